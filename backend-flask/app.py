@@ -10,11 +10,22 @@ import json
 import hashlib
 from flask_cors import CORS
 from user_agents import parse
-from decoy_database import get_memory_db
-from postgres_db import get_db_connection, log_attacker_information, generate_attacker_json, send_log_to_logstash
+from decoy_database import get_decoy_connections, get_decoy_result_cache, get_decoy_sandboxes, get_memory_db, release_memory_db
+from postgres_db import db_connection, get_db_pool, generate_attacker_json
+from log_shipper import get_log_shipper
+from capture_pipeline import get_capture_pipeline, get_flood_suppressor, get_late_verdict_upgrader, queue_attacker_information
+import common_path
+from geolocation import get_geolocation_service
+from verdict_cache import get_verdict_cache
+from attacker_cache import get_attacker_session_cache
+from gemini_batcher import get_gemini_batcher
+from gemini_governor import GeminiUnavailable, get_gemini_governor
+from metrics import instrument_app, time_postgres
 from psycopg2.extras import DictCursor
 
 app = Flask(__name__)
+instrument_app(app)
+app.teardown_request(release_memory_db)
 # Configure CORS properly - allow all origins for all routes
 CORS(app, resources={r"/*": {"origins": "*"}}, allow_headers="*", methods=["GET", "POST", "OPTIONS"])
 # cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
@@ -25,40 +36,19 @@ CORS(app, resources={r"/*": {"origins": "*"}}, allow_headers="*", methods=["GET"
 from honeypot_endpoints import register_honeypot_routes
 from soc_admin import register_soc_admin_routes
 
-from gemini import analyze_payload, init_gemini
+from gemini import analyze_payload, generate_content
 
 # Register routes
 register_honeypot_routes(app)
 register_soc_admin_routes(app)
 
-gemini_client = init_gemini()
-
-def temp_payload_analysis(ioc_list, request):
-    # Check request data for suspicious patterns
-    payload = request.data.decode('utf-8') if request.data else ""
-    print(type(request.data))
-    print(type(request.args))
-    if payload == "" and request.args:
-        payload = dict(request.args).__str__()
-        print(payload)
-    
-
-    if any(pattern in payload.lower() for pattern in ["select ", "union ", "insert ", "drop ", "--", "'; ", "' or '", "1=1"]):
-        ioc_list.append("Possible SQL injection attempt")
-    
-    if any(pattern in payload.lower() for pattern in ["<script>", "javascript:", "onerror=", "onload="]):
-        ioc_list.append("Possible XSS attempt")
-
-    print("Current IOC list:", ioc_list)
-
 @app.route('/')
 def index():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT (name) FROM users;')
-    books = cur.fetchall()
-    cur.close()
-    conn.close()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT (name) FROM users;')
+        books = cur.fetchall()
+        cur.close()
     return "Worked: " + books[0][0] 
 
 def analyze_login(data):
@@ -115,7 +105,12 @@ def logConnection():
             }
         }
 
-        log_result = log_attacker_information(attacker_summary)
+        #the sensor doesn't need to wait for the database, the capture workers persist it
+        if not queue_attacker_information(attacker_summary):
+            return jsonify({
+                "status": "error",
+                "message": "Capture queue is full, attack attempt dropped"
+            }), 503
         
         # Return a success response with status code 200
         return jsonify({
@@ -131,37 +126,35 @@ def logConnection():
         }), 500
 
 def example_ua_queries():
-    conn = get_db_connection()
-    db = conn.cursor()
-
-    # Get count of attacker requests by operating system
-    os_stats = db.execute("""
-        SELECT os, COUNT(*) as count 
-        FROM Attacker 
-        GROUP BY os 
-        ORDER BY count DESC
-    """)
-    
-    # Get count of mobile vs desktop attacks
-    device_stats = db.execute("""
-        SELECT device_type, COUNT(*) as count 
-        FROM Attacker 
-        GROUP BY device_type
-    """)
-    
-    # Get all bot traffic
-    bots = db.execute("""
-        SELECT COUNT(*) FROM Attacker 
-        WHERE is_bot = true
-    """)
-
-    #error handling
-    os_stats = (os_stats.fetchall()) if os_stats else []
-    device_stats = (device_stats.fetchall()) if device_stats else []
-    bots = (bots.fetchall()) if bots else []
+    with db_connection() as conn:
+        db = conn.cursor()
+
+        # Get count of attacker requests by operating system
+        os_stats = db.execute("""
+            SELECT os, COUNT(*) as count 
+            FROM Attacker 
+            GROUP BY os 
+            ORDER BY count DESC
+        """)
+        
+        # Get count of mobile vs desktop attacks
+        device_stats = db.execute("""
+            SELECT device_type, COUNT(*) as count 
+            FROM Attacker 
+            GROUP BY device_type
+        """)
+        
+        # Get all bot traffic
+        bots = db.execute("""
+            SELECT COUNT(*) FROM Attacker 
+            WHERE is_bot = true
+        """)
 
+        #error handling
+        os_stats = (os_stats.fetchall()) if os_stats else []
+        device_stats = (device_stats.fetchall()) if device_stats else []
+        bots = (bots.fetchall()) if bots else []
 
-    conn.close()
     return {
         "os_stats": [dict(row) for row in os_stats],
         "device_stats": [dict(row) for row in device_stats],
@@ -200,32 +193,101 @@ def debug_db():
         "sample_user": sample_user
     })
 
+#per thread decoy connections and how long their statements waited on table locks
+@app.route('/api/debug/decoy_connections', methods=['GET'])
+def debug_decoy_connections():
+    """Debug endpoint to check decoy sqlite lock contention"""
+    return jsonify(get_decoy_connections().stats())
+
+@app.route('/api/debug/decoy_sandboxes', methods=['GET'])
+def debug_decoy_sandboxes():
+    """Debug endpoint to check the per attacker decoy copies and their memory use"""
+    return jsonify(get_decoy_sandboxes().stats())
+
+@app.route('/api/debug/decoy_cache', methods=['GET'])
+def debug_decoy_cache():
+    """Debug endpoint to check the decoy read result cache"""
+    return jsonify(get_decoy_result_cache().stats())
+
+#queue depth and drop counters for the background capture workers
+@app.route('/api/debug/capture_pipeline', methods=['GET'])
+def debug_capture_pipeline():
+    """Debug endpoint to check the capture queue"""
+    return jsonify(get_capture_pipeline().stats())
+
+@app.route('/api/debug/flood_suppression', methods=['GET'])
+def debug_flood_suppression():
+    """Debug endpoint to check how many repeated captures are only being counted"""
+    return jsonify(get_flood_suppressor().stats())
+
+#size, idle connections and borrow wait times for the postgres pool
+@app.route('/api/debug/db_pool', methods=['GET'])
+def debug_db_pool():
+    """Debug endpoint to check the postgres connection pool"""
+    return jsonify(get_db_pool().stats())
+
+@app.route('/api/debug/geolocation', methods=['GET'])
+def debug_geolocation():
+    """Debug endpoint to check the geolocation cache hit rate"""
+    return jsonify(get_geolocation_service().stats())
+
+@app.route('/api/debug/attacker_cache', methods=['GET'])
+def debug_attacker_cache():
+    """Debug endpoint to check how many captures skip session resolution"""
+    return jsonify(get_attacker_session_cache().stats())
+
+@app.route('/api/debug/verdict_cache', methods=['GET'])
+def debug_verdict_cache():
+    """Debug endpoint to check how many gemini calls the verdict cache is saving"""
+    return jsonify(get_verdict_cache().stats())
+
+@app.route('/api/debug/gemini_batcher', methods=['GET'])
+def debug_gemini_batcher():
+    """Debug endpoint to check how many payloads go out per gemini call"""
+    return jsonify(get_gemini_batcher().stats())
+
+#concurrency, rate limit headroom and circuit breaker state of the gemini client
+@app.route('/api/debug/gemini_governor', methods=['GET'])
+def debug_gemini_governor():
+    """Debug endpoint to check whether gemini calls are being throttled or skipped"""
+    return jsonify(get_gemini_governor().stats())
+
+@app.route('/api/debug/late_verdicts', methods=['GET'])
+def debug_late_verdicts():
+    """Debug endpoint to check fallback verdicts waiting on a late gemini answer"""
+    return jsonify(get_late_verdict_upgrader().stats())
+
+@app.route('/api/debug/log_shipper', methods=['GET'])
+def debug_log_shipper():
+    """Debug endpoint to check logstash throughput and how far behind shipping is"""
+    return jsonify(get_log_shipper().stats())
+
 #Testing to see attacker information
 @app.route('/api/debug/attackers', methods=['GET'])
 def debug_attackers():
     """Debug endpoint to view attacker records"""
     try:
-        conn = get_db_connection()
-        db = conn.cursor(cursor_factory=DictCursor)
+        with db_connection() as conn:
+            db = conn.cursor(cursor_factory=DictCursor)
         
-        db.execute("SELECT * FROM Attacker ORDER BY last_seen DESC")
+            db.execute("SELECT * FROM Attacker ORDER BY last_seen DESC")
 
-        rows = db.fetchall()
+            rows = db.fetchall()
 
-        print(rows)
+            print(rows)
 
-        attackers = []
+            attackers = []
 
-        if rows:
-            attackers = [dict(row) for row  in rows]
+            if rows:
+                attackers = [dict(row) for row  in rows]
         
 
-        db.execute("SELECT * FROM Attack ORDER BY timestamp DESC")
+            db.execute("SELECT * FROM Attack ORDER BY timestamp DESC")
 
-        rows = db.fetchall()
+            rows = db.fetchall()
 
-        if rows:
-            attacks = [dict(row) for row  in rows]
+            if rows:
+                attacks = [dict(row) for row  in rows]
 
         print("Getting to this stage")
         reponse_obj = example_ua_queries()
@@ -302,9 +364,9 @@ def test_generate_json():
     }
 
     attacker_json = generate_attacker_json(attack_command, 1)
-    response = send_log_to_logstash("https://cs412anallam.me", attacker_json)
 
-    if not response:
+    #posted straight away (not queued) so the route reports whether logstash is reachable
+    if not get_log_shipper().send([attacker_json], max_retries=0):
         #Not connecting to the elk
         return jsonify({"error" : "Probably having issue connecting to elk"}), 500
     
@@ -320,27 +382,27 @@ def generate_narrative_report():
         return jsonify({"error": "attacker_id is required"}), 400
 
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+        with db_connection() as conn:
+            cur = conn.cursor()
 
-        query = """
-            SELECT a.gemini_response
-            FROM attack a
-            JOIN honeypot_session s ON a.session_id = s.session_id
-            WHERE s.attacker_id = %s
-        """
-        params = [attacker_id]
+            query = """
+                SELECT a.gemini_response
+                FROM attack a
+                JOIN honeypot_session s ON a.session_id = s.session_id
+                WHERE s.attacker_id = %s
+            """
+            params = [attacker_id]
 
-        if start_date and end_date:
-            query += " AND a.timestamp BETWEEN %s AND %s"
-            params.extend([start_date, end_date])
+            if start_date and end_date:
+                query += " AND a.timestamp BETWEEN %s AND %s"
+                params.extend([start_date, end_date])
 
-        query += " ORDER BY a.timestamp"
+            query += " ORDER BY a.timestamp"
 
-        cur.execute(query, params)
-        responses = [row[0] for row in cur.fetchall() if row[0]]
-        cur.close()
-        conn.close()
+            with time_postgres("narrative_report_responses"):
+                cur.execute(query, params)
+            responses = [row[0] for row in cur.fetchall() if row[0]]
+            cur.close()
 
         if not responses:
             return jsonify({"error": "No Gemini responses found for this attacker"}), 404
@@ -361,45 +423,47 @@ Entries:
 Narrative Summary:"""
         )
         
-        response = gemini_client.models.generate_content(
-            model="gemini-1.5-flash",
-            contents=prompt
-        )
+        #through the governor so a report can't spend the rate limits the capture path depends on
+        try:
+            response = generate_content(prompt)
+        except GeminiUnavailable as e:
+            return jsonify({"error": f"Gemini unavailable: {e}"}), 503
 
         # Store in soc_dashboard
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Get the most recent session_id for this attacker
-        cur.execute("""
-            SELECT s.session_id
-            FROM honeypot_session s
-            WHERE s.attacker_id = %s
-            ORDER BY s.last_seen DESC
-            LIMIT 1
-        """, (attacker_id,))
-        session_result = cur.fetchone()
-
-        if not session_result:
-            return jsonify({"error": "No session found for this attacker"}), 404
-
-        session_id = session_result[0]
-
-        # Insert the report into soc_dashboard
-        cur.execute("""
-            INSERT INTO soc_dashboard (session_id, severity, summary, affected_components, report)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (
-            session_id,
-            1,  # Placeholder severity
-            response.text,
-            'N/A',  # Placeholder for affected components
-            response.text  # Using same text for now
-        ))
-
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_connection() as conn:
+            cur = conn.cursor()
+
+            # Get the most recent session_id for this attacker
+            with time_postgres("narrative_report_session"):
+                cur.execute("""
+                    SELECT s.session_id
+                    FROM honeypot_session s
+                    WHERE s.attacker_id = %s
+                    ORDER BY s.last_seen DESC
+                    LIMIT 1
+                """, (attacker_id,))
+            session_result = cur.fetchone()
+
+            if not session_result:
+                return jsonify({"error": "No session found for this attacker"}), 404
+
+            session_id = session_result[0]
+
+            # Insert the report into soc_dashboard
+            with time_postgres("insert_report"):
+                cur.execute("""
+                    INSERT INTO soc_dashboard (session_id, severity, summary, affected_components, report)
+                    VALUES (%s, %s, %s, %s, %s)
+                """, (
+                    session_id,
+                    1,  # Placeholder severity
+                    response.text,
+                    'N/A',  # Placeholder for affected components
+                    response.text  # Using same text for now
+                ))
+
+            conn.commit()
+            cur.close()
 
         return jsonify({
             "attacker_id": attacker_id,
@@ -417,20 +481,20 @@ Narrative Summary:"""
 @app.route('/api/reports', methods=['GET'])
 def get_reports():
     try:
-        conn = get_db_connection()
-        print(f"[DEBUG] DB Connection: {conn}") # DEBUG
-        cur = conn.cursor(cursor_factory=DictCursor)
-
-        cur.execute("""
-            SELECT s.session_id, s.attacker_id, d.report_id, d.summary, d.severity, d.created_at
-            FROM soc_dashboard d
-            JOIN honeypot_session s ON s.session_id = d.session_id
-            ORDER BY d.created_at DESC
-        """)
-
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
+        with db_connection() as conn:
+            print(f"[DEBUG] DB Connection: {conn}") # DEBUG
+            cur = conn.cursor(cursor_factory=DictCursor)
+
+            with time_postgres("reports"):
+                cur.execute("""
+                    SELECT s.session_id, s.attacker_id, d.report_id, d.summary, d.severity, d.created_at
+                    FROM soc_dashboard d
+                    JOIN honeypot_session s ON s.session_id = d.session_id
+                    ORDER BY d.created_at DESC
+                """)
+
+            rows = cur.fetchall()
+            cur.close()
 
         reports = [dict(row) for row in rows]
 
@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+#Attacker identity and session window cache
+#Maps (ip, fingerprint) to attacker_id and attacker_id to its current (session_id, last_seen), so an
+#attacker that was seen inside the session window is recorded with plain UPDATEs instead of going through
+#resolve_attacker_session. last_seen is only ever moved forward from the start of the transaction that
+#touched the session, so an entry the cache calls active is active in postgres as well. Entries expire
+#a margin before the 15 minute window ends to allow for clock drift between the app and the database
+
+#keep in step with the interval in resolve_attacker_session (init_db.py)
+SESSION_WINDOW = 15 * 60
+
+class AttackerSessionCache:
+    def __init__(self, max_entries=100000, window=SESSION_WINDOW, margin=30):
+        self.max_entries = max_entries
+        self.ttl = window - margin
+        self._identities = OrderedDict()
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+        #counters exposed through stats()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidated = 0
+
+    def lookup(self, ip_address, device_fingerprint):
+        """(attacker_id, session_id) when the attacker has a session inside the window, otherwise None"""
+        now = time.time()
+        with self._lock:
+            attacker_id = self._identities.get((ip_address, device_fingerprint))
+            session = self._sessions.get(attacker_id) if attacker_id is not None else None
+
+            if session is None:
+                self.misses += 1
+                return None
+
+            session_id, last_seen = session
+            if now - last_seen >= self.ttl:
+                del self._sessions[attacker_id]
+                self.expired += 1
+                self.misses += 1
+                return None
+
+            self._identities.move_to_end((ip_address, device_fingerprint))
+            self.hits += 1
+            return attacker_id, session_id
+
+    def remember(self, ip_address, device_fingerprint, attacker_id, session_id, seen_at):
+        """Record the session written in a transaction that started at seen_at (time.time())"""
+        with self._lock:
+            key = (ip_address, device_fingerprint)
+            self._identities[key] = attacker_id
+            self._identities.move_to_end(key)
+
+            current = self._sessions.get(attacker_id)
+            if current is None or current[0] != session_id or current[1] < seen_at:
+                self._sessions[attacker_id] = (session_id, seen_at)
+                self._sessions.move_to_end(attacker_id)
+
+            self._prune(time.time())
+
+    def forget(self, ip_address, device_fingerprint):
+        with self._lock:
+            attacker_id = self._identities.pop((ip_address, device_fingerprint), None)
+            self._sessions.pop(attacker_id, None)
+            self.invalidated += 1
+
+    def clear(self):
+        with self._lock:
+            self._identities.clear()
+            self._sessions.clear()
+
+    def _prune(self, now):
+        #sessions are kept in touch order, expired ones are all at the front
+        while self._sessions:
+            attacker_id, (_, last_seen) = next(iter(self._sessions.items()))
+            if now - last_seen < self.ttl:
+                break
+            del self._sessions[attacker_id]
+            self.expired += 1
+
+        while len(self._identities) > self.max_entries:
+            _, attacker_id = self._identities.popitem(last=False)
+            self._sessions.pop(attacker_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0,
+                "expired": self.expired,
+                "invalidated": self.invalidated,
+                "identities": len(self._identities),
+                "active_sessions": len(self._sessions),
+                "capacity": self.max_entries,
+                "ttl": self.ttl
+            }
+
+
+_attacker_session_cache = None
+_attacker_session_cache_lock = threading.Lock()
+
+def get_attacker_session_cache():
+    global _attacker_session_cache
+
+    with _attacker_session_cache_lock:
+        if _attacker_session_cache is None:
+            _attacker_session_cache = AttackerSessionCache(max_entries=int(os.environ.get('ATTACKER_CACHE_SIZE', 100000)))
+
+    return _attacker_session_cache
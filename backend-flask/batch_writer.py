@@ -0,0 +1,151 @@
+import atexit
+import os
+import queue
+import threading
+import time
+import psycopg2
+from postgres_db import log_attacker_batch
+
+#Batched postgres writer
+#Capture events are collected for up to max_latency_ms or max_events and written in one transaction,
+#so a scanner flood costs one commit per batch instead of a commit per statement
+
+class AttackBatchWriter:
+    def __init__(self, write_batch, max_events=100, max_latency_ms=250, max_pending=10000):
+        self.write_batch = write_batch
+        self.max_events = max_events
+        self.max_latency = max_latency_ms / 1000
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+        #counters exposed through stats()
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.last_batch_size = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="attack-batch-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, attacker_summary):
+        """Queue an event for the next batch, returns False if the writer is backed up and the event was dropped"""
+        self.start()
+
+        try:
+            self._queue.put_nowait(attacker_summary)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            print("Attack batch writer is backed up, dropping event")
+            return False
+
+    def flush(self):
+        """Write everything that is currently queued from the calling thread"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+            if len(batch) >= self.max_events:
+                self._write(batch)
+                batch = []
+
+        if batch:
+            self._write(batch)
+
+    def close(self, timeout=5):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": self._queue.qsize(),
+                "batches": self.batches,
+                "written": self.written,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "last_batch_size": self.last_batch_size,
+                "max_events": self.max_events,
+                "max_latency_ms": int(self.max_latency * 1000)
+            }
+
+    def _collect(self):
+        """Block for the first event then gather more until the batch is full or the window closes"""
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_events:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            self.write_batch(batch)
+            with self._lock:
+                self.batches += 1
+                self.written += len(batch)
+                self.last_batch_size = len(batch)
+            return
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            #postgres is unreachable, every event would fail the same way after its own connection timeout
+            print(f"Batch write of {len(batch)} events failed, postgres unavailable: {e}")
+            with self._lock:
+                self.failed += len(batch)
+            return
+        except Exception as e:
+            print(f"Batch write of {len(batch)} events failed: {e}")
+
+        if len(batch) == 1:
+            with self._lock:
+                self.failed += 1
+            return
+
+        #retry one by one so a single bad event doesn't lose the whole batch
+        for attacker_summary in batch:
+            self._write([attacker_summary])
+
+    def _run(self):
+        while not self._stopped.is_set():
+            batch = self._collect()
+            if batch:
+                self._write(batch)
+
+
+_attack_batch_writer = None
+_attack_batch_writer_lock = threading.Lock()
+
+def get_attack_batch_writer():
+    global _attack_batch_writer
+
+    with _attack_batch_writer_lock:
+        if _attack_batch_writer is None:
+            _attack_batch_writer = AttackBatchWriter(
+                log_attacker_batch,
+                max_events=int(os.environ.get('ATTACK_BATCH_MAX_EVENTS', 100)),
+                max_latency_ms=int(os.environ.get('ATTACK_BATCH_MAX_MS', 250))
+            )
+            #write out whatever is still buffered when the worker shuts down
+            atexit.register(_attack_batch_writer.close)
+
+    return _attack_batch_writer
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import timeit
+
+#Query plan benchmark for the decoy schema
+#Builds the decoy database at several multiples of the generated data, runs the SQL every decoy route
+#issues (with the arguments a scanner typically sends) and checks EXPLAIN QUERY PLAN for full scans of
+#tables that have an index for that access path. Exits non zero when one is found, so a schema change
+#that drops an index or a route query that stops using one fails the run
+#
+#Usage:
+#   python benchmarks/decoy_query_plans.py --scales 1,10,100 --output plans.json
+#   python benchmarks/decoy_query_plans.py --scales 100 --without-indexes
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from decoy_snapshot import run_source_scripts
+
+#table -> (primary key, {column: table it references}, columns that must stay unique)
+SCALED_TABLES = {
+    "Users": ("user_id", {"department_id": None}, ("username",)),
+    "Expenses": ("expense_id", {"user_id": "Users", "last_modified_by": "Users"}, ()),
+    "ITSupport": ("ticket_id", {"reported_by": "Users", "assigned_to": "Users"}, ()),
+    "SecurityAnswers": ("answer_id", {"user_id": "Users"}, ()),
+    "Forum": ("forum_id", {"user_id": "Users"}, ()),
+    "ForumComments": ("comment_id", {"forum_id": "Forum", "user_id": "Users"}, ()),
+}
+
+#(name, sql, plan entries that must not be a full scan, by table name or alias as the plan shows them)
+DECOY_QUERIES = [
+    ("login", "select * from users where username = 'jwoodard' and password = '5f4dcc3b5aa765d61d8327deb882cf99'", ["users"]),
+    ("user_by_username", "SELECT user_id FROM Users WHERE username = 'jwoodard'", ["Users"]),
+    ("validate_security_answers", "SELECT * FROM SecurityAnswers WHERE user_id = 5 AND question_id = 2 AND answer = 'Fluffy'", ["SecurityAnswers"]),
+    ("security_questions",
+     "SELECT sq.question_id, sq.question_text FROM SecurityAnswers sa "
+     "JOIN SecurityQuestions sq ON sa.question_id = sq.question_id WHERE sa.user_id = 5", ["sa", "sq"]),
+    ("change_password", "UPDATE Users SET password = '5f4dcc3b5aa765d61d8327deb882cf99' WHERE user_id = 5", ["Users"]),
+    ("forum_by_id",
+     "Select *  from Forum inner join Users as us on Forum.user_id = us.user_id WHERE Forum.forum_id = 3", ["Forum", "us"]),
+    ("forum_by_user",
+     "Select *  from Forum inner join Users as us on Forum.user_id = us.user_id WHERE Forum.user_id = 5", ["Forum", "us"]),
+    ("forum_all", "Select *  from Forum inner join Users as us on Forum.user_id = us.user_id ", ["us"]),
+    ("forum_comments_by_forum",
+     "Select *, fm.title as forum_title from ForumComments "
+     "inner join Forum as fm on ForumComments.forum_id = fm.forum_id "
+     "inner join Users as us on ForumComments.user_id = us.user_id WHERE ForumComments.forum_id = 3",
+     ["ForumComments", "fm", "us"]),
+    ("forum_comments_by_user",
+     "Select *, fm.title as forum_title from ForumComments "
+     "inner join Forum as fm on ForumComments.forum_id = fm.forum_id "
+     "inner join Users as us on ForumComments.user_id = us.user_id WHERE ForumComments.user_id = 5",
+     ["ForumComments", "fm", "us"]),
+    ("reimbursement_by_name",
+     "select * from Expenses inner join Users us on Expenses.user_id = us.user_id WHERE us.name = 'Jordan Woodard'",
+     ["Expenses", "us"]),
+    ("reimbursement_all", "select * from Expenses inner join Users us on Expenses.user_id = us.user_id", ["us"]),
+    ("it_support_all",
+     "Select ITSupport.reported_by as reported_by_id, ITSupport.assigned_to as assigned_to_id, user1.name as reported_by, "
+     "user2.name as assigned_to, ITSupport.* from ITSupport "
+     "inner join Users as user1 on ITSupport.reported_by = user1.user_id "
+     "inner join Users as user2 on ITSupport.assigned_to = user2.user_id ", ["user1", "user2"]),
+    ("performance_analytics_all",
+     "Select *, d.name as department_name from PerformanceAnalytics "
+     "inner join Department as d on PerformanceAnalytics.department_id = d.department_id ", ["d"]),
+    ("employees_by_username", "SELECT * FROM Users WHERE username = 'jwoodard'", ["Users"]),
+]
+
+def build_decoy_db(scale=1, indexes=True):
+    """In-memory decoy database with the generated data repeated scale times, ids and usernames are
+    offset per copy so every foreign key still points at a row of the same copy"""
+    connection = sqlite3.connect(":memory:")
+    run_source_scripts(connection)
+
+    if not indexes:
+        for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'").fetchall():
+            connection.execute(f"DROP INDEX {name}")
+
+    sizes = {table: connection.execute(f"SELECT MAX({key}) FROM {table}").fetchone()[0] or 0
+             for table, (key, _, _) in SCALED_TABLES.items()}
+
+    for copy in range(1, scale):
+        for table, (key, references, unique) in SCALED_TABLES.items():
+            columns = [row[1] for row in connection.execute(f"PRAGMA table_info({table})").fetchall()]
+            values = []
+            for column in columns:
+                if column == key:
+                    values.append(f"{column} + {copy * sizes[table]}")
+                elif references.get(column):
+                    values.append(f"{column} + {copy * sizes[references[column]]}")
+                elif column in unique:
+                    values.append(f"{column} || '_{copy}'")
+                else:
+                    values.append(column)
+            connection.execute(
+                f"INSERT INTO {table} ({', '.join(columns)}) SELECT {', '.join(values)} FROM {table} WHERE {key} <= {sizes[table]}"
+            )
+    connection.commit()
+    return connection
+
+def full_scans(connection, sql, searched):
+    """Plan steps that scan a whole table which should have been searched through an index"""
+    plan = [row[3] for row in connection.execute("EXPLAIN QUERY PLAN " + sql).fetchall()]
+    scans = [step for step in plan if step.startswith("SCAN ") and step.split()[1] in searched]
+    return plan, scans
+
+def run_plans(scales=(1, 10, 100), indexes=True, repeat=5):
+    report = {}
+    for scale in scales:
+        connection = build_decoy_db(scale, indexes)
+        rows = {table: connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in SCALED_TABLES}
+        queries = {}
+        for name, sql, searched in DECOY_QUERIES:
+            plan, scans = full_scans(connection, sql, searched)
+            number = 20
+            timings = timeit.repeat(lambda: connection.execute(sql).fetchall(), number=number, repeat=repeat)
+            connection.rollback()
+            queries[name] = {
+                "median_us": round(statistics.median(timings) / number * 1e6, 2),
+                "plan": plan,
+                "full_scans": scans
+            }
+        report[str(scale)] = {"rows": rows, "queries": queries}
+        connection.close()
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and time the decoy route queries at larger data scales")
+    parser.add_argument("--scales", default="1,10,100", help="comma separated multiples of the generated data")
+    parser.add_argument("--without-indexes", action="store_true", help="drop the idx_ indexes to compare against")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args()
+
+    report = run_plans([int(scale) for scale in args.scales.split(",")], not args.without_indexes, args.repeat)
+
+    failures = 0
+    for scale, result in report.items():
+        print(f"scale x{scale} ({result['rows']['Users']} users, {result['rows']['ForumComments']} comments)")
+        for name, query in result["queries"].items():
+            flag = f"  full scan ({', '.join(query['full_scans'])})" if query["full_scans"] else ""
+            failures += bool(query["full_scans"])
+            print(f"    {name:<28}{query['median_us']:>12.2f} us{flag}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    if failures and not args.without_indexes:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
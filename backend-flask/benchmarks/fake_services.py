@@ -0,0 +1,206 @@
+import argparse
+import gzip
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#Local stand-ins for gemini, ipinfo and logstash so the backend can be load tested offline
+#Each one is a threaded http server on 127.0.0.1 that answers after latency_ms (+/- jitter_ms) and fails
+#error_rate of the requests with a 503. Point the backend at them with the variables from environment()
+#
+#Usage (serve them for a backend started separately, prints the variables to export):
+#   python benchmarks/fake_services.py --gemini-latency-ms 800 --ipinfo-latency-ms 40
+
+GEMINI_ANSWER = (
+    "Injection - SQL",
+    "[{query: ' or 1=1}]",
+    "Stand-in verdict from the load test gemini server"
+)
+
+class FakeService:
+    name = "service"
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+        #counters exposed through stats()
+        self.requests = 0
+        self.failed = 0
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, port=0):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                service._handle(self)
+
+            def do_POST(self):
+                service._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f"fake-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def _handle(self, request):
+        body = request.rfile.read(int(request.headers.get('Content-Length') or 0))
+
+        with self._lock:
+            self.requests += 1
+            delay = max(0, self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.failed += 1
+
+        time.sleep(delay)
+
+        if failed:
+            status, payload = 503, {"error": {"code": 503, "message": "stand-in failure", "status": "UNAVAILABLE"}}
+        else:
+            status, payload = 200, self.respond(request, body)
+
+        data = json.dumps(payload).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def respond(self, request, body):
+        return {}
+
+    def stats(self):
+        with self._lock:
+            return {"url": self.url, "requests": self.requests, "failed": self.failed}
+
+
+class FakeGemini(FakeService):
+    """Answers generateContent with the three line verdict, numbered per payload for batched prompts"""
+    name = "gemini"
+
+    def respond(self, request, body):
+        prompt = " ".join(
+            part.get("text", "")
+            for content in json.loads(body or b"{}").get("contents", [])
+            for part in content.get("parts", [])
+        )
+
+        batched = len(re.findall(r"Payload \[(\d+)\]:", prompt))
+        if batched:
+            text = "\n".join(f"[{i + 1}]\n" + "\n".join(GEMINI_ANSWER) for i in range(batched))
+        else:
+            text = "\n".join(GEMINI_ANSWER)
+
+        return {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+            "usageMetadata": {"promptTokenCount": len(prompt) // 4, "candidatesTokenCount": len(text) // 4}
+        }
+
+
+class FakeIpinfo(FakeService):
+    """Answers /<ip> like ipinfo's details endpoint"""
+    name = "ipinfo"
+
+    def respond(self, request, body):
+        ip_address = request.path.strip("/").split("?")[0]
+        return {
+            "ip": ip_address,
+            "city": "Ashburn",
+            "region": "Virginia",
+            "country": "US",
+            "loc": "39.0437,-77.4875",
+            "org": "AS14618 Amazon.com, Inc.",
+            "timezone": "America/New_York"
+        }
+
+
+class FakeLogstash(FakeService):
+    """Accepts gzip NDJSON batches like the logstash http input and counts the events"""
+    name = "logstash"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.events = 0
+
+    def respond(self, request, body):
+        if request.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        with self._lock:
+            self.events += sum(1 for line in body.split(b"\n") if line.strip())
+        return {}
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats["events"] = self.events
+        return stats
+
+
+def start_fake_services(gemini_latency_ms=800, ipinfo_latency_ms=40, logstash_latency_ms=20,
+                        jitter_ms=0, error_rate=0.0, seed=None):
+    """Start all three stand-ins, returns {name: service}"""
+    return {
+        "gemini": FakeGemini(gemini_latency_ms, jitter_ms, error_rate, seed).start(),
+        "ipinfo": FakeIpinfo(ipinfo_latency_ms, jitter_ms, error_rate, seed).start(),
+        "logstash": FakeLogstash(logstash_latency_ms, jitter_ms, error_rate, seed).start()
+    }
+
+def environment(services):
+    """Backend environment variables that route gemini, ipinfo and logstash to the stand-ins"""
+    return {
+        "GEMINI_API_KEY": "load-test",
+        "GEMINI_BASE_URL": services["gemini"].url,
+        "IP_INFO_ACCESS_TOKEN": "load-test",
+        "IPINFO_API_URL": services["ipinfo"].url,
+        "LOGSTASH_URL": services["logstash"].url
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve local gemini, ipinfo and logstash stand-ins")
+    parser.add_argument("--gemini-latency-ms", type=float, default=800)
+    parser.add_argument("--ipinfo-latency-ms", type=float, default=40)
+    parser.add_argument("--logstash-latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    services = start_fake_services(args.gemini_latency_ms, args.ipinfo_latency_ms, args.logstash_latency_ms,
+                                   args.jitter_ms, args.error_rate)
+    for key, value in environment(services).items():
+        print(f"export {key}={value}")
+
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps({name: service.stats() for name, service in services.items()}))
+    except KeyboardInterrupt:
+        for service in services.values():
+            service.stop()
+
+if __name__ == "__main__":
+    main()
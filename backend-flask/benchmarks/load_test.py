@@ -0,0 +1,268 @@
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+
+#Traffic replay load test for the backend
+#Replays an attack corpus (the training payloads or captured logstash events) at a fixed rate and
+#concurrency and reports p50/p95/p99 latency, throughput and error rate per route. Without --target the
+#backend is started in this process on a free port with gemini, ipinfo and logstash pointed at the local
+#stand-ins from fake_services.py, postgres still comes from the usual DB_* variables
+#
+#Usage:
+#   python benchmarks/load_test.py --requests 2000 --rps 200 --concurrency 32 --output baseline.json
+#   python benchmarks/load_test.py --requests 2000 --rps 200 --concurrency 32 --baseline baseline.json
+#   python benchmarks/load_test.py --target http://127.0.0.1:5000 --corpus captured.ndjson
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from fake_services import environment, start_fake_services
+
+TRAINING_CORPUS = os.path.join(BACKEND_DIR, '..', 'training-matrial', 'payloads.json')
+
+#the mix of tools hitting the decoy, the parse results are memoized so a handful is realistic
+USER_AGENTS = [
+    "sqlmap/1.7.2#stable (https://sqlmap.org)",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+    "curl/7.88.1",
+    "python-requests/2.31.0",
+    "Mozilla/5.0 zgrab/0.x",
+]
+
+def _b64(value):
+    return base64.b64encode(value.encode()).decode()
+
+#(route, method, path, build(payload) -> (query params, json body))
+ROUTES = [
+    ("forum", "GET", "/api/forum", lambda payload: ({"forum_id": payload}, None)),
+    ("forum_comments", "GET", "/api/forum/comments", lambda payload: ({"forum_id": payload}, None)),
+    ("employees", "GET", "/api/admin/employees", lambda payload: ({"name": payload}, None)),
+    ("reimbursement", "GET", "/api/admin/reimbursement", lambda payload: ({"name": payload}, None)),
+    ("it_support", "GET", "/api/admin/it_support", lambda payload: ({"ticket_id": payload}, None)),
+    ("login", "POST", "/api/login", lambda payload: ({}, {"username": _b64(payload), "password": _b64("password123")})),
+]
+
+def load_corpus(path=TRAINING_CORPUS):
+    """Payload strings from a payloads.json style list, or captured events (one logstash log per line)
+    as dicts holding the path, query string, user agent and ip to replay"""
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+
+    if text.lstrip().startswith("["):
+        return [entry["payload"] for entry in json.loads(text) if entry.get("payload")]
+
+    events = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        log = json.loads(line)
+        request_url = log.get("request-url") or {}
+        try:
+            user_agent = json.loads(log.get("user-agent") or "{}").get("raw", "")
+        except ValueError:
+            user_agent = log.get("user-agent") or ""
+        events.append({
+            "path": request_url.get("path", "/"),
+            "query_string": request_url.get("query_string", ""),
+            "user_agent": user_agent,
+            "ip": log.get("ip")
+        })
+    return events
+
+def attacker_addresses(count, seed=0):
+    """count distinct routable addresses, so geolocation and the attacker cache see count attackers"""
+    rng = random.Random(seed)
+    addresses = set()
+    while len(addresses) < count:
+        addresses.add(f"{rng.randint(11, 99)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}")
+    return sorted(addresses)
+
+def build_requests(corpus, count, attackers=50, routes=None, seed=0):
+    """count request specs cycling through the corpus, payloads are spread over the routes in turn"""
+    routes = [route for route in ROUTES if not routes or route[0] in routes]
+    addresses = attacker_addresses(attackers, seed)
+    rng = random.Random(seed)
+
+    specs = []
+    for i in range(count):
+        item = corpus[i % len(corpus)]
+        headers = {"X-Forwarded-For": rng.choice(addresses), "User-Agent": rng.choice(USER_AGENTS)}
+
+        if isinstance(item, dict):
+            #captured event, replayed as it arrived
+            headers["User-Agent"] = item["user_agent"] or headers["User-Agent"]
+            headers["X-Forwarded-For"] = item["ip"] or headers["X-Forwarded-For"]
+            path = item["path"] + ("?" + item["query_string"] if item["query_string"] else "")
+            specs.append({"route": item["path"], "method": "GET", "path": path, "json": None, "headers": headers})
+            continue
+
+        name, method, path, build = routes[i % len(routes)]
+        params, body = build(item)
+        if params:
+            path += "?" + urlencode(params)
+        specs.append({"route": name, "method": method, "path": path, "json": body, "headers": headers})
+
+    return specs
+
+def run_load(target, specs, rps=0, concurrency=16, timeout=30):
+    """Send specs from concurrency threads, request i is due at i / rps seconds (as fast as possible when
+    rps is 0). Latency is measured from when the request was due rather than when it was sent, so a
+    backend that falls behind the rate shows it instead of hiding it. Returns (results, elapsed)"""
+    results = []
+    results_lock = threading.Lock()
+    next_index = [0]
+    started = time.perf_counter()
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with results_lock:
+                index = next_index[0]
+                next_index[0] += 1
+            if index >= len(specs):
+                return
+
+            spec = specs[index]
+            due = started + index / rps if rps else time.perf_counter()
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+
+            status = None
+            try:
+                response = session.request(spec["method"], target + spec["path"], json=spec["json"],
+                                           headers=spec["headers"], timeout=timeout)
+                status = response.status_code
+            except requests.RequestException:
+                pass
+
+            latency = time.perf_counter() - due
+            with results_lock:
+                results.append((spec["route"], status, latency))
+
+    threads = [threading.Thread(target=worker, name=f"load-{i}", daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results, time.perf_counter() - started
+
+def percentile(sorted_values, pct):
+    """Nearest rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+def summarize(results, elapsed):
+    """Per route (and "all") request count, error rate, throughput and latency percentiles in ms.
+    Errors are transport failures and 5xx answers, the decoy answers 500 to payloads that break its SQL
+    so the status breakdown is kept alongside"""
+    by_route = {}
+    for route, status, latency in results:
+        by_route.setdefault(route, []).append((status, latency))
+        by_route.setdefault("all", []).append((status, latency))
+
+    report = {}
+    for route, samples in sorted(by_route.items()):
+        latencies = sorted(latency * 1000 for _, latency in samples)
+        errors = sum(1 for status, _ in samples if status is None or status >= 500)
+        statuses = {}
+        for status, _ in samples:
+            statuses[str(status or "failed")] = statuses.get(str(status or "failed"), 0) + 1
+        report[route] = {
+            "requests": len(samples),
+            "errors": errors,
+            "error_rate": round(errors / len(samples), 4),
+            "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else 0,
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "max_ms": round(latencies[-1], 2),
+            "statuses": statuses
+        }
+    return report
+
+def print_report(report, baseline=None):
+    print(f"{'route':<28}{'requests':>9}{'errors':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, row in report.items():
+        print(f"{route:<28}{row['requests']:>9}{row['error_rate']:>8.1%}{row['throughput_rps']:>9}"
+              f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+
+        previous = (baseline or {}).get(route)
+        if previous:
+            #change against the baseline run, negative latency and positive throughput are improvements
+            deltas = [f"{key} {row[key] - previous[key]:+.2f}" for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms")]
+            print(f"{'  vs baseline':<28}" + ", ".join(deltas))
+
+def serve_backend():
+    """Start the backend app on a free local port in a background thread, returns its base url"""
+    from werkzeug.serving import make_server
+    from app import app
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="load-test-backend", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay an attack corpus against the backend")
+    parser.add_argument("--target", help="base url of a running backend, by default one is started in process")
+    parser.add_argument("--corpus", default=TRAINING_CORPUS, help="payloads.json or captured logstash events (NDJSON)")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--rps", type=float, default=100, help="request rate, 0 sends as fast as the threads allow")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--attackers", type=int, default=50, help="distinct attacker addresses")
+    parser.add_argument("--routes", help="comma separated route names to restrict the mix to")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--gemini-latency-ms", type=float, default=800)
+    parser.add_argument("--ipinfo-latency-ms", type=float, default=40)
+    parser.add_argument("--logstash-latency-ms", type=float, default=20)
+    parser.add_argument("--output", help="write the report as JSON, to use as a later --baseline")
+    parser.add_argument("--baseline", help="report JSON of an earlier run to compare against")
+    args = parser.parse_args()
+
+    services = None
+    target = args.target
+    if target is None:
+        services = start_fake_services(args.gemini_latency_ms, args.ipinfo_latency_ms, args.logstash_latency_ms)
+        os.environ.update(environment(services))
+        os.chdir(BACKEND_DIR)
+        target = serve_backend()
+
+    corpus = load_corpus(args.corpus)
+    specs = build_requests(corpus, args.requests, args.attackers, args.routes.split(",") if args.routes else None, args.seed)
+    print(f"Replaying {len(specs)} requests from {len(corpus)} corpus entries against {target} "
+          f"at {args.rps or 'max'} rps with {args.concurrency} threads")
+
+    results, elapsed = run_load(target, specs, args.rps, args.concurrency)
+    report = {
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "elapsed_s": round(elapsed, 3),
+        "routes": summarize(results, elapsed)
+    }
+    if services is not None:
+        report["stand_ins"] = {name: service.stats() for name, service in services.items()}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["routes"]
+    print_report(report["routes"], baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+if __name__ == "__main__":
+    main()
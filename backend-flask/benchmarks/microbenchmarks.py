@@ -0,0 +1,201 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import timeit
+from datetime import datetime
+from unittest.mock import patch
+
+#Microbenchmarks for the capture hot paths
+#Each benchmark runs against the in-memory decoy database and in-memory fakes (nothing reaches postgres,
+#gemini or ipinfo) and the results are written as JSON. With --baseline the run is compared against an
+#earlier results file and exits non zero when anything got slower than --tolerance allows
+#
+#Usage:
+#   python benchmarks/microbenchmarks.py --output baseline.json
+#   python benchmarks/microbenchmarks.py --baseline baseline.json --tolerance 0.2
+#   python benchmarks/microbenchmarks.py --only decoy
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BACKEND_DIR)
+
+#the gemini client is a mock and no .env is needed, the app module is only imported for its routes
+os.environ.setdefault('FLASK_TESTING', 'true')
+
+#fixed headers, so the fingerprint, user agent parse and IOC scan do the same work every run
+ATTACK_HEADERS = {
+    "User-Agent": "sqlmap/1.7.2#stable (https://sqlmap.org)",
+    "X-Forwarded-For": "45.83.64.1",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Accept-Encoding": "gzip, deflate"
+}
+ATTACK_QUERY = "name=admin' OR '1'='1&id=1 UNION SELECT username, password FROM users--"
+
+GEMINI_ANSWER = "Injection - SQL\n[{name?: admin' OR '1'='1}]\nTautology based SQL injection against the employee lookup"
+
+#read only decoy routes with arguments that match rows, writes would grow the database between runs
+DECOY_ROUTES = [
+    ("decoy_forum", "GET", "/api/forum?Forum.forum_id=1", None),
+    ("decoy_forum_comments", "GET", "/api/forum/comments?ForumComments.forum_id=1", None),
+    ("decoy_employees", "GET", "/api/admin/employees?username=jwoodard", None),
+    ("decoy_reimbursement", "GET", "/api/admin/reimbursement", None),
+    ("decoy_it_support", "GET", "/api/admin/it_support", None),
+    ("decoy_performance_analytics", "GET", "/api/admin/performance_analytics", None),
+    ("decoy_corporate_initiatives", "GET", "/api/admin/corporate_initiatives", None),
+    ("decoy_login", "POST", "/api/login", {"username": "andwnvd2", "password": "cGFzc3dvcmQ="}),
+]
+
+def measure(fn, number=1000, repeat=5):
+    """Best and median time per call over repeat runs of number calls, in microseconds"""
+    timings = timeit.repeat(fn, number=number, repeat=repeat)
+    per_call = [timing / number * 1e6 for timing in timings]
+    return {
+        "number": number,
+        "repeat": repeat,
+        "best_us": round(min(per_call), 3),
+        "median_us": round(statistics.median(per_call), 3),
+        "ops_per_sec": round(1e6 / min(per_call), 1)
+    }
+
+def capture_benchmarks():
+    """{name: (fn, number)} for the per request capture work"""
+    from app import app
+    from honeypot_endpoints import extract_attacker_info, get_attacker_summary
+    from ioc_rules import get_ioc_rule_engine, request_fields
+    from capture_pipeline import parse_gemini_answer
+    from gemini import split_batch_response
+    from postgres_db import generate_attacker_json
+    from user_agent_parser import clear_user_agent_cache, parse_user_agent
+    from user_agent_parser import _parse_user_agent
+
+    context = app.test_request_context("/api/admin/employees?" + ATTACK_QUERY, headers=ATTACK_HEADERS)
+    context.push()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        attacker_info = extract_attacker_info()
+        attacker_summary = get_attacker_summary(attacker_info)
+
+    ioc_engine = get_ioc_rule_engine()
+    from flask import request
+    fields = request_fields(request)
+
+    attack_command = dict(
+        attacker_summary,
+        gemini=parse_gemini_answer(GEMINI_ANSWER),
+        session_id=1,
+        attacker_info=dict(attacker_info, geolocation={"country": "DE", "city": "Frankfurt"})
+    )
+    batch_answer = "\n".join(f"[{i + 1}]\n{GEMINI_ANSWER}" for i in range(10))
+
+    def quiet(fn):
+        #the capture code prints on every request, keep the terminal write out of the numbers
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):
+                fn()
+        return run
+
+    clear_user_agent_cache()
+    return {
+        "parse_user_agent_cached": (lambda: parse_user_agent(ATTACK_HEADERS["User-Agent"]), 20000),
+        "parse_user_agent_uncached": (lambda: _parse_user_agent(ATTACK_HEADERS["User-Agent"]), 2000),
+        "extract_attacker_info": (extract_attacker_info, 2000),
+        "ioc_scan": (lambda: ioc_engine.scan(fields), 5000),
+        "get_attacker_summary": (quiet(lambda: get_attacker_summary(attacker_info)), 5000),
+        "parse_gemini_answer": (lambda: parse_gemini_answer(GEMINI_ANSWER), 20000),
+        "split_batch_response": (lambda: split_batch_response(batch_answer, 10), 5000),
+        "generate_attacker_json": (lambda: generate_attacker_json(attack_command, 1), 5000)
+    }
+
+def decoy_benchmarks():
+    """{name: (fn, number)} for the decoy routes, the capture queue is replaced by a no-op and the result
+    cache is off so every run measures the query path rather than a cache hit"""
+    from app import app
+    from decoy_cache import DecoyResultCache
+    from decoy_database import get_memory_db
+
+    get_memory_db()
+    client = app.test_client()
+    queued = patch('honeypot_endpoints.queue_attacker_information', lambda attacker_summary: None)
+    queued.start()
+    uncached = patch('honeypot_endpoints.get_decoy_result_cache', return_value=DecoyResultCache(max_entries=0))
+    uncached.start()
+
+    def route(method, path, body):
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):
+                response = client.open(path, method=method, json=body, headers=ATTACK_HEADERS)
+            if response.status_code >= 500:
+                raise RuntimeError(f"{method} {path} answered {response.status_code}")
+        return run
+
+    return {name: (route(method, path, body), 200) for name, method, path, body in DECOY_ROUTES}
+
+def run_benchmarks(only=None, repeat=5, scale=1.0):
+    benchmarks = {}
+    benchmarks.update(capture_benchmarks())
+    benchmarks.update(decoy_benchmarks())
+
+    results = {}
+    for name, (fn, number) in benchmarks.items():
+        if only and not any(part in name for part in only):
+            continue
+        fn()  #warm up caches and lazy singletons before timing
+        results[name] = measure(fn, number=max(1, int(number * scale)), repeat=repeat)
+    return results
+
+def compare(results, baseline, tolerance=0.2):
+    """Benchmarks whose best time grew by more than tolerance against the baseline, {name: ratio}"""
+    regressions = {}
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous and previous["best_us"]:
+            ratio = result["best_us"] / previous["best_us"]
+            if ratio > 1 + tolerance:
+                regressions[name] = round(ratio, 2)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the capture hot paths")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    parser.add_argument("--only", help="comma separated substrings of the benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for the calls per repeat")
+    args = parser.parse_args()
+
+    os.chdir(BACKEND_DIR)
+    started = time.time()
+    results = run_benchmarks(args.only.split(",") if args.only else None, args.repeat, args.scale)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "elapsed_s": round(time.time() - started, 2),
+        "benchmarks": results
+    }
+
+    for name, result in results.items():
+        print(f"{name:<32}{result['best_us']:>12.3f} us{result['ops_per_sec']:>14.1f} ops/s")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["benchmarks"], args.tolerance)
+        for name, ratio in regressions.items():
+            print(f"REGRESSION {name}: {ratio}x the baseline")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+import atexit
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import common_path
+from geolocation import get_geolocation_service
+from ioc_rules import get_ioc_rule_engine
+from gemini_batcher import submit_payload
+from batch_writer import get_attack_batch_writer
+from postgres_db import upgrade_attack_verdict
+from verdict_cache import get_verdict_cache, verdict_key
+from local_classifier import local_verdict
+from flood_suppression import FloodSuppressor
+
+#Background capture pipeline
+#The decoy routes only snapshot the request and hand it to this queue, the worker threads do the
+#slow part (geolocation, gemini classification, postgres + logstash) after the response is sent.
+#Gemini gets GEMINI_DEADLINE_MS to answer, past that the attack is written with a verdict from the IOC
+#rules and upgraded in place when the late answer comes back
+
+class CapturePipeline:
+    def __init__(self, handler, max_size=1000, workers=4):
+        self.handler = handler
+        self.max_size = max_size
+        self.worker_count = workers
+        self._queue = queue.Queue(maxsize=max_size)
+        self._workers = []
+        self._lock = threading.Lock()
+
+        #counters exposed through stats()
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def start(self):
+        with self._lock:
+            if self._workers:
+                return
+
+            for i in range(self.worker_count):
+                worker = threading.Thread(target=self._run, name=f"capture-worker-{i}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def submit(self, event):
+        """Queue an event without blocking, returns False if the queue is full and the event was dropped"""
+        self.start()
+
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            print("Capture queue is full, dropping event")
+            return False
+
+        with self._lock:
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    def drain(self, timeout=None):
+        """Wait until every queued event has been handled, returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self.max_size,
+                "max_depth": self.max_depth,
+                "workers": len(self._workers),
+                "submitted": self.submitted,
+                "processed": self.processed,
+                "failed": self.failed,
+                "dropped": self.dropped
+            }
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            try:
+                self.handler(event)
+                with self._lock:
+                    self.processed += 1
+            except Exception as e:
+                print(f"Capture worker failed to process event: {e}")
+                with self._lock:
+                    self.failed += 1
+            finally:
+                self._queue.task_done()
+
+
+def lookup_geolocation(ip_address):
+    return get_geolocation_service().lookup(ip_address)
+
+def enrich_attacker_info(attacker_info):
+    """Fill in the geolocation for attacker info captured on the request path"""
+    if attacker_info.get("geolocation"):
+        return attacker_info
+
+    try:
+        attacker_info["geolocation"] = lookup_geolocation(attacker_info["ip_address"])
+    except Exception as e:
+        print(f"Geolocation lookup failed: {e}")
+        attacker_info["geolocation"] = {"ip": attacker_info["ip_address"]}
+
+    return attacker_info
+
+class LateVerdictUpgrader:
+    def __init__(self, upgrade, workers=2, attempts=5, retry_interval=1.0):
+        self.upgrade = upgrade
+        self.attempts = attempts
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+
+        #upgrades wait on postgres (and on the batch writer), keep that off the gemini batcher threads
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verdict-upgrade")
+
+        #counters exposed through stats()
+        self.deferred = 0
+        self.upgraded = 0
+        self.unusable = 0
+        self.failed = 0
+
+    def track(self, attacker_summary, future, key=None):
+        """Upgrade the attack written for attacker_summary once the gemini future resolves"""
+        with self._lock:
+            self.deferred += 1
+        future.add_done_callback(lambda done: self._executor.submit(self._apply, attacker_summary, done, key))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "deferred": self.deferred,
+                "upgraded": self.upgraded,
+                "unusable": self.unusable,
+                "failed": self.failed,
+                "pending": self.deferred - self.upgraded - self.unusable - self.failed
+            }
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _apply(self, attacker_summary, future, key):
+        try:
+            verdict = parse_gemini_answer(future.result())
+        except Exception as e:
+            print(f"Late gemini answer failed: {e}")
+            verdict = None
+
+        if verdict is None:
+            #the fallback verdict stays
+            self._count("unusable")
+            return
+
+        #the batch writer picks this up if it hasn't written the attack yet
+        attacker_summary["gemini"] = verdict
+        if key is not None:
+            get_verdict_cache().put(key, verdict)
+
+        for attempt in range(self.attempts):
+            try:
+                if self.upgrade(attacker_summary["capture_id"], verdict):
+                    self._count("upgraded")
+                    return
+            except Exception as e:
+                print(f"Verdict upgrade failed: {e}")
+            time.sleep(self.retry_interval)
+
+        print(f"Gave up upgrading the verdict of capture {attacker_summary['capture_id']}")
+        self._count("failed")
+
+
+def parse_gemini_answer(gemini_analysis):
+    """technique, iocs and description out of the three line gemini answer, None for errors and
+    answers that don't have the three lines"""
+    #filter the empty lines
+    response_string = [row for row in str(gemini_analysis).split("\n") if row.strip()]
+    if len(response_string) < 3 or response_string[0].startswith("Error"):
+        return None
+
+    return {
+        "technique": response_string[0],
+        "iocs": response_string[1],
+        "description": response_string[2]
+    }
+
+def fallback_verdict(attacker_summary, reason):
+    """Deterministic verdict from the IOC rule matches captured on the request path"""
+    verdict = get_ioc_rule_engine().verdict(attacker_summary["attacker_info"].get("ioc_matches") or [])
+    verdict["description"] = f"{reason}, classified by the IOC rules. {verdict['description']}"
+    return verdict
+
+def classify_attacker_summary(attacker_summary):
+    """Classify the captured payload locally when the model is confident, otherwise reuse a cached
+    verdict or send it to gemini, unless the route already supplied a verdict"""
+    if attacker_summary.get("gemini"):
+        return attacker_summary
+
+    verdict = local_verdict(attacker_summary["payload_to_analyze"], attacker_summary["attacker_info"].get("ioc_matches"))
+    if verdict is not None:
+        attacker_summary["gemini"] = verdict
+        return attacker_summary
+
+    verdict_cache = get_verdict_cache()
+    key = verdict_key(attacker_summary["payload_to_analyze"])
+    if key is not None:
+        verdict = verdict_cache.get(key)
+        if verdict is not None:
+            attacker_summary["gemini"] = verdict
+            return attacker_summary
+
+    future = submit_payload(attacker_summary["payload_to_analyze"])
+    try:
+        gemini_analysis = future.result(timeout=int(os.environ.get('GEMINI_DEADLINE_MS', 8000)) / 1000)
+    except FutureTimeoutError:
+        #write the attack now with the IOC rules verdict, the late answer upgrades it by capture_id
+        attacker_summary["capture_id"] = uuid.uuid4().hex
+        attacker_summary["gemini"] = fallback_verdict(attacker_summary, "Gemini missed the deadline")
+        get_late_verdict_upgrader().track(attacker_summary, future, key)
+        return attacker_summary
+    except Exception as e:
+        gemini_analysis = f"Error: {e}"
+
+    print(gemini_analysis)
+
+    verdict = parse_gemini_answer(gemini_analysis)
+    if verdict is None:
+        #errors and malformed answers aren't cached, the next capture of this payload asks gemini again
+        attacker_summary["gemini"] = fallback_verdict(attacker_summary, "Gemini gave no usable answer")
+        return attacker_summary
+
+    attacker_summary["gemini"] = verdict
+    if key is not None:
+        verdict_cache.put(key, verdict)
+
+    return attacker_summary
+
+def process_attacker_summary(attacker_summary):
+    """Worker stage: enrichment, classification then hand off to the batched postgres writer"""
+    enrich_attacker_info(attacker_summary["attacker_info"])
+    classify_attacker_summary(attacker_summary)
+    get_attack_batch_writer().submit(attacker_summary)
+
+
+_capture_pipeline = None
+_capture_pipeline_lock = threading.Lock()
+
+def get_capture_pipeline():
+    global _capture_pipeline
+
+    with _capture_pipeline_lock:
+        if _capture_pipeline is None:
+            _capture_pipeline = CapturePipeline(
+                process_attacker_summary,
+                max_size=int(os.environ.get('CAPTURE_QUEUE_SIZE', 1000)),
+                #workers mostly wait on the gemini batcher, more of them means fuller batches
+                workers=int(os.environ.get('CAPTURE_WORKERS', 16))
+            )
+
+    return _capture_pipeline
+
+_late_verdict_upgrader = None
+_late_verdict_upgrader_lock = threading.Lock()
+
+def get_late_verdict_upgrader():
+    global _late_verdict_upgrader
+
+    with _late_verdict_upgrader_lock:
+        if _late_verdict_upgrader is None:
+            _late_verdict_upgrader = LateVerdictUpgrader(upgrade_attack_verdict)
+
+    return _late_verdict_upgrader
+
+_flood_suppressor = None
+_flood_suppressor_lock = threading.Lock()
+
+def get_flood_suppressor():
+    global _flood_suppressor
+
+    with _flood_suppressor_lock:
+        if _flood_suppressor is None:
+            #summaries go through the workers too, enrichment and classification are skipped when the
+            #template capture already has them
+            _flood_suppressor = FloodSuppressor(
+                lambda summary: get_capture_pipeline().submit(summary),
+                full_events=int(os.environ.get('FLOOD_FULL_EVENTS', 5)),
+                window=int(os.environ.get('FLOOD_WINDOW', 60)),
+                max_groups=int(os.environ.get('FLOOD_MAX_GROUPS', 50000))
+            )
+            #registered after the batch writer so the summaries are written before the writer closes
+            get_attack_batch_writer()
+            atexit.register(close_flood_suppressor)
+
+    return _flood_suppressor
+
+def close_flood_suppressor():
+    """Write out the repeats counted so far, on shutdown"""
+    _flood_suppressor.close()
+    get_capture_pipeline().drain(timeout=5)
+
+def queue_attacker_information(attacker_summary):
+    """Hand the attacker summary to the capture workers, never blocks the decoy response. Repeats of a
+    flooded payload are only counted, see flood_suppression.py"""
+    if not get_flood_suppressor().admit(attacker_summary):
+        return True
+    return get_capture_pipeline().submit(attacker_summary)
@@ -0,0 +1,8 @@
+import os
+import sys
+
+#Make the modules shared between backend-flask and flask-honeypot importable
+COMMON_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'honeypot-common'))
+
+if COMMON_DIR not in sys.path:
+    sys.path.append(COMMON_DIR)
@@ -0,0 +1,200 @@
+import threading
+import time
+from contextlib import contextmanager
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+#Thread safe postgres connection pool
+#Connections are borrowed for the length of a `with` block and handed back afterwards, idle connections
+#are health checked by a background thread instead of running SELECT 1 before every use
+
+class PoolTimeout(Exception):
+    pass
+
+class PostgresPool:
+    def __init__(self, connect, min_size=1, max_size=10, acquire_timeout=5, health_check_interval=30):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle = []
+        self._size = 0
+        self._condition = threading.Condition()
+        self._health_thread = None
+        self._closed = False
+
+        #counters exposed through stats()
+        self.borrows = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.replaced = 0
+
+    def start(self):
+        """Open the minimum number of connections and start the background health checks"""
+        self._fill_to_min()
+
+        if self.health_check_interval and self._health_thread is None:
+            self._health_thread = threading.Thread(target=self._health_loop, name="postgres-pool-health", daemon=True)
+            self._health_thread.start()
+
+    def borrow(self):
+        start = time.monotonic()
+        deadline = start + self.acquire_timeout
+        waited = False
+
+        with self._condition:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+
+                if self._size < self.max_size:
+                    #reserve the slot, the connection itself is opened outside the lock
+                    self._size += 1
+                    conn = None
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(f"Timed out after {self.acquire_timeout}s waiting for a database connection")
+
+                waited = True
+                self._condition.wait(remaining)
+
+            wait_time = time.monotonic() - start
+            self.borrows += 1
+            self.total_wait += wait_time
+            self.max_wait = max(self.max_wait, wait_time)
+            if waited:
+                self.waits += 1
+
+        if conn is None:
+            try:
+                conn = self.connect()
+            except Exception:
+                self._release_slot()
+                raise
+
+        return conn
+
+    def give_back(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                #don't leak an open transaction to the next borrower
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        else:
+            discard = True
+
+        if discard or self._closed:
+            self._close_quietly(conn)
+            self._release_slot()
+            return
+
+        with self._condition:
+            self._idle.append(conn)
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the block, it is rolled back and returned to the pool afterwards"""
+        conn = self.borrow()
+        try:
+            yield conn
+        except Exception:
+            #a broken connection shows up as closed, don't hand it to anyone else
+            self.give_back(conn, discard=bool(conn.closed))
+            raise
+        else:
+            self.give_back(conn)
+
+    def check_idle(self):
+        """Ping every idle connection, replace the dead ones and top the pool back up to min_size"""
+        with self._condition:
+            idle, self._idle = self._idle, []
+
+        alive = []
+        for conn in idle:
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                cur.close()
+                conn.rollback()
+                alive.append(conn)
+            except Exception:
+                self._close_quietly(conn)
+                self._release_slot()
+                self.replaced += 1
+
+        with self._condition:
+            self._idle.extend(alive)
+            self._condition.notify_all()
+
+        self._fill_to_min()
+
+    def close(self):
+        self._closed = True
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "borrows": self.borrows,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "replaced": self.replaced,
+                "avg_wait_ms": round(self.total_wait / self.borrows * 1000, 3) if self.borrows else 0,
+                "max_wait_ms": round(self.max_wait * 1000, 3)
+            }
+
+    def _fill_to_min(self):
+        while True:
+            with self._condition:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+
+            try:
+                conn = self.connect()
+            except Exception as e:
+                print(f"Database connection error: {e}")
+                self._release_slot()
+                return
+
+            with self._condition:
+                self._idle.append(conn)
+                self._condition.notify()
+
+    def _release_slot(self):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _health_loop(self):
+        while not self._closed:
+            time.sleep(self.health_check_interval)
+            try:
+                self.check_idle()
+            except Exception as e:
+                print(f"Database pool health check failed: {e}")
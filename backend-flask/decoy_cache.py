@@ -0,0 +1,128 @@
+import re
+import threading
+from collections import OrderedDict
+
+#Result cache for the read only decoy routes
+#Scanners repeat the same GET with the same query string, each one rebuilt the SQL, ran it and
+#converted every row before jsonify. The cache keeps the serialized JSON body per route, normalized
+#args and decoy database (scope, None for the shared one, a per sandbox value otherwise) in LRU order,
+#capped by count and total size. Entries are indexed by the identifiers in their SQL, a write to a
+#table drops every entry of the same scope whose query names it, including tables an injected
+#UNION pulled in. Each write also stamps (scope, table) with the next value of a clock, a read takes
+#the clock before its query and put() skips the body when a table it read was written since, so a
+#read that raced a write never caches what it saw before the write
+
+IDENTIFIER = re.compile(r"[a-z_][a-z0-9_]*")
+
+def result_key(route, args, scope=None):
+    """Cache key of a read, args in sorted order so ?a=1&b=2 and ?b=2&a=1 share one entry"""
+    return (route, tuple(sorted(args.items(multi=True))), scope)
+
+def query_tables(query):
+    """Lower case identifiers of query, a superset of the tables it reads"""
+    return frozenset(IDENTIFIER.findall(query.lower()))
+
+class DecoyResultCache:
+    def __init__(self, max_entries=1000, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        #key -> (body, tables)
+        self._entries = OrderedDict()
+        #(scope, table) -> keys of the entries whose query names the table
+        self._by_table = {}
+        self._bytes = 0
+        #(scope, table) -> clock value of the last write, forgotten past max_generations with _floor
+        #taking the place of every forgotten one
+        self._generations = {}
+        self._clock = 0
+        self._floor = 0
+        self.max_generations = 10000
+        self._lock = threading.Lock()
+
+        #counters exposed through stats()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.invalidated = 0
+        self.stale = 0
+
+    def get(self, key):
+        """Cached JSON body for key, None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def clock(self):
+        """Take before running a read, put() needs it to tell whether a write happened meanwhile"""
+        with self._lock:
+            return self._clock
+
+    def put(self, key, body, query, started):
+        if self.max_entries <= 0 or len(body) > self.max_bytes:
+            return
+
+        tables = query_tables(query)
+        with self._lock:
+            if any(self._generations.get((key[2], table), self._floor) > started for table in tables):
+                self.stale += 1
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (body, tables)
+            self._bytes += len(body)
+            for table in tables:
+                self._by_table.setdefault((key[2], table), set()).add(key)
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evicted += 1
+
+    def invalidate(self, tables, scope=None):
+        """Drop the entries of scope that read any of tables, call after a write to them"""
+        with self._lock:
+            self._clock += 1
+            for table in tables:
+                self._generations[(scope, table.lower())] = self._clock
+                for key in self._by_table.pop((scope, table.lower()), ()):
+                    if key in self._entries:
+                        self._drop(key)
+                        self.invalidated += 1
+
+            if len(self._generations) > self.max_generations:
+                self._generations.clear()
+                self._floor = self._clock
+
+    def _drop(self, key):
+        body, tables = self._entries.pop(key)
+        self._bytes -= len(body)
+        for table in tables:
+            keys = self._by_table.get((key[2], table))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[(key[2], table)]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_table.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evicted": self.evicted,
+                "invalidated": self.invalidated,
+                "stale": self.stale
+            }
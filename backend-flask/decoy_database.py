@@ -1,28 +1,243 @@
+import itertools
+import os
 import sqlite3
-from flask import Flask
+import threading
+import time
+from flask import g, has_request_context, request
+import common_path
+from metrics import DECOY_LOCK_WAIT_SECONDS, DECOY_QUERY_SECONDS, sql_statement_type
+from decoy_snapshot import load_snapshot, run_source_scripts, snapshot_path_from_environment
+from decoy_sandbox import DecoySandboxes, sandbox_key, sandboxes_enabled
+from decoy_cache import DecoyResultCache
 
-app = Flask(__name__)
+DECOY_URI = "file::memory:?cache=shared"
 
-_app_db_conn = None
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection that records every query in honeypot_decoy_query_seconds by statement type.
+    Statements that hit a shared cache table lock are retried for up to lock_timeout seconds (sqlite
+    returns those at once rather than honouring a busy timeout) and the wait is recorded"""
+    manager = None
+    lock_timeout = 5.0
+    #result cache scope, None for the shared database and a serial per sandbox
+    cache_scope = None
+
+    def execute(self, sql, parameters=()):
+        with DECOY_QUERY_SECONDS.time(statement=sql_statement_type(sql)):
+            return self._wait_for_locks(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with DECOY_QUERY_SECONDS.time(statement=sql_statement_type(sql)):
+            return self._wait_for_locks(super().executemany, sql, seq_of_parameters)
+
+    def _wait_for_locks(self, run, sql, parameters):
+        started = None
+        delay = 0.001
+        while True:
+            try:
+                result = run(sql, parameters)
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e):
+                    raise
+                now = time.perf_counter()
+                started = started or now
+                if now - started >= self.lock_timeout:
+                    self._record_lock_wait(now - started, timed_out=True)
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+                continue
+
+            if started is not None:
+                self._record_lock_wait(time.perf_counter() - started)
+            return result
+
+    def _record_lock_wait(self, waited, timed_out=False):
+        DECOY_LOCK_WAIT_SECONDS.observe(waited)
+        if self.manager is not None:
+            self.manager.record_lock_wait(waited, timed_out)
+
+
+class DecoyConnections:
+    """Connections to the shared cache in-memory decoy database, so request threads don't serialize on
+    one connection or share its cursor state. Requests check a connection out of a small pool (acquire)
+    and return it at teardown (release), the dev server starts a thread per request so per thread
+    connections would never be reused. Long lived threads use connection(), their own for as long as
+    they run. Connections run in autocommit with read_uncommitted, reads then don't wait on table locks
+    held by writers (an in-memory database has no WAL). A keeper connection loads the data and stays
+    open, the database lives as long as it does"""
+    def __init__(self, uri=DECOY_URI, lock_timeout=5.0, max_idle=8):
+        self.uri = uri
+        self.lock_timeout = lock_timeout
+        self.max_idle = max_idle
+        self._local = threading.local()
+        self._idle = []
+        self._lock = threading.Lock()
+        self._keeper = None
+
+        #counters exposed through stats()
+        self.opened = 0
+        self.reused = 0
+        self.in_use = 0
+        self.lock_waits = 0
+        self.lock_timeouts = 0
+        self.lock_wait_seconds = 0.0
+        self.max_lock_wait = 0.0
+
+    def _open(self):
+        connection = sqlite3.connect(self.uri, uri=True, check_same_thread=False, isolation_level=None, factory=TimedConnection)
+        connection.row_factory = sqlite3.Row
+        connection.manager = self
+        connection.lock_timeout = self.lock_timeout
+        connection.execute("PRAGMA read_uncommitted = 1")
+        return connection
+
+    def keeper(self):
+        with self._lock:
+            if self._keeper is None:
+                self._keeper = self._open()
+                # Initialize the schema here to ensure it's done before any queries
+                load_decoy_db(self._keeper)
+            return self._keeper
+
+    def connection(self):
+        """The calling thread's connection, opened on first use"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self.keeper()
+            connection = self._local.connection = self._open()
+            with self._lock:
+                self.opened += 1
+        return connection
+
+    def acquire(self):
+        """A pooled connection for one request, hand it back with release()"""
+        self.keeper()
+        with self._lock:
+            self.in_use += 1
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop()
+            self.opened += 1
+        return self._open()
+
+    def release(self, connection):
+        if connection.in_transaction:
+            #a failed request can leave a transaction behind, the next one mustn't inherit its locks
+            connection.rollback()
+        with self._lock:
+            self.in_use -= 1
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def record_lock_wait(self, waited, timed_out=False):
+        with self._lock:
+            self.lock_waits += 1
+            self.lock_timeouts += timed_out
+            self.lock_wait_seconds += waited
+            self.max_lock_wait = max(self.max_lock_wait, waited)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "opened": self.opened,
+                "reused": self.reused,
+                "in_use": self.in_use,
+                "idle": len(self._idle),
+                "max_idle": self.max_idle,
+                "lock_waits": self.lock_waits,
+                "lock_timeouts": self.lock_timeouts,
+                "lock_wait_ms_total": round(self.lock_wait_seconds * 1000, 1),
+                "lock_wait_ms_max": round(self.max_lock_wait * 1000, 1),
+                "lock_timeout_s": self.lock_timeout
+            }
+
+
+_decoy_connections = None
+_decoy_connections_lock = threading.Lock()
+
+def get_decoy_connections():
+    global _decoy_connections
+
+    with _decoy_connections_lock:
+        if _decoy_connections is None:
+            _decoy_connections = DecoyConnections(
+                lock_timeout=float(os.environ.get('DECOY_LOCK_TIMEOUT', 5)),
+                max_idle=int(os.environ.get('DECOY_POOL_SIZE', 8))
+            )
+
+    return _decoy_connections
+
+_decoy_sandboxes = None
+_decoy_sandboxes_lock = threading.Lock()
+_sandbox_serial = itertools.count(1)
+
+def _connect_sandbox():
+    connection = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None, factory=TimedConnection)
+    connection.row_factory = sqlite3.Row
+    #never reused, a sandbox cloned again after eviction doesn't see the old one's cached results
+    connection.cache_scope = next(_sandbox_serial)
+    return connection
+
+def get_decoy_sandboxes():
+    global _decoy_sandboxes
+
+    with _decoy_sandboxes_lock:
+        if _decoy_sandboxes is None:
+            _decoy_sandboxes = DecoySandboxes(
+                _connect_sandbox,
+                max_sandboxes=int(os.environ.get('DECOY_SANDBOX_MAX', 200)),
+                max_bytes=int(os.environ.get('DECOY_SANDBOX_MAX_MB', 256)) * 1024 * 1024,
+                idle_ttl=int(os.environ.get('DECOY_SANDBOX_IDLE', 1800))
+            )
+
+    return _decoy_sandboxes
+
+_decoy_result_cache = None
+_decoy_result_cache_lock = threading.Lock()
+
+def get_decoy_result_cache():
+    global _decoy_result_cache
+
+    with _decoy_result_cache_lock:
+        if _decoy_result_cache is None:
+            _decoy_result_cache = DecoyResultCache(
+                max_entries=int(os.environ.get('DECOY_CACHE_MAX', 1000)),
+                max_bytes=int(os.environ.get('DECOY_CACHE_MAX_MB', 32)) * 1024 * 1024
+            )
+
+    return _decoy_result_cache
 
 #In memory database connection
-def get_memory_db():
-    global _app_db_conn
-    
-    # Create the connection if it doesn't exist
-    if _app_db_conn is None:
-        
-        _app_db_conn = sqlite3.connect(
-            "file::memory:?cache=shared",
-            uri=True,
-            check_same_thread=False
-        )
-        _app_db_conn.row_factory = sqlite3.Row
-        
-        # Initialize the schema here to ensure it's done before any queries
-        init_decoy_db(_app_db_conn)
-    
-    return _app_db_conn
+def get_memory_db(for_write=False):
+    """The decoy database for the current request, a pooled connection it keeps until
+    release_memory_db at teardown (outside a request the calling thread's own connection). With
+    DECOY_SANDBOXES=true an attacker's first write (for_write) gives them a private copy
+    (decoy_sandbox.py) that their later requests use, leased until teardown as well"""
+    if not has_request_context():
+        return get_decoy_connections().connection()
+
+    base = g.get('_decoy_connection')
+    if base is None:
+        base = g._decoy_connection = get_decoy_connections().acquire()
+    if not sandboxes_enabled():
+        return base
+
+    connection = get_decoy_sandboxes().connection(sandbox_key(request), base, for_write)
+    if connection is None:
+        return base
+    g.setdefault('_decoy_sandbox_leases', []).append(connection)
+    return connection
+
+def release_memory_db(exc=None):
+    """Teardown hook, returns the request's pooled connection and the sandboxes it leased"""
+    for connection in g.pop('_decoy_sandbox_leases', ()):
+        get_decoy_sandboxes().release(connection)
+
+    base = g.pop('_decoy_connection', None)
+    if base is not None:
+        get_decoy_connections().release(base)
 
 def query_memory_db(query, args=(), one=False):
     cur = get_memory_db().execute(query, args)
@@ -33,23 +248,8 @@ def query_memory_db(query, args=(), one=False):
     return (rv[0] if rv else None) if one else rv
 
 def init_decoy_db(connection):
-    db = connection
-    with app.open_resource('inmemory_schema.sql', mode='r') as f:
-        db.cursor().executescript(f.read())
-    db.commit()
-
-    gen_data_path = "../generate-database-data/populate_decoy_memory_db2.sql"
-
-    with app.open_resource(gen_data_path, mode='r') as f:
-        db.cursor().executescript(f.read())
-    db.commit()
-
-    #Forum data
-    forum_data_path = "../generate-database-data/modified_forum.sql"
-
-    with app.open_resource(forum_data_path, mode='r') as f:
-        db.cursor().executescript(f.read())
-    db.commit()
+    """Run the schema and data scripts straight into connection, the slow path the snapshot replaces"""
+    run_source_scripts(connection)
 
     # print("Prove it works")
     # user = query_memory_db('select * from users where username = ?',
@@ -58,3 +258,15 @@ def init_decoy_db(connection):
     #     print('No such user')
     # else:
     #     print('jwoodard has the id', user['id'])
+
+def load_decoy_db(connection):
+    """Fill the decoy database from the prebuilt snapshot, falling back to the SQL scripts"""
+    path = snapshot_path_from_environment()
+    if path:
+        try:
+            load_snapshot(connection, path)
+            return
+        except (sqlite3.Error, OSError) as e:
+            print(f"Decoy snapshot {path} unusable, running the SQL scripts instead: {e}")
+
+    init_decoy_db(connection)
@@ -0,0 +1,159 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+#Copy-on-write decoy databases per attacker
+#With DECOY_SANDBOXES=true the decoy routes stop writing to the shared in-memory database. An attacker
+#reads the shared (base) database until their first write, which clones the base into a private
+#in-memory database that serves all of their later reads and writes. Nothing one attacker changes is
+#seen by anyone else, and writers no longer queue on the one shared connection. Sandboxes are kept in
+#LRU order, capped by count and by total size, and dropped once they have been idle for idle_ttl.
+#connection() leases the sandbox to the caller until release(), a sandbox dropped while a request
+#still uses it is closed by the last release instead of under the running query
+
+class DecoySandboxes:
+    def __init__(self, connect, max_sandboxes=200, max_bytes=256 * 1024 * 1024, idle_ttl=1800):
+        #connect() opens an empty in-memory connection configured like the base one
+        self.connect = connect
+        self.max_sandboxes = max_sandboxes
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        #key -> {"connection", "bytes", "last_used", "refs", "dropped"}
+        self._sandboxes = OrderedDict()
+        #connection -> sandbox of every leased connection, dropped ones included
+        self._leased = {}
+        self._lock = threading.Lock()
+
+        #counters exposed through stats()
+        self.created = 0
+        self.evicted = 0
+        self.expired = 0
+        self.hits = 0
+
+    def connection(self, key, base, for_write=False):
+        """The attacker's sandbox, cloned from base when for_write and they don't have one yet.
+        None when they have no sandbox and only read, the caller then uses base. A returned
+        connection is leased, hand it back with release() once the request is done with it"""
+        now = time.monotonic()
+        with self._lock:
+            sandbox = self._sandboxes.get(key)
+            if sandbox is not None:
+                self._sandboxes.move_to_end(key)
+                sandbox["last_used"] = now
+                self.hits += 1
+                self._lease(sandbox)
+            elif not for_write:
+                return None
+
+        if sandbox is not None:
+            if for_write:
+                #sized outside the lock, the lease keeps the connection open meanwhile
+                size = self._size(sandbox["connection"])
+                with self._lock:
+                    sandbox["bytes"] = size
+            return sandbox["connection"]
+
+        #clone outside the lock, the backup copies every page of the base database
+        connection = self.connect()
+        base.backup(connection)
+        size = self._size(connection)
+
+        with self._lock:
+            current = self._sandboxes.get(key)
+            if current is None:
+                current = self._sandboxes[key] = {"connection": connection, "bytes": size, "last_used": now,
+                                                  "refs": 0, "dropped": False}
+                self.created += 1
+                self._evict(now, keep=key)
+                connection = None
+            #else another request of the same attacker cloned first, use theirs
+            self._lease(current)
+
+        if connection is not None:
+            connection.close()
+        return current["connection"]
+
+    def release(self, connection):
+        """End a lease taken by connection(), closes the connection when its sandbox was dropped meanwhile"""
+        with self._lock:
+            sandbox = self._leased.get(connection)
+            if sandbox is None:
+                return
+            sandbox["refs"] -= 1
+            if sandbox["refs"]:
+                return
+            del self._leased[connection]
+            if not sandbox["dropped"]:
+                return
+        connection.close()
+
+    def _lease(self, sandbox):
+        sandbox["refs"] += 1
+        self._leased[sandbox["connection"]] = sandbox
+
+    @staticmethod
+    def _size(connection):
+        page_count = connection.execute("PRAGMA page_count").fetchone()[0]
+        page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    def _evict(self, now, keep):
+        #idle sandboxes are all at the front
+        for key, sandbox in list(self._sandboxes.items()):
+            if key == keep or now - sandbox["last_used"] < self.idle_ttl:
+                break
+            self._drop(key)
+            self.expired += 1
+
+        while len(self._sandboxes) > 1 and (
+            len(self._sandboxes) > self.max_sandboxes
+            or sum(sandbox["bytes"] for sandbox in self._sandboxes.values()) > self.max_bytes
+        ):
+            key = next(iter(self._sandboxes))
+            if key == keep:
+                break
+            self._drop(key)
+            self.evicted += 1
+
+    def _drop(self, key):
+        sandbox = self._sandboxes.pop(key)
+        if sandbox["refs"]:
+            #still in use by a request, its last release() closes it
+            sandbox["dropped"] = True
+        else:
+            sandbox["connection"].close()
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._sandboxes):
+                self._drop(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sandboxes": len(self._sandboxes),
+                "leased": len(self._leased),
+                "max_sandboxes": self.max_sandboxes,
+                "bytes": sum(sandbox["bytes"] for sandbox in self._sandboxes.values()),
+                "max_bytes": self.max_bytes,
+                "idle_ttl": self.idle_ttl,
+                "created": self.created,
+                "hits": self.hits,
+                "evicted": self.evicted,
+                "expired": self.expired
+            }
+
+
+def sandbox_key(request):
+    """Sandbox owner of a request, the attacker's address and user agent. Close to the device fingerprint
+    but taken from the request directly, some routes write before they call extract_attacker_info"""
+    ip_address = request.remote_addr
+    if request.headers.get('X-Forwarded-For'):
+        ip_address = request.headers.get('X-Forwarded-For').split(',')[0].strip()
+    return hashlib.sha256(f"{ip_address}\n{request.headers.get('User-Agent', '')}".encode()).hexdigest()
+
+def sandboxes_enabled():
+    return os.environ.get('DECOY_SANDBOXES', 'false').lower() == 'true'
+
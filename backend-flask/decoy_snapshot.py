@@ -0,0 +1,122 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+#Prebuilt decoy database image
+#Every worker used to parse the decoy SQL scripts with executescript at startup, a cost that grows with
+#the synthetic dataset. build_snapshot runs them once into a SQLite file and load_snapshot copies that
+#file into the shared in-memory database with the backup API, which only copies pages. The sha256 of the
+#source scripts is kept next to the image (<image>.sha256, outside the database so an attacker dumping
+#sqlite_master doesn't see it) and a snapshot whose checksum doesn't match the scripts is rebuilt
+#
+#Usage:
+#   python decoy_snapshot.py build
+#   python decoy_snapshot.py status
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SNAPSHOT_PATH = os.path.join(BASE_DIR, 'decoy_snapshot.sqlite')
+
+#run in this order, relative to backend-flask
+SOURCE_SCRIPTS = [
+    'inmemory_schema.sql',
+    '../generate-database-data/populate_decoy_memory_db2.sql',
+    '../generate-database-data/modified_forum.sql'
+]
+
+def source_checksum():
+    digest = hashlib.sha256()
+    for script in SOURCE_SCRIPTS:
+        with open(os.path.join(BASE_DIR, script), 'rb') as f:
+            digest.update(script.encode() + b"\0" + f.read() + b"\0")
+    return digest.hexdigest()
+
+def run_source_scripts(connection):
+    for script in SOURCE_SCRIPTS:
+        with open(os.path.join(BASE_DIR, script), encoding='utf-8') as f:
+            connection.cursor().executescript(f.read())
+        connection.commit()
+
+def _checksum_path(path):
+    return path + '.sha256'
+
+def snapshot_checksum(path=DEFAULT_SNAPSHOT_PATH):
+    """Checksum the image at path was built from, None when there is no usable image"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(_checksum_path(path)) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def is_stale(path=DEFAULT_SNAPSHOT_PATH):
+    return snapshot_checksum(path) != source_checksum()
+
+def build_snapshot(path=DEFAULT_SNAPSHOT_PATH):
+    """Run the source scripts into a fresh image at path, returns the checksum it was built from.
+    Written to a temp file and renamed, so workers starting at the same time never load a partial image"""
+    checksum = source_checksum()
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    connection = sqlite3.connect(temp_path)
+    try:
+        run_source_scripts(connection)
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+
+    os.replace(temp_path, path)
+    temp_checksum = f"{_checksum_path(path)}.{os.getpid()}.tmp"
+    with open(temp_checksum, 'w') as f:
+        f.write(checksum)
+    os.replace(temp_checksum, _checksum_path(path))
+    return checksum
+
+def ensure_snapshot(path=DEFAULT_SNAPSHOT_PATH):
+    """Build the image when it is missing or older than the scripts, returns True when it was rebuilt"""
+    if not is_stale(path):
+        return False
+    print(f"Decoy snapshot {path} is missing or stale, rebuilding it")
+    build_snapshot(path)
+    return True
+
+def load_snapshot(connection, path=DEFAULT_SNAPSHOT_PATH):
+    """Copy the image into connection (the shared in-memory decoy database), rebuilding it first if stale"""
+    ensure_snapshot(path)
+    source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        source.backup(connection)
+    finally:
+        source.close()
+
+def snapshot_path_from_environment():
+    """DECOY_SNAPSHOT overrides the image path, an empty value turns the snapshot off"""
+    path = os.environ.get('DECOY_SNAPSHOT', DEFAULT_SNAPSHOT_PATH)
+    return os.path.join(BASE_DIR, path) if path else None
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or inspect the prebuilt decoy database image")
+    parser.add_argument("command", choices=["build", "status"])
+    parser.add_argument("--path", default=snapshot_path_from_environment() or DEFAULT_SNAPSHOT_PATH)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        started = time.perf_counter()
+        build_snapshot(args.path)
+        print(f"Built {args.path} in {time.perf_counter() - started:.2f}s")
+
+    print(json.dumps({
+        "path": args.path,
+        "bytes": os.path.getsize(args.path) if os.path.exists(args.path) else None,
+        "checksum": snapshot_checksum(args.path),
+        "source_checksum": source_checksum(),
+        "stale": is_stale(args.path)
+    }, indent=4))
+
+if __name__ == "__main__":
+    main()
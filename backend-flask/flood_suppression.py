@@ -0,0 +1,143 @@
+import threading
+import time
+from datetime import datetime
+from verdict_cache import verdict_key
+
+#Flood suppression for repetitive scanner traffic
+#Captures are grouped by (ip, fingerprint, path, payload hash). Inside a window the first full_events of
+#a group go through the capture pipeline as usual, the repeats only bump a counter. When the window
+#closes the repeats are written as one summarized attack row carrying count, first_ts and last_ts, with
+#the verdict of the last fully processed capture, so a nikto run costs a handful of rows and gemini calls
+
+class FloodSuppressor:
+    def __init__(self, emit, full_events=5, window=60, max_groups=50000):
+        self.emit = emit
+        self.full_events = full_events
+        self.window = window
+        self.max_groups = max_groups
+        self._groups = {}
+        self._closed = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+        #counters exposed through stats()
+        self.admitted = 0
+        self.suppressed = 0
+        self.untracked = 0
+        self.summaries = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="flood-suppressor", daemon=True)
+                self._thread.start()
+
+    @staticmethod
+    def group_key(attacker_summary):
+        attacker_info = attacker_summary["attacker_info"]
+        return (
+            attacker_info.get("ip_address"),
+            attacker_info.get("device_fingerprint"),
+            attacker_summary["request_details"]["path"],
+            verdict_key(attacker_summary.get("payload_to_analyze") or {})
+        )
+
+    def admit(self, attacker_summary):
+        """True when the capture should be processed in full, False when it was counted as a repeat"""
+        self.start()
+
+        key = self.group_key(attacker_summary)
+        now = time.monotonic()
+
+        with self._lock:
+            group = self._groups.get(key)
+            if group is not None and now - group["window_start"] >= self.window:
+                self._close(key, group)
+                group = None
+
+            if group is None:
+                if len(self._groups) >= self.max_groups:
+                    #too many distinct groups to track, let the capture through untouched
+                    self.untracked += 1
+                    self.admitted += 1
+                    return True
+
+                self._groups[key] = {
+                    "window_start": now,
+                    "full": 1,
+                    "repeats": 0,
+                    "first_ts": None,
+                    "last_ts": None,
+                    "template": attacker_summary
+                }
+                self.admitted += 1
+                return True
+
+            if group["full"] < self.full_events:
+                group["full"] += 1
+                group["template"] = attacker_summary
+                self.admitted += 1
+                return True
+
+            timestamp = datetime.now()
+            group["repeats"] += 1
+            group["first_ts"] = group["first_ts"] or timestamp
+            group["last_ts"] = timestamp
+            self.suppressed += 1
+            return False
+
+    def _close(self, key, group):
+        del self._groups[key]
+        if group["repeats"]:
+            self._closed.append(group)
+
+    def flush(self, force=False):
+        """Emit a summary for every window that has closed (every window with force), returns how many"""
+        now = time.monotonic()
+        with self._lock:
+            for key, group in list(self._groups.items()):
+                if force or now - group["window_start"] >= self.window:
+                    self._close(key, group)
+            closed, self._closed = self._closed, []
+
+        for group in closed:
+            template = group["template"]
+            self.emit({
+                "attacker_info": template["attacker_info"],
+                "gemini": template["gemini"],
+                "payload_to_analyze": template.get("payload_to_analyze") or {},
+                "request_details": template["request_details"],
+                "count": group["repeats"],
+                "first_ts": group["first_ts"],
+                "last_ts": group["last_ts"]
+            })
+
+        with self._lock:
+            self.summaries += len(closed)
+        return len(closed)
+
+    def close(self):
+        self._stopped.set()
+        self.flush(force=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "groups": len(self._groups),
+                "max_groups": self.max_groups,
+                "admitted": self.admitted,
+                "suppressed": self.suppressed,
+                "untracked": self.untracked,
+                "summaries": self.summaries,
+                "full_events": self.full_events,
+                "window": self.window
+            }
+
+    def _run(self):
+        #check a few times per window so summaries are written soon after their window closes
+        while not self._stopped.wait(max(self.window / 4, 0.05)):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Flood summary flush failed: {e}")
@@ -0,0 +1,166 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from gemini import analyze_payload_2, analyze_payload_batch
+
+#Micro-batched gemini classification
+#Capture workers hand their payloads to this stage and wait on a future, pending payloads are collected
+#for up to max_wait_ms or max_batch and sent as one numbered prompt. Answers that can't be parsed out of
+#the batch response fall back to a single analyze_payload_2 call for just that payload. At most
+#max_pending payloads wait for an answer (queued or in flight), past that submit answers with an error
+#straight away so the caller falls back to its IOC verdict instead of the backlog growing without bound
+
+class GeminiBatcher:
+    def __init__(self, analyze_batch, analyze_single, max_batch=10, max_wait_ms=200, max_in_flight=4, max_pending=1000):
+        self.analyze_batch = analyze_batch
+        self.analyze_single = analyze_single
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.max_pending = max_pending
+        self._pending = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        #batches are sent from a small pool so the next batch can be collected while one is in flight
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="gemini-batch")
+
+        #counters exposed through stats()
+        self.batches = 0
+        self.items = 0
+        self.gemini_calls = 0
+        self.fallbacks = 0
+        self.failed = 0
+        self.max_batch_seen = 0
+        self.rejected = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="gemini-batcher", daemon=True)
+                self._thread.start()
+
+    def submit(self, payload):
+        """Queue a payload for the next batch, the future resolves to the three line gemini answer"""
+        self.start()
+        future = Future()
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                future.set_result(f"Error: gemini backlog full ({self.max_pending} payloads pending)")
+                return future
+            self._pending += 1
+        future.add_done_callback(self._done)
+        self._queue.put((payload, future))
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def classify(self, payload, timeout=None):
+        return self.submit(payload).result(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "queued": self._queue.qsize(),
+                "rejected": self.rejected,
+                "max_pending": self.max_pending,
+                "batches": self.batches,
+                "items": self.items,
+                "gemini_calls": self.gemini_calls,
+                "fallbacks": self.fallbacks,
+                "failed": self.failed,
+                "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0,
+                "max_batch_size": self.max_batch_seen,
+                "max_batch": self.max_batch,
+                "max_wait_ms": int(self.max_wait * 1000)
+            }
+
+    def _collect(self):
+        """Block for the first payload then gather more until the batch is full or the window closes"""
+        batch = [self._queue.get()]
+
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _dispatch(self, batch):
+        payloads = [payload for payload, _ in batch]
+
+        with self._lock:
+            self.batches += 1
+            self.items += len(batch)
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+
+        if len(batch) == 1:
+            answers = [None]
+        else:
+            try:
+                with self._lock:
+                    self.gemini_calls += 1
+                answers = self.analyze_batch(payloads)
+            except Exception as e:
+                #the whole call failed, answer like analyze_payload_2 does instead of retrying every item
+                print(f"Gemini batch of {len(batch)} failed: {e}")
+                with self._lock:
+                    self.failed += len(batch)
+                for _, future in batch:
+                    future.set_result(f"Error: {e}")
+                return
+
+        #anything missing from the batch answer is retried on its own
+        answers = list(answers)[:len(batch)]
+        answers += [None] * (len(batch) - len(answers))
+
+        for (payload, future), answer in zip(batch, answers):
+            if answer is None:
+                with self._lock:
+                    self.gemini_calls += 1
+                    if len(batch) > 1:
+                        self.fallbacks += 1
+                try:
+                    answer = self.analyze_single(payload)
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+            future.set_result(answer)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self._executor.submit(self._dispatch, batch)
+
+
+_gemini_batcher = None
+_gemini_batcher_lock = threading.Lock()
+
+def get_gemini_batcher():
+    global _gemini_batcher
+
+    with _gemini_batcher_lock:
+        if _gemini_batcher is None:
+            _gemini_batcher = GeminiBatcher(
+                analyze_payload_batch,
+                analyze_payload_2,
+                max_batch=int(os.environ.get('GEMINI_BATCH_SIZE', 10)),
+                max_wait_ms=int(os.environ.get('GEMINI_BATCH_MS', 200)),
+                max_pending=int(os.environ.get('GEMINI_MAX_PENDING', 1000))
+            )
+
+    return _gemini_batcher
+
+def submit_payload(payload):
+    """Future for the three line gemini answer, batched with whatever else is pending"""
+    return get_gemini_batcher().submit(payload)
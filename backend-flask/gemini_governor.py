@@ -0,0 +1,239 @@
+import os
+import threading
+import time
+
+#Gemini call governor
+#Every gemini request goes through one governor: a semaphore caps the calls in flight, requests per minute
+#and tokens per minute buckets keep us under the provider rate limits, and a circuit breaker stops calling
+#after consecutive failures. While the breaker is open calls are rejected straight away (the capture
+#pipeline falls back to the IOC rules verdict) until a single half-open probe succeeds
+
+#rough prompt size estimate, the real usage from the response corrects the bucket afterwards
+CHARS_PER_TOKEN = 4
+OUTPUT_TOKEN_ESTIMATE = 256
+
+class GeminiUnavailable(Exception):
+    """The circuit breaker is open, gemini isn't called"""
+
+class GeminiThrottled(Exception):
+    """No capacity freed up within the governor's max wait"""
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = float(per_minute)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount, deadline):
+        """Take amount tokens, waiting for the refill until the monotonic deadline, returns False on timeout"""
+        #a request bigger than the whole bucket would never fit, let it through on a full bucket
+        amount = min(amount, self.capacity)
+
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return True
+                wait = (amount - self.tokens) / self.rate
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(wait, remaining))
+
+    def adjust(self, amount):
+        """Give back (positive) or take (negative) tokens once the real cost is known, can go into debt"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return int(self.tokens)
+
+
+class GeminiGovernor:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, max_in_flight=4, requests_per_minute=15, tokens_per_minute=1000000,
+                 failure_threshold=5, reset_timeout=30, max_wait=60):
+        self.max_in_flight = max_in_flight
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_wait = max_wait
+        self._semaphore = threading.BoundedSemaphore(max_in_flight)
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._lock = threading.Lock()
+
+        self.state = self.CLOSED
+        self._opened_at = 0
+        self._probe_in_flight = False
+
+        #counters exposed through stats()
+        self.in_flight = 0
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.rejected = 0
+        self.throttled = 0
+        self.throttle_wait = 0.0
+        self.times_opened = 0
+        self.last_error = None
+
+    def call(self, fn, prompt):
+        """fn(prompt) under the concurrency limit, rate limits and circuit breaker"""
+        probe = self._admit()
+        try:
+            response = self._call_limited(fn, prompt)
+        except GeminiThrottled:
+            #throttling is ours, not a provider failure, a throttled probe just lets the next caller try
+            with self._lock:
+                self._probe_in_flight = False
+            raise
+        except Exception as e:
+            self._record_failure(e, probe)
+            raise
+
+        self._record_success()
+        return response
+
+    def _admit(self):
+        """Raise GeminiUnavailable while the breaker is open, returns True for the half-open probe"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    raise GeminiUnavailable(f"circuit open after {self.consecutive_failures} consecutive failures")
+                self.state = self.HALF_OPEN
+
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    self.rejected += 1
+                    raise GeminiUnavailable("circuit half open, waiting on the probe call")
+                self._probe_in_flight = True
+                return True
+
+        return False
+
+    def _call_limited(self, fn, prompt):
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        estimate = len(str(prompt)) // CHARS_PER_TOKEN + OUTPUT_TOKEN_ESTIMATE
+
+        if not self._semaphore.acquire(timeout=self.max_wait):
+            self._throttled(started)
+            raise GeminiThrottled(f"{self.max_in_flight} gemini calls already in flight")
+
+        try:
+            if not self._requests.acquire(1, deadline):
+                self._throttled(started)
+                raise GeminiThrottled("requests per minute limit reached")
+
+            if not self._tokens.acquire(estimate, deadline):
+                self._requests.adjust(1)
+                self._throttled(started)
+                raise GeminiThrottled("tokens per minute limit reached")
+
+            with self._lock:
+                self.in_flight += 1
+                self.calls += 1
+                self.throttle_wait += time.monotonic() - started
+
+            try:
+                response = fn(prompt)
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+
+            #settle the token estimate against what the call actually used
+            used = getattr(getattr(response, "usage_metadata", None), "total_token_count", None)
+            if isinstance(used, int):
+                self._tokens.adjust(estimate - used)
+
+            return response
+        finally:
+            self._semaphore.release()
+
+    def _throttled(self, started):
+        with self._lock:
+            self.throttled += 1
+            self.throttle_wait += time.monotonic() - started
+
+    def _record_success(self):
+        with self._lock:
+            self.successes += 1
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+            if self.state != self.CLOSED:
+                print("Gemini circuit closed")
+            self.state = self.CLOSED
+
+    def _record_failure(self, e, probe):
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = str(e)
+            self._probe_in_flight = False
+
+            if probe or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                    print(f"Gemini circuit open after {self.consecutive_failures} consecutive failures: {e}")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            waited = self.calls + self.throttled
+            return {
+                "state": self.state,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "requests_available": self._requests.available(),
+                "requests_per_minute": self._requests.capacity,
+                "tokens_available": self._tokens.available(),
+                "tokens_per_minute": self._tokens.capacity,
+                "calls": self.calls,
+                "successes": self.successes,
+                "failures": self.failures,
+                "consecutive_failures": self.consecutive_failures,
+                "rejected": self.rejected,
+                "throttled": self.throttled,
+                "avg_wait_ms": round(self.throttle_wait / waited * 1000, 2) if waited else 0,
+                "times_opened": self.times_opened,
+                "last_error": self.last_error
+            }
+
+
+_gemini_governor = None
+_gemini_governor_lock = threading.Lock()
+
+def get_gemini_governor():
+    global _gemini_governor
+
+    with _gemini_governor_lock:
+        if _gemini_governor is None:
+            _gemini_governor = GeminiGovernor(
+                max_in_flight=int(os.environ.get('GEMINI_MAX_IN_FLIGHT', 4)),
+                requests_per_minute=int(os.environ.get('GEMINI_RPM', 15)),
+                tokens_per_minute=int(os.environ.get('GEMINI_TPM', 1000000)),
+                failure_threshold=int(os.environ.get('GEMINI_BREAKER_FAILURES', 5)),
+                reset_timeout=int(os.environ.get('GEMINI_BREAKER_RESET', 30)),
+                max_wait=int(os.environ.get('GEMINI_MAX_WAIT', 60))
+            )
+
+    return _gemini_governor
@@ -1,66 +1,17 @@
 # from __main__ import app
-from flask import jsonify, request
+from flask import current_app, jsonify, request
 import base64
 import hashlib
 import os
 import sqlite3
 import json
-import ipinfo
-from user_agents import parse
-from dotenv import load_dotenv
-from decoy_database import get_memory_db
-from postgres_db import log_attacker_information, query_db
-from gemini import analyze_payload_2
-
-def parse_user_agent(user_agent_string):
-    """
-    Parse a user agent string into structured data using the user-agents package
-    """
-    if not user_agent_string:
-        return {
-            "browser": "Unknown",
-            "browser_version": "Unknown",
-            "os": "Unknown",
-            "device": "Unknown",
-            "is_mobile": False,
-            "is_tablet": False,
-            "is_pc": False,
-            "is_bot": False,
-            "raw": user_agent_string
-        }
-    
-    try:
-        # Parse the user agent string
-        user_agent = parse(user_agent_string)
-        
-        # Extract structured information
-        parsed_data = {
-            "browser": user_agent.browser.family,
-            "browser_version": ".".join(str(v) for v in user_agent.browser.version if v),
-            "os": f"{user_agent.os.family} {'.'.join(str(v) for v in user_agent.os.version if v)}".strip(),
-            "device": user_agent.device.family,
-            "is_mobile": user_agent.is_mobile,
-            "is_tablet": user_agent.is_tablet,
-            "is_pc": user_agent.is_pc,
-            "is_bot": user_agent.is_bot,
-            "raw": user_agent_string
-        }
-        
-        return parsed_data
-    except Exception as e:
-        print(f"Error parsing user agent: {e}")
-        return {
-            "browser": "Parse Error",
-            "browser_version": "Unknown",
-            "os": "Unknown",
-            "device": "Unknown",
-            "is_mobile": False,
-            "is_tablet": False,
-            "is_pc": False,
-            "is_bot": False,
-            "raw": user_agent_string,
-            "error": str(e)
-        }
+from decoy_database import get_decoy_result_cache, get_memory_db
+from decoy_cache import result_key
+from postgres_db import query_db
+from capture_pipeline import queue_attacker_information
+import common_path
+from user_agent_parser import parse_user_agent
+from ioc_rules import get_ioc_rule_engine, request_fields
 
 def extract_attacker_info():
     """Extract attacker information from the request with enhanced user agent parsing"""
@@ -83,20 +34,12 @@ def extract_attacker_info():
     }
     device_fingerprint = hashlib.sha256(json.dumps(fingerprint_data, sort_keys=True).encode()).hexdigest()
     
-    # Placeholder for geolocation
-    #Will need to get a real service/api to get the geolocation based on IP
-
-    load_dotenv('.env')
-    geolocation_handler = ipinfo.getHandler(os.environ.get('IP_INFO_ACCESS_TOKEN'))
-
-    geolocation = geolocation_handler.getDetails(ip_address)
-    print(type(geolocation.all))
-    print(geolocation.all)
+    #geolocation is looked up by the capture workers after the response is sent
     
-    # Look for IOCs
-    ioc_list = []
-
-    temp_payload_analysis(ioc_list, request)
+    # Look for IOCs in the body, query string and headers
+    ioc_engine = get_ioc_rule_engine()
+    ioc_matches = ioc_engine.scan(request_fields(request))
+    ioc_list = ioc_engine.match_labels(ioc_matches)
 
     # Add user-agent specific IOCs
     if parsed_ua["is_bot"]:
@@ -112,14 +55,15 @@ def extract_attacker_info():
     ioc = json.dumps(ioc_list) if ioc_list else None
     
     # Store the full parsed UA data
-    user_agent_data = json.dumps(parsed_ua)
+    user_agent_data = json.dumps(dict(parsed_ua))
     
     return {
         "ip_address": ip_address,
         "user_agent": user_agent_data,  # Store the full parsed data as JSON
         "device_fingerprint": device_fingerprint,
-        "geolocation": geolocation.all,
+        "geolocation": None,
         "ioc": ioc,
+        "ioc_matches": ioc_matches,
         # Additional parsed fields for easy querying
         "browser": parsed_ua["browser"],
         "os": parsed_ua["os"],
@@ -128,24 +72,6 @@ def extract_attacker_info():
     }
 
 
-def temp_payload_analysis(ioc_list, request):
-    # Check request data for suspicious patterns
-    payload = request.data.decode('utf-8') if request.data else ""
-    print(type(request.data))
-    print(type(request.args))
-    if payload == "" and request.args:
-        payload = dict(request.args).__str__()
-        print(payload)
-    
-
-    if any(pattern in payload.lower() for pattern in ["select ", "union ", "insert ", "drop ", "--", "'; ", "' or '", "1=1"]):
-        ioc_list.append("Possible SQL injection attempt")
-    
-    if any(pattern in payload.lower() for pattern in ["<script>", "javascript:", "onerror=", "onload="]):
-        ioc_list.append("Possible XSS attempt")
-
-    print("Current IOC list:", ioc_list)
-
 def get_attacker_summary(attacker_info, gemini_summary=None):
     #send the information to the ai to process
     payload_to_analyze = {
@@ -175,36 +101,11 @@ def get_attacker_summary(attacker_info, gemini_summary=None):
     #get any query arguments or strings 
     payload_to_analyze['query_params'] = request.query_string
 
-    #get response from gemini
-    if not gemini_summary:
-        gemini_analysis = analyze_payload_2(payload_to_analyze)
-
-        print(gemini_analysis)
-    else:
-        gemini_analysis = []
-
-
-    response_string = str(gemini_analysis).split("\n")
-
-    #filter the empty lines
-    arr = []
-    for row in response_string:
-        if row:
-            arr.append(row)
-    
-    response_string = arr
-    if not gemini_summary:
-        gemini_analysis_res = {
-            "technique": response_string[0],
-            "iocs": response_string[1],
-            "description": response_string[2] 
-        }
-    else:
-        gemini_analysis_res = gemini_summary
-
+    #gemini is called by the capture workers, a route can still pass its own verdict
     attacker_summary = {
         "attacker_info" : attacker_info,
-        "gemini" : gemini_analysis_res,
+        "gemini" : gemini_summary,
+        "payload_to_analyze": payload_to_analyze,
         "request_details": {
             "full_url": request.url,
             "path": request.path,
@@ -221,6 +122,24 @@ def get_attacker_summary(attacker_info, gemini_summary=None):
 
 
 
+def cached_decoy_response(db):
+    """Result cache ticket of this read on db (its key and the cache clock) and the cached response,
+    None on a miss"""
+    cache = get_decoy_result_cache()
+    ticket = (result_key(request.path, request.args, getattr(db, 'cache_scope', None)), cache.clock())
+    body = cache.get(ticket[0])
+    if body is None:
+        return ticket, None
+    return ticket, current_app.response_class(body, mimetype=current_app.json.mimetype)
+
+def decoy_rows_response(ticket, db, query):
+    """Run a read only decoy query and cache the JSON body unless a write to its tables raced it"""
+    result = db.execute(query).fetchall()
+    response = jsonify([dict(row) for row in result])
+    key, started = ticket
+    get_decoy_result_cache().put(key, response.get_data(), query, started)
+    return response
+
 def register_honeypot_routes(app):
     @app.route('/api/login', methods=["POST", "OPTIONS"])
     def handleDecoyLogin():
@@ -247,7 +166,7 @@ def register_honeypot_routes(app):
         #continue the request as normal back to the frontend
         if not data or 'username' not in data or 'password' not in data:
             attacker_summary = get_attacker_summary(attacker_info)
-            log_attacker_information(attacker_summary)
+            queue_attacker_information(attacker_summary)
             return jsonify({"error": "username and password are required"}), 400
 
         username_encoded = data['username']
@@ -272,7 +191,7 @@ def register_honeypot_routes(app):
             attacker_info["ioc"] = json.dumps(["SQL injection in credentials"])
 
         attacker_summary = get_attacker_summary(attacker_info)
-        log_attacker_information(attacker_summary)
+        queue_attacker_information(attacker_summary)
 
         try:
             #purposely using a sql injection susceptible query
@@ -398,7 +317,7 @@ def register_honeypot_routes(app):
             return jsonify({"error": "Username and new password are required."}), 400
 
         # Fetch the user based on username
-        db = get_memory_db()
+        db = get_memory_db(for_write=True)
         userCheck = db.execute("SELECT user_id FROM Users WHERE username = '" + username + "'")
         user = userCheck.fetchone()
         if not user:
@@ -410,6 +329,7 @@ def register_honeypot_routes(app):
         # Update the user's password
         db.execute("UPDATE Users SET password = '" + new_password + "' WHERE user_id = " + str(user_id))
         db.commit()
+        get_decoy_result_cache().invalidate(["Users"], getattr(db, 'cache_scope', None))
 
         #"Password successfully changed."
         return jsonify({"message": True}), 200
@@ -424,11 +344,14 @@ def register_honeypot_routes(app):
         attacker_summary = get_attacker_summary(attacker_info)
 
         #get the log from the attacker
-        log_attacker_information(attacker_summary)
+        queue_attacker_information(attacker_summary)
         
         try:
             #actually get the data from the decoy database
             db = get_memory_db()
+            ticket, cached = cached_decoy_response(db)
+            if cached is not None:
+                return cached
 
             query = "Select *  from Forum " \
             "inner join Users as us on Forum.user_id = us.user_id "
@@ -443,14 +366,7 @@ def register_honeypot_routes(app):
                     query += " AND "
 
             print(query)
-            cur = db.execute(query)
-            result = cur.fetchall()
-
-            res = []
-
-            if result:
-                res = [dict(row) for row in result]
-            return jsonify(res)
+            return decoy_rows_response(ticket, db, query)
         except sqlite3.Error as e:
             print(f"SQLite error: {e}")
             return jsonify({"error": f"Database error: {str(e)}"}), 500
@@ -501,11 +417,11 @@ def register_honeypot_routes(app):
         attacker_summary = get_attacker_summary(attacker_info)
 
         #get the log from the attacker
-        log_attacker_information(attacker_summary)
+        queue_attacker_information(attacker_summary)
         
         try:
             #actually get the data from the decoy database
-            db = get_memory_db()
+            db = get_memory_db(for_write=True)
 
             query = "INSERT INTO Forum (title, description, forum_category, user_id, is_pinned)" \
                 " VALUES " \
@@ -514,6 +430,7 @@ def register_honeypot_routes(app):
             print(query)
             cur = db.execute(query)
             result = cur.fetchone()
+            get_decoy_result_cache().invalidate(["Forum"], getattr(db, 'cache_scope', None))
             print(result)
 
             if result:
@@ -534,11 +451,14 @@ def register_honeypot_routes(app):
         attacker_summary = get_attacker_summary(attacker_info)
 
         #get the log from the attacker
-        log_attacker_information(attacker_summary)
+        queue_attacker_information(attacker_summary)
         
         try:
             #actually get the data from the decoy database
             db = get_memory_db()
+            ticket, cached = cached_decoy_response(db)
+            if cached is not None:
+                return cached
 
             query = "Select *, fm.title as forum_title from ForumComments " \
             "inner join Forum as fm on ForumComments.forum_id = fm.forum_id " \
@@ -554,14 +474,7 @@ def register_honeypot_routes(app):
                     query += " AND "
 
             print(query)
-            cur = db.execute(query)
-            result = cur.fetchall()
-
-            res = []
-
-            if result:
-                res = [dict(row) for row in result]
-            return jsonify(res)
+            return decoy_rows_response(ticket, db, query)
         except sqlite3.Error as e:
             print(f"SQLite error: {e}")
             return jsonify({"error": f"Database error: {str(e)}"}), 500
@@ -602,10 +515,10 @@ def register_honeypot_routes(app):
         # Log attacker info
         attacker_info = extract_attacker_info()
         attacker_summary = get_attacker_summary(attacker_info)
-        log_attacker_information(attacker_summary)
+        queue_attacker_information(attacker_summary)
 
         try:
-            db = get_memory_db()
+            db = get_memory_db(for_write=True)
             query = (
                 "INSERT INTO ForumComments (forum_id, user_id, comment) "
                 f"VALUES ('{request_data['forum_id']}', '{user_id}', '{request_data['comment']}') RETURNING *;"
@@ -613,6 +526,7 @@ def register_honeypot_routes(app):
             print("Insert comment query:", query)
             cur = db.execute(query)
             result = cur.fetchone()
+            get_decoy_result_cache().invalidate(["ForumComments"], getattr(db, 'cache_scope', None))
 
             if result:
                 result = dict(result)
@@ -639,11 +553,14 @@ def register_honeypot_routes(app):
         attacker_summary = get_attacker_summary(attacker_info)
 
         #get the log from the attacker
-        log_attacker_information(attacker_summary)
+        queue_attacker_information(attacker_summary)
         
         try:
             #actually get the data from the decoy database
             db = get_memory_db()
+            ticket, cached = cached_decoy_response(db)
+            if cached is not None:
+                return cached
 
             query = ""
             if employee_name and amount:
@@ -655,14 +572,7 @@ def register_honeypot_routes(app):
             else:
                 query = "select * from Expenses inner join Users us on Expenses.user_id = us.user_id"
 
-            cur = db.execute(query)
-            result = cur.fetchall()
-
-            res = []
-
-            if result:
-                res = [dict(row) for row in result]
-            return jsonify(res)
+            return decoy_rows_response(ticket, db, query)
         except sqlite3.Error as e:
             print(f"SQLite error: {e}")
             return jsonify({"error": f"Database error: {str(e)}"}), 500
@@ -679,11 +589,14 @@ def register_honeypot_routes(app):
         attacker_summary = get_attacker_summary(attacker_info)
 
         #get the log from the attacker
-        log_attacker_information(attacker_summary)
+        queue_attacker_information(attacker_summary)
         
         try:
             #actually get the data from the decoy database
             db = get_memory_db()
+            ticket, cached = cached_decoy_response(db)
+            if cached is not None:
+                return cached
 
             query = "Select ITSupport.reported_by as reported_by_id, ITSupport.assigned_to as assigned_to_id, user1.name as reported_by, user2.name as assigned_to, ITSupport.* from ITSupport " \
             "inner join Users as user1 on ITSupport.reported_by = user1.user_id " \
@@ -699,14 +612,7 @@ def register_honeypot_routes(app):
                     query += " AND "
 
             print(query)
-            cur = db.execute(query)
-            result = cur.fetchall()
-
-            res = []
-
-            if result:
-                res = [dict(row) for row in result]
-            return jsonify(res)
+            return decoy_rows_response(ticket, db, query)
         except sqlite3.Error as e:
             print(f"SQLite error: {e}")
             return jsonify({"error": f"Database error: {str(e)}"}), 500
@@ -721,11 +627,14 @@ def register_honeypot_routes(app):
         attacker_summary = get_attacker_summary(attacker_info)
 
         #get the log from the attacker
-        log_attacker_information(attacker_summary)
+        queue_attacker_information(attacker_summary)
         
         try:
             #actually get the data from the decoy database
             db = get_memory_db()
+            ticket, cached = cached_decoy_response(db)
+            if cached is not None:
+                return cached
 
             query = "Select *, d.name as department_name from PerformanceAnalytics " \
             "inner join Department as d on PerformanceAnalytics.department_id = d.department_id "
@@ -740,14 +649,7 @@ def register_honeypot_routes(app):
                     query += " AND "
 
             print(query)
-            cur = db.execute(query)
-            result = cur.fetchall()
-
-            res = []
-
-            if result:
-                res = [dict(row) for row in result]
-            return jsonify(res)
+            return decoy_rows_response(ticket, db, query)
         except sqlite3.Error as e:
             print(f"SQLite error: {e}")
             return jsonify({"error": f"Database error: {str(e)}"}), 500
@@ -763,11 +665,14 @@ def register_honeypot_routes(app):
         attacker_summary = get_attacker_summary(attacker_info)
 
         #get the log from the attacker
-        log_attacker_information(attacker_summary)
+        queue_attacker_information(attacker_summary)
         
         try:
             #actually get the data from the decoy database
             db = get_memory_db()
+            ticket, cached = cached_decoy_response(db)
+            if cached is not None:
+                return cached
 
             query = "Select * from CorporateInitiatives "
             
@@ -781,14 +686,7 @@ def register_honeypot_routes(app):
                     query += " AND "
 
             print(query)
-            cur = db.execute(query)
-            result = cur.fetchall()
-
-            res = []
-
-            if result:
-                res = [dict(row) for row in result]
-            return jsonify(res)
+            return decoy_rows_response(ticket, db, query)
         except sqlite3.Error as e:
             print(f"SQLite error: {e}")
             return jsonify({"error": f"Database error: {str(e)}"}), 500
@@ -799,11 +697,14 @@ def register_honeypot_routes(app):
         
         attacker_info = extract_attacker_info()
         attacker_summary = get_attacker_summary(attacker_info)
-        log_attacker_information(attacker_summary) #logging to postgres
+        queue_attacker_information(attacker_summary) #queued for logging to postgres
         
         try:
             # Connect to the database
             db = get_memory_db()
+            ticket, cached = cached_decoy_response(db)
+            if cached is not None:
+                return cached
             
             # Base query to get all employees
             query = "SELECT * FROM Users "
@@ -818,15 +719,7 @@ def register_honeypot_routes(app):
                         query += " AND "
             
             # Execute the query
-            cur = db.execute(query)
-            result = cur.fetchall()
-            
-            # Convert the result to a list of dictionaries
-            res = []
-            if result:
-                res = [dict(row) for row in result]
-                
-            return jsonify(res)
+            return decoy_rows_response(ticket, db, query)
         
         except sqlite3.Error as e:
             print(f"SQLite error: {e}")
@@ -850,7 +743,7 @@ def register_honeypot_routes(app):
         attacker_summary = get_attacker_summary(attacker_info, gemini_summary)
 
         #get the log from the attacker
-        log_attacker_information(attacker_summary)
+        queue_attacker_information(attacker_summary)
         
         try:
             #actually get the data from the actual database but specify the columns
@@ -78,10 +78,28 @@ def create_table():
                         owasp_technique text,
                         ioc text,
                         gemini_response text,
+                        capture_id text,
+                        count integer NOT NULL DEFAULT 1,
+                        first_ts timestamp,
+                        last_ts timestamp,
                         timestamp timestamp DEFAULT CURRENT_TIMESTAMP
                     ); """
                 );        
     
+    #one attacker row per (ip, fingerprint), lets the capture path upsert with ON CONFLICT
+    cur.execute(""" CREATE UNIQUE INDEX attacker_identity_idx
+                    ON Attacker (ip_address, device_fingerprint); """
+                );
+
+    cur.execute(""" CREATE INDEX honeypot_session_attacker_idx
+                    ON Honeypot_Session (attacker_id, last_seen DESC); """
+                );
+
+    #only attacks that went in with a fallback verdict carry a capture_id, the late gemini answer finds them by it
+    cur.execute(""" CREATE INDEX attack_capture_idx
+                    ON Attack (capture_id) WHERE capture_id IS NOT NULL; """
+                );
+
     cur.execute('DROP TABLE IF EXISTS SOC_Dashboard CASCADE;')
     cur.execute(""" CREATE TABLE SOC_Dashboard
                     (
@@ -93,8 +111,22 @@ def create_table():
                         report text
                     ); """
                 ); 
+
+    #gemini verdicts keyed by a hash of the normalized payload, shared by every worker and kept across restarts
+    cur.execute('DROP TABLE IF EXISTS Gemini_Verdict CASCADE;')
+    cur.execute(""" CREATE TABLE Gemini_Verdict
+                    (
+                        payload_hash text primary key,
+                        owasp_technique text,
+                        ioc text,
+                        gemini_response text,
+                        created_at timestamp DEFAULT CURRENT_TIMESTAMP
+                    ); """
+                );
     
 
+    create_capture_functions(cur)
+
     #commit to the database
     conn.commit()
 
@@ -104,5 +136,61 @@ def create_table():
     conn.close()
 
 
+def create_capture_functions(cur):
+    """Server side functions so the capture path records an attack in a single round trip"""
+
+    #Upserts the attacker then reuses its latest session if it was active in the last 15 minutes,
+    #otherwise opens a new one. The ON CONFLICT upsert keeps the attacker row locked until commit so
+    #concurrent requests from the same attacker can't open duplicate sessions
+    cur.execute(""" CREATE OR REPLACE FUNCTION resolve_attacker_session(
+                        p_ip_address TEXT,
+                        p_user_agent TEXT,
+                        p_device_fingerprint TEXT,
+                        p_geolocation TEXT,
+                        p_browser TEXT,
+                        p_os TEXT,
+                        p_device_type TEXT,
+                        p_is_bot BOOLEAN
+                    ) RETURNS TABLE (attacker_id INTEGER, session_id INTEGER) AS $$
+                    #variable_conflict use_column
+                    DECLARE
+                        v_attacker_id INTEGER;
+                        v_session_id INTEGER;
+                    BEGIN
+                        INSERT INTO Attacker
+                            (ip_address, user_agent, device_fingerprint, geolocation, browser, os, device_type, is_bot)
+                        VALUES
+                            (p_ip_address, p_user_agent, p_device_fingerprint, p_geolocation, p_browser, p_os, p_device_type, p_is_bot)
+                        ON CONFLICT (ip_address, device_fingerprint) DO UPDATE SET
+                            last_seen = CURRENT_TIMESTAMP,
+                            user_agent = EXCLUDED.user_agent,
+                            browser = EXCLUDED.browser,
+                            os = EXCLUDED.os,
+                            device_type = EXCLUDED.device_type,
+                            is_bot = EXCLUDED.is_bot
+                        RETURNING attacker_id INTO v_attacker_id;
+
+                        UPDATE Honeypot_Session SET last_seen = CURRENT_TIMESTAMP
+                        WHERE session_id = (
+                            SELECT hs.session_id FROM Honeypot_Session hs
+                            WHERE hs.attacker_id = v_attacker_id
+                              AND hs.last_seen >= LOCALTIMESTAMP - INTERVAL '15 minutes'
+                            ORDER BY hs.last_seen DESC
+                            LIMIT 1
+                        )
+                        RETURNING session_id INTO v_session_id;
+
+                        IF v_session_id IS NULL THEN
+                            INSERT INTO Honeypot_Session (attacker_id)
+                            VALUES (v_attacker_id)
+                            RETURNING session_id INTO v_session_id;
+                        END IF;
+
+                        RETURN QUERY SELECT v_attacker_id, v_session_id;
+                    END;
+                    $$ LANGUAGE plpgsql; """
+                );
+
+
 create_table()
 # insert_to_table()
\ No newline at end of file
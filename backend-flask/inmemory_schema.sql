@@ -130,4 +130,12 @@ CREATE TABLE IF NOT EXISTS CorporateInitiatives (
     budget INTEGER,
     progress TEXT,
     executive_sponsor TEXT
-);
\ No newline at end of file
+);
+
+-- Indexes for the access paths of the decoy routes (benchmarks/decoy_query_plans.py checks them)
+CREATE INDEX IF NOT EXISTS idx_users_name ON Users (name);
+CREATE INDEX IF NOT EXISTS idx_expenses_user_id ON Expenses (user_id);
+CREATE INDEX IF NOT EXISTS idx_security_answers_user_question ON SecurityAnswers (user_id, question_id);
+CREATE INDEX IF NOT EXISTS idx_forum_user_id ON Forum (user_id);
+CREATE INDEX IF NOT EXISTS idx_forum_comments_forum_id ON ForumComments (forum_id);
+CREATE INDEX IF NOT EXISTS idx_forum_comments_user_id ON ForumComments (user_id);
@@ -0,0 +1,311 @@
+import argparse
+import json
+import math
+import os
+import random
+import re
+import threading
+from collections import Counter, defaultdict
+from urllib.parse import parse_qsl
+import common_path
+from metrics import timed_stage
+
+#Local payload classifier
+#Character n-gram TF-IDF vectors and one centroid per category, trained from the labelled payloads in
+#training-matrial. Classifying a payload is a handful of dict lookups, so confident verdicts skip gemini
+#and only the uncertain ones are escalated. A verdict stays local only when the softmax confidence clears
+#the threshold, the best centroid beats the runner up by min_margin (cosine) and its class was trained on
+#at least min_samples payloads, a class built from a handful of samples claims anything near them
+#
+#Usage:
+#   python local_classifier.py train     retrain and export local_classifier_model.json
+#   python local_classifier.py report    cross validated accuracy and how much traffic the threshold keeps local
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TRAINING_FILES = [
+    os.path.join(BASE_DIR, '..', 'training-matrial', 'payloads.json'),
+    os.path.join(BASE_DIR, '..', 'training-matrial', 'benign_payloads.json')
+]
+DEFAULT_MODEL_PATH = os.path.join(BASE_DIR, 'local_classifier_model.json')
+
+#training labels mapped onto the attack vectors analyze_payload_2 answers with, the rest are left to gemini
+CATEGORY_MAP = {
+    "SQL Injection": "Injection - SQL",
+    "XSS Injection": "Injection - XSS",
+    "Broken Access Control": "Broken Access Control",
+    "No Attack Vector": "No Attack Vector"
+}
+
+NGRAM_SIZES = (3, 4, 5)
+MAX_TEXT_LENGTH = 2000
+
+def normalize_text(text):
+    return re.sub(r'\s+', ' ', str(text)).strip().lower()[:MAX_TEXT_LENGTH]
+
+def ngram_counts(text):
+    text = f" {normalize_text(text)} "
+    counts = Counter()
+    for n in NGRAM_SIZES:
+        counts.update(text[i:i + n] for i in range(len(text) - n + 1))
+    return counts
+
+
+class LocalClassifier:
+    def __init__(self, idf, centroids, temperature=0.05, class_sizes=None):
+        self.idf = idf
+        self.centroids = centroids
+        self.temperature = temperature
+        #training payloads per category, a model without them never answers locally
+        self.class_sizes = class_sizes or {}
+
+        #unseen n-grams still count towards the vector length, with the weight of the rarest known one
+        self.default_idf = max(idf.values()) if idf else 1.0
+        self._build_index()
+
+    def _build_index(self):
+        #n-gram -> [(category, weight)] so scoring walks the payload's n-grams once instead of once per category
+        self.labels = list(self.centroids)
+        self._index = defaultdict(list)
+        for position, label in enumerate(self.labels):
+            for gram, weight in self.centroids[label].items():
+                self._index[gram].append((position, weight))
+
+    @classmethod
+    def train(cls, samples, max_features_per_class=3000, temperature=0.05):
+        """samples is a list of (text, label)"""
+        documents = [(ngram_counts(text), label) for text, label in samples]
+
+        document_frequency = Counter()
+        for counts, _ in documents:
+            document_frequency.update(counts.keys())
+
+        total = len(documents)
+        idf = {gram: math.log((1 + total) / (1 + df)) + 1 for gram, df in document_frequency.items()}
+        model = cls(idf, {}, temperature)
+
+        sums = defaultdict(Counter)
+        sizes = Counter()
+        for counts, label in documents:
+            sums[label].update(model._weights(counts))
+            sizes[label] += 1
+
+        for label, summed in sums.items():
+            #keep only the strongest features so the exported model stays small
+            top = dict(Counter({gram: weight / sizes[label] for gram, weight in summed.items()}).most_common(max_features_per_class))
+            norm = math.sqrt(sum(weight * weight for weight in top.values())) or 1.0
+            model.centroids[label] = {gram: round(weight / norm, 6) for gram, weight in top.items()}
+
+        model.class_sizes = dict(sizes)
+        model._build_index()
+        return model
+
+    def _weights(self, counts):
+        weights = {gram: (1 + math.log(count)) * self.idf.get(gram, self.default_idf) for gram, count in counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+        return {gram: weight / norm for gram, weight in weights.items()}
+
+    def scores(self, text):
+        """Cosine similarity of the text to every category centroid"""
+        totals = [0.0] * len(self.labels)
+        index = self._index
+        for gram, weight in self._weights(ngram_counts(text)).items():
+            for position, centroid_weight in index.get(gram, ()):
+                totals[position] += weight * centroid_weight
+        return dict(zip(self.labels, totals))
+
+    def classify(self, text):
+        """(category, confidence, margin), confidence is a softmax over the centroid similarities and
+        margin how far the best similarity is ahead of the runner up"""
+        scores = self.scores(text)
+        if not scores:
+            return None, 0.0, 0.0
+
+        best = max(scores, key=scores.get)
+        exps = {label: math.exp((score - scores[best]) / self.temperature) for label, score in scores.items()}
+        runner_up = max((score for label, score in scores.items() if label != best), default=0.0)
+        return best, exps[best] / sum(exps.values()), scores[best] - runner_up
+
+    def predict(self, text):
+        """(category, confidence)"""
+        return self.classify(text)[:2]
+
+    def accepts(self, label, confidence, margin, threshold=0.8, min_margin=0.1, min_samples=5):
+        """Whether a classification is trustworthy enough to skip gemini"""
+        return (
+            label is not None
+            and confidence >= threshold
+            and margin >= min_margin
+            and self.class_sizes.get(label, 0) >= min_samples
+        )
+
+    def to_dict(self):
+        #only n-grams used by a centroid are needed at runtime, the rest fall back to default_idf
+        used = set().union(*self.centroids.values()) if self.centroids else set()
+        return {
+            "ngram_sizes": list(NGRAM_SIZES),
+            "temperature": self.temperature,
+            "default_idf": self.default_idf,
+            "class_sizes": self.class_sizes,
+            "idf": {gram: round(self.idf[gram], 6) for gram in sorted(used)},
+            "centroids": self.centroids
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        model = cls(data["idf"], data["centroids"], data.get("temperature", 0.05), data.get("class_sizes"))
+        model.default_idf = data.get("default_idf", model.default_idf)
+        return model
+
+    def save(self, path=DEFAULT_MODEL_PATH):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path=DEFAULT_MODEL_PATH):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def load_training_samples(paths=TRAINING_FILES):
+    samples = []
+    for path in paths:
+        with open(path) as f:
+            for item in json.load(f):
+                label = CATEGORY_MAP.get(item["owaspCategory"])
+                if label:
+                    samples.append((item["payload"], label))
+    return samples
+
+def _query_pairs(query_params):
+    if isinstance(query_params, bytes):
+        query_params = query_params.decode('utf-8', 'replace')
+    return parse_qsl(query_params or "", keep_blank_values=True)
+
+def payload_text(payload_to_analyze):
+    """The attacker controlled part of a captured payload, request data and query param keys and values.
+    Keys count too, the decoy routes put query keys straight into their SQL"""
+    values = []
+    for key, value in dict(payload_to_analyze.get("request_data") or {}).items():
+        values += [str(key), str(value)]
+    for key, value in _query_pairs(payload_to_analyze.get("query_params")):
+        values += [key, value]
+
+    return "\n".join(value for value in values if value.strip())
+
+
+def cross_validate(samples, folds=5, threshold=0.8, min_margin=0.1, min_samples=5, seed=42):
+    """Accuracy per fold held out, plus how much traffic stays local at the threshold and how accurate that is"""
+    samples = list(samples)
+    random.Random(seed).shuffle(samples)
+
+    correct = 0
+    confident = 0
+    confident_correct = 0
+    per_class = defaultdict(lambda: {"total": 0, "correct": 0})
+
+    for fold in range(folds):
+        test = samples[fold::folds]
+        train = [sample for i, sample in enumerate(samples) if i % folds != fold]
+        model = LocalClassifier.train(train)
+
+        for text, label in test:
+            predicted, confidence, margin = model.classify(text)
+            per_class[label]["total"] += 1
+            if predicted == label:
+                correct += 1
+                per_class[label]["correct"] += 1
+            if model.accepts(predicted, confidence, margin, threshold, min_margin, min_samples):
+                confident += 1
+                confident_correct += predicted == label
+
+    total = len(samples)
+    return {
+        "samples": total,
+        "folds": folds,
+        "accuracy": round(correct / total, 4) if total else 0,
+        "threshold": threshold,
+        "min_margin": min_margin,
+        "min_samples": min_samples,
+        "local_coverage": round(confident / total, 4) if total else 0,
+        "local_accuracy": round(confident_correct / confident, 4) if confident else 0,
+        "per_class_recall": {
+            label: round(counts["correct"] / counts["total"], 4) for label, counts in sorted(per_class.items())
+        }
+    }
+
+
+_local_classifier = None
+_local_classifier_lock = threading.Lock()
+
+def get_local_classifier():
+    """Exported model if there is one, otherwise trained from training-matrial on first use"""
+    global _local_classifier
+
+    with _local_classifier_lock:
+        if _local_classifier is None:
+            path = os.environ.get('LOCAL_CLASSIFIER_MODEL') or DEFAULT_MODEL_PATH
+            try:
+                _local_classifier = LocalClassifier.load(path)
+            except OSError:
+                print(f"No local classifier model at {path}, training from {TRAINING_FILES}")
+                _local_classifier = LocalClassifier.train(load_training_samples())
+
+    return _local_classifier
+
+@timed_stage("local_classifier")
+def local_verdict(payload_to_analyze, ioc_matches=None):
+    """Gemini style verdict when the local classifier is confident enough, None to escalate to gemini.
+    A benign verdict is never given for a request the IOC rules matched"""
+    text = payload_text(payload_to_analyze)
+    if not text:
+        return None
+
+    classifier = get_local_classifier()
+    technique, confidence, margin = classifier.classify(text)
+    if not classifier.accepts(
+        technique,
+        confidence,
+        margin,
+        threshold=float(os.environ.get('LOCAL_CLASSIFIER_THRESHOLD', 0.8)),
+        min_margin=float(os.environ.get('LOCAL_CLASSIFIER_MIN_MARGIN', 0.1)),
+        min_samples=int(os.environ.get('LOCAL_CLASSIFIER_MIN_SAMPLES', 5))
+    ):
+        return None
+    if technique == "No Attack Vector" and ioc_matches:
+        return None
+
+    iocs = []
+    if technique != "No Attack Vector":
+        #same shape gemini is asked for, [{key1: value1}, {param1?: value2}]
+        iocs = [f"{{{key}: {value}}}" for key, value in dict(payload_to_analyze.get("request_data") or {}).items()]
+        iocs += [f"{{{key}?: {value}}}" for key, value in _query_pairs(payload_to_analyze.get("query_params"))]
+
+    return {
+        "technique": technique,
+        "iocs": "[" + ", ".join(iocs) + "]",
+        "description": f"Classified by the local model as {technique} ({confidence:.2f} confidence)"
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and evaluate the local payload classifier")
+    parser.add_argument("command", choices=["train", "report"])
+    parser.add_argument("--output", default=DEFAULT_MODEL_PATH, help="where train exports the model")
+    parser.add_argument("--threshold", type=float, default=float(os.environ.get('LOCAL_CLASSIFIER_THRESHOLD', 0.8)))
+    parser.add_argument("--min-margin", type=float, default=float(os.environ.get('LOCAL_CLASSIFIER_MIN_MARGIN', 0.1)))
+    parser.add_argument("--min-samples", type=int, default=int(os.environ.get('LOCAL_CLASSIFIER_MIN_SAMPLES', 5)))
+    parser.add_argument("--folds", type=int, default=5)
+    args = parser.parse_args()
+
+    samples = load_training_samples()
+
+    if args.command == "train":
+        model = LocalClassifier.train(samples)
+        model.save(args.output)
+        print(f"Trained on {len(samples)} payloads, exported {args.output}")
+    else:
+        print(json.dumps(cross_validate(samples, folds=args.folds, threshold=args.threshold,
+                                        min_margin=args.min_margin, min_samples=args.min_samples), indent=4))
+
+if __name__ == "__main__":
+    main()
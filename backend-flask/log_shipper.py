@@ -0,0 +1,274 @@
+import atexit
+import gzip
+import os
+import queue
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from log_spool import spool_from_environment
+import common_path
+from metrics import time_stage
+
+#Bulk logstash shipper
+#Attack logs are queued and a background thread posts them in batches of up to max_events (or whatever
+#arrived within max_latency_ms) as one gzip compressed NDJSON body over a single keep-alive session.
+#Failed posts are retried with exponential backoff, batches that still fail go to the disk spool
+#(log_spool.py) and are drained in order once logstash answers again. The logstash http input needs
+#    additional_codecs => { "application/x-ndjson" => "json_lines" }
+#to split the body into one event per line, gzip bodies are decompressed by the input itself
+#The spool has no cross process locking, every worker process needs its own LOGSTASH_SPOOL_DIR
+
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+class LogShipper:
+    def __init__(self, url, max_events=500, max_latency_ms=1000, max_pending=10000,
+                 max_retries=5, backoff=0.5, max_backoff=30, timeout=5, spool=None, drain_interval=5):
+        self.url = url
+        self.max_events = max_events
+        self.max_latency = max_latency_ms / 1000
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.spool = spool
+        self.drain_interval = drain_interval
+        self._next_drain = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+        #one pooled connection is plenty, only the shipper thread (and the odd test route) posts
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+
+        #counters exposed through stats()
+        self.submitted = 0
+        self.shipped = 0
+        self.batches = 0
+        self.retries = 0
+        self.failed = 0
+        self.dropped = 0
+        self.spooled = 0
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._started_at = time.monotonic()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="logstash-shipper", daemon=True)
+                self._thread.start()
+
+    def submit(self, attacker_json):
+        """Queue one log line (a compact JSON string) for the next batch, returns False if it was dropped"""
+        self.start()
+
+        try:
+            self._queue.put_nowait((time.monotonic(), attacker_json))
+        except queue.Full:
+            if self.spool is not None:
+                #overflow goes to disk rather than being lost
+                self._spool([attacker_json])
+                return True
+            with self._lock:
+                self.dropped += 1
+            print("Logstash shipper is backed up, dropping log")
+            return False
+
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def send(self, lines, max_retries=None):
+        """Post lines as one gzip NDJSON body from the calling thread, returns True once logstash accepted it"""
+        body = ("\n".join(lines) + "\n").encode("utf-8")
+        compressed = gzip.compress(body, compresslevel=5)
+        headers = {"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"}
+        max_retries = self.max_retries if max_retries is None else max_retries
+
+        for attempt in range(max_retries + 1):
+            if attempt:
+                with self._lock:
+                    self.retries += 1
+                #exponential backoff with jitter so a recovering logstash isn't hit by every retry at once,
+                #the wait ends early when the shipper is closing
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+                self._stopped.wait(delay * random.uniform(0.5, 1))
+
+            try:
+                with time_stage("logstash_post"):
+                    response = self.session.post(self.url, data=compressed, headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                print(f"Logstash post of {len(lines)} logs failed: {e}")
+                continue
+
+            if response.status_code < 300:
+                with self._lock:
+                    self.raw_bytes += len(body)
+                    self.sent_bytes += len(compressed)
+                return True
+
+            print(f"Logstash rejected {len(lines)} logs with status {response.status_code}")
+            if response.status_code not in RETRY_STATUSES:
+                return False
+
+        return False
+
+    def flush(self):
+        """Ship everything that is currently queued from the calling thread"""
+        while True:
+            batch = []
+            while len(batch) < self.max_events:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            self._ship(batch)
+
+    def close(self, timeout=5):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            elapsed = time.monotonic() - self._started_at
+            return {
+                "url": self.url,
+                "pending": self._queue.qsize(),
+                "submitted": self.submitted,
+                "shipped": self.shipped,
+                "batches": self.batches,
+                "retries": self.retries,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "spooled": self.spooled,
+                "spool": self.spool.stats() if self.spool is not None else None,
+                "events_per_second": round(self.shipped / elapsed, 2) if elapsed else 0,
+                "compression_ratio": round(self.raw_bytes / self.sent_bytes, 2) if self.sent_bytes else 0,
+                "last_lag_ms": round(self.last_lag * 1000, 1),
+                "max_lag_ms": round(self.max_lag * 1000, 1)
+            }
+
+    def _collect(self):
+        """Block for the first log then gather more until the batch is full or the window closes"""
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_events:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _spool(self, lines):
+        try:
+            self.spool.append(lines)
+        except OSError as e:
+            print(f"Logstash spool write failed, dropping {len(lines)} logs: {e}")
+            with self._lock:
+                self.failed += len(lines)
+            return
+
+        with self._lock:
+            self.spooled += len(lines)
+
+    def _drain_spool(self):
+        """Ship spooled logs oldest first, one attempt per chunk and at most every drain_interval after a failure"""
+        if self.spool is None or time.monotonic() < self._next_drain:
+            return
+
+        while True:
+            batch = self.spool.next_batch(self.max_events)
+            if batch is None:
+                return
+
+            segment, lines = batch
+            if not self.send(lines, max_retries=0):
+                self._next_drain = time.monotonic() + self.drain_interval
+                return
+
+            self.spool.ack(segment, len(lines))
+            with self._lock:
+                self.batches += 1
+                self.shipped += len(lines)
+
+    def _ship(self, batch):
+        lines = [line for _, line in batch]
+
+        if self.spool is not None and self.spool.has_pending():
+            #logs already spooled go first, new ones queue up behind them on disk to keep the order
+            self._spool(lines)
+            self._drain_spool()
+            return
+
+        shipped = self.send(lines)
+        if not shipped and self.spool is not None:
+            self._spool(lines)
+            self._next_drain = time.monotonic() + self.drain_interval
+            return
+
+        with self._lock:
+            if not shipped:
+                self.failed += len(batch)
+                return
+
+            #lag is how long the oldest log in the batch waited between submit and logstash accepting it
+            lag = time.monotonic() - batch[0][0]
+            self.batches += 1
+            self.shipped += len(batch)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+
+    def _run(self):
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                batch = self._collect()
+                if batch:
+                    self._ship(batch)
+                else:
+                    self._drain_spool()
+                failures = 0
+            except Exception as e:
+                #a spool that went missing or a full disk must not kill the thread, back off and try again
+                failures += 1
+                print(f"Logstash shipper failed: {e}")
+                self._stopped.wait(min(self.max_backoff, self.backoff * 2 ** (failures - 1)))
+
+
+_log_shipper = None
+_log_shipper_lock = threading.Lock()
+
+def get_log_shipper():
+    global _log_shipper
+
+    with _log_shipper_lock:
+        if _log_shipper is None:
+            _log_shipper = LogShipper(
+                os.environ.get('LOGSTASH_URL', 'http://cs412anallam.me:5044'),
+                max_events=int(os.environ.get('LOGSTASH_BATCH_MAX_EVENTS', 500)),
+                max_latency_ms=int(os.environ.get('LOGSTASH_BATCH_MAX_MS', 1000)),
+                max_pending=int(os.environ.get('LOGSTASH_QUEUE_SIZE', 10000)),
+                spool=spool_from_environment()
+            )
+            #ship whatever is still buffered when the worker shuts down
+            atexit.register(_log_shipper.close)
+
+    return _log_shipper
@@ -0,0 +1,218 @@
+import argparse
+import json
+import os
+import re
+import threading
+
+#Disk spool for logstash logs
+#When logstash can't be reached the shipper appends the logs to NDJSON segment files here instead of
+#dropping them, and drains them oldest first once it is back. Segments rotate at segment_bytes and the
+#oldest ones are evicted past max_bytes. A cursor file remembers how far into the oldest segment the
+#drain got, so a restart doesn't resend what logstash already has
+#Only one process may use a directory at a time, with several worker processes give each its own
+#LOGSTASH_SPOOL_DIR
+#
+#Usage (with the backend stopped, it drains the same directory):
+#   python log_spool.py status
+#   python log_spool.py replay [--url http://logstash:5044]
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SPOOL_DIR = os.path.join(BASE_DIR, 'logstash_spool')
+SEGMENT_PATTERN = re.compile(r'^spool-(\d{12})\.ndjson$')
+CURSOR_FILE = 'cursor.json'
+
+class LogSpool:
+    def __init__(self, directory=DEFAULT_SPOOL_DIR, segment_bytes=4 * 1024 * 1024, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        #segment currently appended to, sealed before it is drained so drained segments never change
+        self._current = None
+        self._current_size = 0
+
+        #lines of the segment being drained, loaded once rather than once per chunk
+        self._draining = None
+        self._draining_lines = []
+        self._cursor = self._load_cursor()
+
+        #counters exposed through stats()
+        self.appended = 0
+        self.drained = 0
+        self.evicted_segments = 0
+        self.evicted_lines = 0
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.directory) if SEGMENT_PATTERN.match(name))
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load_cursor(self):
+        try:
+            with open(self._path(CURSOR_FILE)) as f:
+                cursor = json.load(f)
+            return cursor["segment"], int(cursor["offset"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None, 0
+
+    def _save_cursor(self, segment, offset):
+        self._cursor = (segment, offset)
+        temp_path = self._path(CURSOR_FILE + '.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump({"segment": segment, "offset": offset}, f)
+        os.replace(temp_path, self._path(CURSOR_FILE))
+
+    def has_pending(self):
+        with self._lock:
+            return bool(self._segments())
+
+    def append(self, lines):
+        """Append log lines to the newest segment, rotating and evicting as needed"""
+        if not lines:
+            return
+
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        with self._lock:
+            if self._current is None or self._current_size >= self.segment_bytes:
+                segments = self._segments()
+                sequence = int(SEGMENT_PATTERN.match(segments[-1]).group(1)) + 1 if segments else 1
+                self._current = f"spool-{sequence:012d}.ndjson"
+                self._current_size = 0
+
+            with open(self._path(self._current), 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            self._current_size += len(data)
+            self.appended += len(lines)
+            self._evict()
+
+    def _evict(self):
+        """Drop the oldest segments until the spool fits in max_bytes, the open segment is always kept"""
+        segments = self._segments()
+        sizes = {name: os.path.getsize(self._path(name)) for name in segments}
+        total = sum(sizes.values())
+
+        for name in segments:
+            if total <= self.max_bytes or name == self._current:
+                break
+
+            with open(self._path(name), 'rb') as f:
+                lines = f.read().count(b"\n")
+            if name == self._cursor[0]:
+                lines -= self._cursor[1]
+                self._save_cursor(None, 0)
+            if name == self._draining:
+                self._draining = None
+
+            os.remove(self._path(name))
+            total -= sizes[name]
+            self.evicted_segments += 1
+            self.evicted_lines += lines
+            print(f"Logstash spool is over {self.max_bytes} bytes, evicted {name} ({lines} logs)")
+
+    def next_batch(self, max_lines=500):
+        """(segment, lines) of the oldest logs not drained yet, None when the spool is empty"""
+        with self._lock:
+            for oldest in self._segments():
+                if oldest == self._current:
+                    self._current = None
+
+                if self._draining != oldest:
+                    with open(self._path(oldest), encoding='utf-8') as f:
+                        self._draining_lines = [line for line in f.read().split("\n") if line]
+                    self._draining = oldest
+
+                offset = self._cursor[1] if self._cursor[0] == oldest else 0
+                if offset < len(self._draining_lines):
+                    return oldest, self._draining_lines[offset:offset + max_lines]
+
+                #nothing left in it (empty or already drained before a restart)
+                os.remove(self._path(oldest))
+                self._draining = None
+                self._save_cursor(None, 0)
+
+            return None
+
+    def ack(self, segment, count):
+        """Mark count lines of segment as shipped, the segment is removed once it is fully drained"""
+        with self._lock:
+            if segment != self._draining:
+                #evicted while it was being shipped
+                return
+
+            offset = (self._cursor[1] if self._cursor[0] == segment else 0) + count
+            self.drained += count
+
+            if offset < len(self._draining_lines):
+                self._save_cursor(segment, offset)
+                return
+
+            os.remove(self._path(segment))
+            self._draining = None
+            self._draining_lines = []
+            self._save_cursor(None, 0)
+
+    def stats(self):
+        with self._lock:
+            segments = self._segments()
+            return {
+                "directory": self.directory,
+                "segments": len(segments),
+                "bytes": sum(os.path.getsize(self._path(name)) for name in segments),
+                "max_bytes": self.max_bytes,
+                "appended": self.appended,
+                "drained": self.drained,
+                "evicted_segments": self.evicted_segments,
+                "evicted_lines": self.evicted_lines
+            }
+
+
+def replay_spool(spool, shipper, max_lines=500):
+    """Ship the spool oldest first until it is empty or logstash fails, returns the logs shipped"""
+    shipped = 0
+    while True:
+        batch = spool.next_batch(max_lines)
+        if batch is None:
+            return shipped
+
+        segment, lines = batch
+        if not shipper.send(lines):
+            return shipped
+
+        spool.ack(segment, len(lines))
+        shipped += len(lines)
+
+
+def spool_from_environment():
+    return LogSpool(
+        os.environ.get('LOGSTASH_SPOOL_DIR') or DEFAULT_SPOOL_DIR,
+        segment_bytes=int(os.environ.get('LOGSTASH_SPOOL_SEGMENT_MB', 4)) * 1024 * 1024,
+        max_bytes=int(os.environ.get('LOGSTASH_SPOOL_MAX_MB', 256)) * 1024 * 1024
+    )
+
+def main():
+    from log_shipper import LogShipper
+
+    parser = argparse.ArgumentParser(description="Inspect or replay the logstash spool")
+    parser.add_argument("command", choices=["status", "replay"])
+    parser.add_argument("--dir", help="spool directory, defaults to LOGSTASH_SPOOL_DIR")
+    parser.add_argument("--url", default=os.environ.get('LOGSTASH_URL', 'http://cs412anallam.me:5044'))
+    args = parser.parse_args()
+
+    if args.dir:
+        os.environ['LOGSTASH_SPOOL_DIR'] = args.dir
+    spool = spool_from_environment()
+
+    if args.command == "replay":
+        shipped = replay_spool(spool, LogShipper(args.url))
+        print(f"Replayed {shipped} logs to {args.url}")
+
+    print(json.dumps(spool.stats(), indent=4))
+
+if __name__ == "__main__":
+    main()
@@ -2,507 +2,540 @@ import psycopg2
 from dotenv import load_dotenv
 import os
 import uuid
-import requests
 from psycopg.rows import dict_row
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, execute_values
 import json
-from datetime import datetime, timedelta, timezone
-_psql_db_conn = None
-
-# Actual Database connection
-def get_db_connection():
-    global _psql_db_conn
-    
-    #reduce the amount of actual connections
-    if _psql_db_conn is None:
-        try:
+import threading
+import time
+from datetime import datetime
+from db_pool import PostgresPool
+from log_shipper import get_log_shipper
+from attacker_cache import get_attacker_session_cache
+import common_path
+from metrics import time_postgres
+
+_psql_db_pool = None
+_psql_db_pool_lock = threading.Lock()
+
+def connect_db():
+    """Open a new postgres connection, only used by the pool"""
+    conn = psycopg2.connect(
+        host='localhost',
+        database=os.environ['DB_NAME'],
+        user=os.environ['DB_USERNAME'],
+        password=os.environ['DB_PASSWORD'],
+        connect_timeout=3  # Increased timeout
+    )
+    print("Successfully connected to PostgreSQL database")
+    return conn
+
+# Actual Database connection pool, shared by every flask thread
+def get_db_pool():
+    global _psql_db_pool
+
+    with _psql_db_pool_lock:
+        if _psql_db_pool is None:
             env_path = ".env"
             load_dotenv(dotenv_path=env_path)
-            
-            _psql_db_conn = conn = psycopg2.connect(
-                host='localhost',
-                database=os.environ['DB_NAME'],
-                user=os.environ['DB_USERNAME'],
-                password=os.environ['DB_PASSWORD'],
-                connect_timeout=3  # Increased timeout
+
+            _psql_db_pool = PostgresPool(
+                connect_db,
+                min_size=int(os.environ.get('DB_POOL_MIN_SIZE', 1)),
+                max_size=int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+                acquire_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+                health_check_interval=float(os.environ.get('DB_POOL_HEALTH_CHECK_INTERVAL', 30))
             )
-            print("Successfully connected to PostgreSQL database")
-            return _psql_db_conn
-        except Exception as e:
-            print(f"Database connection error: {e}")
-            return None
-    else:
-        # Return existing connection if it's still valid
-        try:
-            # Test if connection is still alive with a simple query
-            cur = _psql_db_conn.cursor()
-            cur.execute("SELECT 1")
-            cur.close()
-            return _psql_db_conn
-        except Exception:
-            # If connection is dead, set to None and try again
-            _psql_db_conn = None
-            return get_db_connection()
+            _psql_db_pool.start()
 
-def query_db(query, args=(), one=False):
-    #cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur = get_db_connection().cursor(cursor_factory=DictCursor)
-    cur.execute(query, args)
+    return _psql_db_pool
 
-    rv = cur.fetchall()
+def db_connection():
+    """Borrow a pooled connection: `with db_connection() as conn:`, it goes back to the pool after the block"""
+    return get_db_pool().connection()
 
-    cur.close()
+def query_db(query, args=(), one=False):
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        with time_postgres("query_db"):
+            cur.execute(query, args)
+            rv = cur.fetchall()
+
+        cur.close()
     return (rv[0] if rv else None) if one else rv
 
-# Example of using the parsed data in the log_attacker_info function
 def log_attacker_information(attacker_summary):
-    """Log attacker information with enhanced user agent data to the database"""
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=DictCursor)
-
-    attacker_info = attacker_summary['attacker_info']
-    gemini = attacker_summary['gemini']
-
-    #make sure the dict is in string format
-    attacker_info['geolocation'] = json.dumps(attacker_info['geolocation'])
-
-    attacker_id = update_attacker(attacker_info)
-
-    session_id = update_honey_session(attacker_id)
-    attack_command = {
-        "session_id": session_id,
-        "gemini": gemini,
-        "attacker_info": attacker_info,
-        "request_details": attacker_summary['request_details']
-    }
-
-    #update the attack table with the attack command / request information
-    update_attack_command(attack_command)
-
-    #generate the json for the log
-    attacker_json = generate_attacker_json(attack_command, attacker_id)
-
-    #send to logstash, can have a response if the connection isn't working
-    send_log_to_logstash("http://cs412anallam.me", attacker_json)
-
-    #close db connection
-    conn.commit()
-    cur.close()
-
-
-def update_attacker(attacker_info):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=DictCursor)
-
-    # Check if this attacker has been seen before
-    cur.execute(
-        "SELECT * FROM Attacker WHERE ip_address = %s AND device_fingerprint = %s",
-        (attacker_info["ip_address"], attacker_info["device_fingerprint"])
+    """Log one attacker summary, the capture workers write through log_attacker_batch and so does this"""
+    return log_attacker_batch([attacker_summary])
+
+def attacker_identity_row(attacker_info):
+    """Arguments for the resolve_attacker_session function (see init_db.py)"""
+    return (
+        attacker_info["ip_address"],
+        attacker_info["user_agent"],
+        attacker_info["device_fingerprint"],
+        attacker_info["geolocation"],
+        attacker_info["browser"],
+        attacker_info["os"],
+        attacker_info["device_type"],
+        attacker_info["is_bot"]
     )
 
-    exists = cur.fetchone()
-    attacker_id = ""
-    if exists:
-        # Update last_seen timestamp and other data for returning attackers
-        attacker_id = exists['attacker_id']
-        cur.execute(
-            """
-            UPDATE Attacker SET 
-                last_seen = CURRENT_TIMESTAMP, 
-                user_agent = %s,
-                browser = %s,
-                os = %s,
-                device_type = %s,
-                is_bot = %s
-            WHERE ip_address = %s AND device_fingerprint = %s
-            """,
-            (
-                attacker_info["user_agent"],
-                attacker_info["browser"],
-                attacker_info["os"],
-                attacker_info["device_type"],
-                attacker_info["is_bot"],
-                attacker_info["ip_address"],
-                attacker_info["device_fingerprint"]
-            )
-        )
-    else:
-        # Insert new attacker record with enhanced data
-        cur.execute(
+def resolve_attacker_sessions(cur, attacker_infos):
+    """Upsert every attacker and resolve its session in one statement, returns {(ip, fingerprint): (attacker_id, session_id)}"""
+    #upserted in (ip, fingerprint) order so concurrent batches from several workers lock Attacker rows in
+    #the same order and can't deadlock each other
+    attacker_infos = sorted(attacker_infos, key=lambda info: (str(info["ip_address"]), str(info["device_fingerprint"])))
+    with time_postgres("resolve_attacker_sessions"):
+        rows = execute_values(
+            cur,
             """
-            INSERT INTO Attacker 
-            (ip_address, user_agent, device_fingerprint, geolocation, browser, os, device_type, is_bot) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING attacker_id;
+            SELECT v.ip_address, v.device_fingerprint, r.attacker_id, r.session_id
+            FROM (VALUES %s) AS v(ip_address, user_agent, device_fingerprint, geolocation, browser, os, device_type, is_bot)
+            CROSS JOIN LATERAL resolve_attacker_session(
+                v.ip_address, v.user_agent, v.device_fingerprint, v.geolocation,
+                v.browser, v.os, v.device_type, v.is_bot
+            ) r;
             """,
-            (
-                attacker_info["ip_address"],
-                attacker_info["user_agent"],
-                attacker_info["device_fingerprint"],
-                attacker_info["geolocation"],
-                attacker_info["browser"],
-                attacker_info["os"],
-                attacker_info["device_type"],
-                attacker_info["is_bot"]
-            )
+            [attacker_identity_row(attacker_info) for attacker_info in attacker_infos],
+            template="(%s, %s, %s, %s, %s, %s, %s, %s::boolean)",
+            page_size=len(attacker_infos) or 1,
+            fetch=True
         )
 
-        attacker_id = cur.fetchone()
-        attacker_id = attacker_id['attacker_id']
-    conn.commit()
-    cur.close()
-    return attacker_id
-
-def update_honey_session(attacker_id):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=DictCursor)
+    return {(row[0], row[1]): (row[2], row[3]) for row in rows}
 
-    print("Attacker id:", attacker_id)
-
-    # Check if this attacker has been seen before
-    cur.execute(
-        "SELECT * FROM Honeypot_Session where attacker_id = %s ORDER BY last_seen DESC NULLS LAST LIMIT 1",
-        (str(attacker_id), )
-    )
-
-    exists = cur.fetchone()
-    session_id = ""
-    current_time_utc = datetime.now(timezone.utc)
-    # print(current_time_utc)
-    # print(current_time_utc - timedelta(minutes=15))
-    # another_time = current_time_utc - timedelta(minutes=5)
-    # print(timedelta(minutes=10))
-    # print(current_time_utc - another_time >= timedelta(minutes=10))
-    # last_dt = parser("2025-03-21 23:14:55.120000")
-    #conversion
-    # last_dt = datetime.strptime("2025-03-21 23:14:55.120000", "%Y-%m-%d %H:%M:%S.%f")
-
-    # print(last_dt)
-
-    #check to see if it's in the 15 minute time window
-    if exists:
-        #make the time from psql timezone aware
-        last_seen = datetime.strptime(str(exists["last_seen"]), "%Y-%m-%d %H:%M:%S.%f").replace(tzinfo=timezone.utc)
-        # print(current_time_utc)
-        print("Last seen:", last_seen)
-        time_diff = current_time_utc - last_seen
-        print(time_diff)
-        # print(time_diff >= timedelta(minutes=15))
-
-        #False if it goes past 15 minutes
-        exists = exists if current_time_utc - last_seen <= timedelta(minutes=15) else False
-
-
-    if exists:
-        # if datetime.now(tzinfo=datetime.timezone.utc) - exists['last_seen'] < 15 : 
-        # Update last_seen timestamp
-        session_id = exists["session_id"]
-        print("The session id is", str(session_id))
-        cur.execute(
-            """
-            UPDATE Honeypot_Session SET 
-                last_seen = CURRENT_TIMESTAMP
-            WHERE session_id = %s;
-            """,
-            (str(session_id), ) #funny, apparently had to make it into a tuple explicitly by adding the comma XD
-        )
-    else:
-        cur.execute(
+def touch_attacker_sessions(cur, hits):
+    """Refresh attackers and sessions the cache already resolved, writes only, in one statement.
+    hits is [(attacker_info, attacker_id, session_id)], returns the session ids that still exist"""
+    with time_postgres("touch_attacker_sessions"):
+        rows = execute_values(
+            cur,
             """
-            INSERT INTO Honeypot_Session 
-            (attacker_id) 
-            VALUES (%s) RETURNING session_id;
+            WITH v(attacker_id, session_id, user_agent, browser, os, device_type, is_bot) AS (VALUES %s),
+            touched_attackers AS (
+                UPDATE Attacker AS a SET
+                    last_seen = CURRENT_TIMESTAMP,
+                    user_agent = v.user_agent,
+                    browser = v.browser,
+                    os = v.os,
+                    device_type = v.device_type,
+                    is_bot = v.is_bot
+                FROM v
+                WHERE a.attacker_id = v.attacker_id
+            )
+            UPDATE Honeypot_Session AS hs SET last_seen = CURRENT_TIMESTAMP
+            FROM v
+            WHERE hs.session_id = v.session_id AND hs.attacker_id = v.attacker_id
+            RETURNING hs.session_id;
             """,
-            (str(attacker_id), )#nvm it actually does need to be a tuple lol
+            [
+                (attacker_id, session_id, attacker_info["user_agent"], attacker_info["browser"],
+                 attacker_info["os"], attacker_info["device_type"], attacker_info["is_bot"])
+                for attacker_info, attacker_id, session_id in hits
+            ],
+            template="(%s::integer, %s::integer, %s, %s, %s, %s, %s::boolean)",
+            page_size=len(hits) or 1,
+            fetch=True
         )
 
-        session_id = cur.fetchone()
-        session_id = session_id['session_id']
-    conn.commit()
-    cur.close()
-    return session_id
-
-def update_attack_command(attacker_command):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=DictCursor)
-
+    return {row[0] for row in rows}
+
+def resolve_attacker_sessions_cached(cur, attacker_infos):
+    """resolve_attacker_sessions for the attackers the session cache doesn't know, the rest are only touched"""
+    cache = get_attacker_session_cache()
+    hits = []
+    misses = []
+
+    for attacker_info in attacker_infos:
+        cached = cache.lookup(attacker_info["ip_address"], attacker_info["device_fingerprint"])
+        if cached is None:
+            misses.append(attacker_info)
+        else:
+            hits.append((attacker_info, cached[0], cached[1]))
+
+    sessions = {}
+    if hits:
+        existing = touch_attacker_sessions(cur, hits)
+        for attacker_info, attacker_id, session_id in hits:
+            key = (attacker_info["ip_address"], attacker_info["device_fingerprint"])
+            if session_id in existing:
+                sessions[key] = (attacker_id, session_id)
+            else:
+                #the rows are gone (database reset), resolve it the slow way
+                cache.forget(*key)
+                misses.append(attacker_info)
+
+    if misses:
+        sessions.update(resolve_attacker_sessions(cur, misses))
+
+    return sessions
+
+def attack_command_row(attacker_command):
+    """Column values for one Attack row in the batched insert"""
     attacker_info = attacker_command['attacker_info']
     gemini = attacker_command['gemini']
     request_details = attacker_command['request_details']
 
+    return (
+        str(attacker_command['session_id']),
+        request_details['path'],
+        attacker_info['device_type'],
+        gemini['technique'],
+        gemini['iocs'],
+        gemini['description'],
+        attacker_command.get('capture_id'),
+        attacker_command.get('count', 1),
+        attacker_command.get('first_ts'),
+        attacker_command.get('last_ts')
+    )
 
-    #insert the information
-    cur.execute(
-            """
-            INSERT INTO Attack 
-            (session_id, request_url, interaction_type, owasp_technique, ioc, gemini_response) 
-            VALUES (%s, %s, %s, %s, %s, %s);
-            """,
-            (
-                str(attacker_command['session_id']),
-                request_details['path'],
-                attacker_info['device_type'],
-                gemini['technique'],
-                gemini['iocs'],
-                gemini['description']
+def log_attacker_batch(attacker_summaries):
+    """Persist a batch of attacker summaries in a single transaction
+
+    Every distinct attacker in the batch is upserted and gets its session resolved in one statement (attackers
+    the session cache knows are only touched), then every attack row goes in with one multi-row INSERT
+    """
+    attackers = {}
+    for attacker_summary in attacker_summaries:
+        attacker_info = attacker_summary['attacker_info']
+
+        #make sure the dict is in string format
+        if not isinstance(attacker_info['geolocation'], str):
+            attacker_info['geolocation'] = json.dumps(attacker_info['geolocation'])
+
+        attackers[(attacker_info["ip_address"], attacker_info["device_fingerprint"])] = attacker_info
+
+    attack_commands = []
+
+    #sessions are cached as last seen at the start of the transaction, never later than postgres has them
+    started = time.time()
+
+    #the pool rolls the transaction back if anything in the block fails
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+
+        sessions = resolve_attacker_sessions_cached(cur, list(attackers.values()))
+
+        for attacker_summary in attacker_summaries:
+            attacker_info = attacker_summary['attacker_info']
+            attacker_id, session_id = sessions[(attacker_info["ip_address"], attacker_info["device_fingerprint"])]
+
+            attack_command = {
+                "session_id": session_id,
+                "gemini": attacker_summary['gemini'],
+                "attacker_info": attacker_info,
+                "request_details": attacker_summary['request_details'],
+                "capture_id": attacker_summary.get('capture_id'),
+                #summarized repeats from the flood suppressor
+                "count": attacker_summary.get('count', 1),
+                "first_ts": attacker_summary.get('first_ts'),
+                "last_ts": attacker_summary.get('last_ts')
+            }
+            attack_commands.append((attack_command, attacker_id))
+
+        with time_postgres("insert_attacks"):
+            execute_values(
+                cur,
+                """
+                INSERT INTO Attack 
+                (session_id, request_url, interaction_type, owasp_technique, ioc, gemini_response, capture_id, count, first_ts, last_ts) 
+                VALUES %s;
+                """,
+                [attack_command_row(attack_command) for attack_command, _ in attack_commands],
+                page_size=len(attack_commands) or 1
             )
-    )
 
-    # print("Insert successful", cur.fetchone())
-    conn.commit()
-    cur.close()
+        with time_postgres("commit"):
+            conn.commit()
+        cur.close()
+
+    #only committed sessions go in the cache
+    cache = get_attacker_session_cache()
+    for (ip_address, device_fingerprint), (attacker_id, session_id) in sessions.items():
+        cache.remember(ip_address, device_fingerprint, attacker_id, session_id, started)
+
+    for attack_command, attacker_id in attack_commands:
+        attacker_json = generate_attacker_json(attack_command, attacker_id)
+        send_log_to_logstash(attacker_json)
+
+    return len(attack_commands)
+
+def upgrade_attack_verdict(capture_id, gemini):
+    """Replace the fallback verdict of an attack with the late gemini answer, returns the rows updated
+    (0 when the batch writer hasn't written the attack yet)"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        with time_postgres("upgrade_attack_verdict"):
+            cur.execute("""
+                UPDATE Attack
+                SET owasp_technique = %s, ioc = %s, gemini_response = %s
+                WHERE capture_id = %s
+            """, (gemini['technique'], gemini['iocs'], gemini['description'], capture_id))
+        updated = cur.rowcount
+        conn.commit()
+        cur.close()
+
+    return updated
 
 #aggregate functions for the soc admin 
 # -- attack table
 def aggregate_attack_by_type(category="owasp_technique"):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=DictCursor)
-
-    curr_categories = ["attack_id", 
-                       "session_id", 
-                       "request_url", 
-                       "interaction_type", 
-                       "owasp_technique", 
-                       "ioc", 
-                       "gemini_response", 
-                       "timestamp"]
-
-    if category not in curr_categories:
-        raise Exception("Incorrect Column")
-    
-    # Customize query based on category
-    if category == "owasp_technique":
-        # Exclude "No Attack Vector" and "No attack Vector"
-        query_db = """
-            SELECT {0}, COUNT({0}) as count
-            FROM attack
-            WHERE {0} IS NOT NULL AND {0} NOT IN ('No Attack Vector', 'No attack vector')
-            GROUP BY {0}
-            ORDER BY COUNT({0}) DESC
-            LIMIT 5
-        """.format(category)
-    else:
-        # Standard query with ordering by count and null check
-        query_db = """
-            SELECT {0}, COUNT({0}) as count
-            FROM attack
-            WHERE {0} IS NOT NULL
-            GROUP BY {0}
-            ORDER BY COUNT({0}) DESC
-            LIMIT 5
-        """.format(category)
-    
-    # Execute the query
-    cur.execute(query_db)
-
-    res = cur.fetchall()
-
-    if res:
-        res = [dict(row) for row in res]
-
-    print(res)
-    conn.commit()
-    cur.close()
-    return res
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+
+        curr_categories = ["attack_id", 
+                           "session_id", 
+                           "request_url", 
+                           "interaction_type", 
+                           "owasp_technique", 
+                           "ioc", 
+                           "gemini_response", 
+                           "timestamp"]
+
+        if category not in curr_categories:
+            raise Exception("Incorrect Column")
+        
+        #summarized flood rows stand for count attacks
+        # Customize query based on category
+        if category == "owasp_technique":
+            # Exclude "No Attack Vector" and "No attack Vector"
+            query_db = """
+                SELECT {0}, SUM(attack.count) as count
+                FROM attack
+                WHERE {0} IS NOT NULL AND {0} NOT IN ('No Attack Vector', 'No attack vector')
+                GROUP BY {0}
+                ORDER BY SUM(attack.count) DESC
+                LIMIT 5
+            """.format(category)
+        else:
+            # Standard query with ordering by count and null check
+            query_db = """
+                SELECT {0}, SUM(attack.count) as count
+                FROM attack
+                WHERE {0} IS NOT NULL
+                GROUP BY {0}
+                ORDER BY SUM(attack.count) DESC
+                LIMIT 5
+            """.format(category)
+        
+        # Execute the query
+        with time_postgres("aggregate_attack_by_type"):
+            cur.execute(query_db)
+
+        res = cur.fetchall()
+
+        if res:
+            res = [dict(row) for row in res]
+
+        print(res)
+        conn.commit()
+        cur.close()
+        return res
 
 # -- attacker table
 def aggregate_attacker_by_type(category="request_url", selection=""):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=DictCursor)
-
-    curr_categories = ["attacker_id",
-                       "ip_address",
-                       "user_agent",
-                       "device_fingerprint",
-                       "geolocation",
-                       "browser",
-                       "os",
-                       "device_type",
-                       "is_bot",
-                       "last_seen",
-                       "first_seen",
-                       "owasp_technique",
-                       "request_url"]
-
-    if category not in curr_categories:
-        raise Exception("Incorrect Column")
-
-    # Customize query based on category
-    if category == "ip_address":
-        # Exclude localhost and 127.0.0.1
-        query_db = """
-            SELECT {0}, COUNT({0}) as count
-            FROM attacker
-            WHERE {0} IS NOT NULL AND {0} NOT IN ('127.0.0.1', 'localhost', 'Other', 'Unknown', 'unknown')
-            GROUP BY {0}
-            ORDER BY COUNT({0}) DESC
-            LIMIT 5
-        """.format(category)
-    elif category == "os":
-        # Include Other & Unknown for OS
-        query_db = """
-            SELECT {0}, COUNT({0}) as count
-            FROM attacker
-            WHERE {0} IS NOT NULL
-            GROUP BY {0}
-            ORDER BY COUNT({0}) DESC
-            LIMIT 5
-        """.format(category)
-    else:
-        # Standard query with ordering by count and null/unkown/other check
-        query_db = """
-            SELECT {0}, COUNT({0}) as count
-            FROM attacker
-            WHERE {0} IS NOT NULL AND {0} NOT IN ('Other', 'other', 'Unknown', 'unknown')
-            GROUP BY {0}
-            ORDER BY COUNT({0}) DESC
-            LIMIT 5
-        """.format(category)
-
-    # Execute the query
-    cur.execute(query_db)
-
-    res = cur.fetchall()
-
-    if res:
-        res = [dict(row) for row in res]
-
-    print(res)
-    conn.commit()
-    cur.close()
-    return res
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+
+        curr_categories = ["attacker_id",
+                           "ip_address",
+                           "user_agent",
+                           "device_fingerprint",
+                           "geolocation",
+                           "browser",
+                           "os",
+                           "device_type",
+                           "is_bot",
+                           "last_seen",
+                           "first_seen",
+                           "owasp_technique",
+                           "request_url"]
+
+        if category not in curr_categories:
+            raise Exception("Incorrect Column")
+
+        # Customize query based on category
+        if category == "ip_address":
+            # Exclude localhost and 127.0.0.1
+            query_db = """
+                SELECT {0}, COUNT({0}) as count
+                FROM attacker
+                WHERE {0} IS NOT NULL AND {0} NOT IN ('127.0.0.1', 'localhost', 'Other', 'Unknown', 'unknown')
+                GROUP BY {0}
+                ORDER BY COUNT({0}) DESC
+                LIMIT 5
+            """.format(category)
+        elif category == "os":
+            # Include Other & Unknown for OS
+            query_db = """
+                SELECT {0}, COUNT({0}) as count
+                FROM attacker
+                WHERE {0} IS NOT NULL
+                GROUP BY {0}
+                ORDER BY COUNT({0}) DESC
+                LIMIT 5
+            """.format(category)
+        else:
+            # Standard query with ordering by count and null/unkown/other check
+            query_db = """
+                SELECT {0}, COUNT({0}) as count
+                FROM attacker
+                WHERE {0} IS NOT NULL AND {0} NOT IN ('Other', 'other', 'Unknown', 'unknown')
+                GROUP BY {0}
+                ORDER BY COUNT({0}) DESC
+                LIMIT 5
+            """.format(category)
+
+        # Execute the query
+        with time_postgres("aggregate_attacker_by_type"):
+            cur.execute(query_db)
+
+        res = cur.fetchall()
+
+        if res:
+            res = [dict(row) for row in res]
+
+        print(res)
+        conn.commit()
+        cur.close()
+        return res
 
 
 def total_attacker_count():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=DictCursor)
-    
-    query_db = "Select count(*) from attacker;"
-    cur.execute(
-        query_db
-    )
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        
+        query_db = "Select count(*) from attacker;"
+        with time_postgres("total_attacker_count"):
+            cur.execute(
+                query_db
+            )
 
-    res = cur.fetchall()
+        res = cur.fetchall()
 
-    if res:
-        res = [dict(row) for row in res]
+        if res:
+            res = [dict(row) for row in res]
 
-    print(res)
-    conn.commit()
-    cur.close()
-    return res
+        print(res)
+        conn.commit()
+        cur.close()
+        return res
 
 def attacker_engagement(attacker_id=None):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=DictCursor)
-    query_wrap = "SELECT * from ({}) ORDER BY day ASC;"
-    query_db = """
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        query_wrap = "SELECT * from ({}) ORDER BY day ASC;"
+        query_db = """
 
-    SELECT
-        DATE(hs.first_seen) AS day,
-        hs.attacker_id,
-        COUNT(*) AS occurrences
-    FROM attacker inner join honeypot_session hs on attacker.attacker_id = hs.attacker_id
+        SELECT
+            DATE(hs.first_seen) AS day,
+            hs.attacker_id,
+            COUNT(*) AS occurrences
+        FROM attacker inner join honeypot_session hs on attacker.attacker_id = hs.attacker_id
 
-    """
+        """
 
-    params = ()
+        params = ()
 
-    if attacker_id:
-        query_db += " WHERE hs.attacker_id = %s "
-        params = (attacker_id,)
+        if attacker_id:
+            query_db += " WHERE hs.attacker_id = %s "
+            params = (attacker_id,)
 
-    query_db += """
-        GROUP BY day, hs.attacker_id
-        ORDER BY day DESC, hs.attacker_id LIMIT 5;
-    """
+        query_db += """
+            GROUP BY day, hs.attacker_id
+            ORDER BY day DESC, hs.attacker_id LIMIT 5;
+        """
 
-    query_wrap.format(query_db)
+        query_wrap.format(query_db)
 
-    cur.execute(
-        query_wrap,
-        params
-    )
+        with time_postgres("attacker_engagement"):
+            cur.execute(
+                query_wrap,
+                params
+            )
 
-    res = cur.fetchall()
+        res = cur.fetchall()
 
-    if res:
-        res = [dict(row) for row in res]
+        if res:
+            res = [dict(row) for row in res]
 
-    print(res)
-    conn.commit()
-    cur.close()
-    return res
+        print(res)
+        conn.commit()
+        cur.close()
+        return res
 
 def total_attacker_engagement(attacker_id=None):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=DictCursor)
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
 
-    # query_wrap = "SELECT * from ({}) ORDER BY day ASC;".format(query_db)
-    
-    query_db = """
+        # query_wrap = "SELECT * from ({}) ORDER BY day ASC;".format(query_db)
+        
+        query_db = """
 
-    SELECT
-        DATE(hs.first_seen) AS day,
-        COUNT(*) AS occurrences
-    FROM attacker inner join honeypot_session hs on attacker.attacker_id = hs.attacker_id
+        SELECT
+            DATE(hs.first_seen) AS day,
+            COUNT(*) AS occurrences
+        FROM attacker inner join honeypot_session hs on attacker.attacker_id = hs.attacker_id
 
-    """
+        """
 
-    params = ()
+        params = ()
 
-    if attacker_id:
-        query_db += "WHERE  hs.attacker_id = %s "
-        params = (attacker_id,)
-    
-    query_db += """
-        GROUP BY day
-        ORDER BY day DESC LIMIT 5
-    """
+        if attacker_id:
+            query_db += "WHERE  hs.attacker_id = %s "
+            params = (attacker_id,)
+        
+        query_db += """
+            GROUP BY day
+            ORDER BY day DESC LIMIT 5
+        """
 
-    # query_wrap.format(query_db)
-    query_wrap = "SELECT * from ({}) ORDER BY day ASC;".format(query_db)
+        # query_wrap.format(query_db)
+        query_wrap = "SELECT * from ({}) ORDER BY day ASC;".format(query_db)
 
-    print(query_wrap)
+        print(query_wrap)
 
-    cur.execute(
-        query_wrap,
-        params
-    )
+        with time_postgres("total_attacker_engagement"):
+            cur.execute(
+                query_wrap,
+                params
+            )
 
-    res = cur.fetchall()
+        res = cur.fetchall()
 
-    if res:
-        res = [dict(row) for row in res]
+        if res:
+            res = [dict(row) for row in res]
 
-    print(res)
-    conn.commit()
-    cur.close()
-    return res
+        print(res)
+        conn.commit()
+        cur.close()
+        return res
 
 def total_report_count():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=DictCursor)
-    query_db = """
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        query_db = """
 
-    SELECT
-        COUNT(*)
-    FROM soc_dashboard;
+        SELECT
+            COUNT(*)
+        FROM soc_dashboard;
 
-    """
+        """
 
-    cur.execute(
-        query_db
-    )
+        with time_postgres("total_report_count"):
+            cur.execute(
+                query_db
+            )
 
-    res = cur.fetchone()
+        res = cur.fetchone()
 
-    if res:
-        res = dict(res)
+        if res:
+            res = dict(res)
 
-    print(res)
-    conn.commit()
-    cur.close()
-    return res
+        print(res)
+        conn.commit()
+        cur.close()
+        return res
 
 def generate_attacker_json(attack_command, attacker_id):
 
@@ -524,20 +557,15 @@ def generate_attacker_json(attack_command, attacker_id):
         "log-id": str(uuid.uuid4()),  # Generate a unique log ID
         "geolocation" : attack_command.get("attacker_info").get("geolocation"),
         "port" : "6969" if attack_command.get("gemini").get("technique") == "Security Misconfiguration" else "",
-        "attacker-id" : attacker_id
+        "attacker-id" : attacker_id,
+        "count": attack_command.get("count", 1),
+        "first-ts": str(attack_command["first_ts"]) if attack_command.get("first_ts") else None,
+        "last-ts": str(attack_command["last_ts"]) if attack_command.get("last_ts") else None
     }
 
-    return json.dumps(attacker_log, indent=4)
+    #compact, one line per log in the NDJSON batches
+    return json.dumps(attacker_log)
 
-def send_log_to_logstash(elk_url, attacker_json):
-    index_name = "attacker_logs"
-    url = f"{elk_url}:5044"
-    headers = {
-        "Content-Type": "application/json"
-    }
-    try:
-        response = requests.post(url, headers=headers, data=attacker_json, timeout=3)
-        return response
-    except Exception as e: 
-        print(e)
-        return None
+def send_log_to_logstash(attacker_json):
+    """Queue the log for the background shipper (LOGSTASH_URL), never waits on logstash"""
+    return get_log_shipper().submit(attacker_json)
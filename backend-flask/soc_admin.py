@@ -1,7 +1,7 @@
 
 # from __main__ import app
 from flask import jsonify, request
-from postgres_db import get_db_connection, aggregate_attack_by_type, aggregate_attacker_by_type, total_attacker_engagement, attacker_engagement, total_attacker_count, total_report_count
+from postgres_db import db_connection, aggregate_attack_by_type, aggregate_attacker_by_type, total_attacker_engagement, attacker_engagement, total_attacker_count, total_report_count
 
 #API Endpoints for SOC Admin frontend
 def register_soc_admin_routes(app):
@@ -10,40 +10,39 @@ def register_soc_admin_routes(app):
         try:
             # Connect to the database - use your PostgreSQL connection 
             # (You might be using SQLAlchemy or psycopg2)
-            db = get_db_connection()  # Your database connection function
-            cursor = db.cursor()
+            with db_connection() as db:  # Borrow a pooled connection
+                cursor = db.cursor()
             
-            # PostgreSQL-specific query to extract country from JSON
-            query = """
-            SELECT 
-                (geolocation::json->>'country') as country_code,
-                COUNT(*) as activity_count
-            FROM 
-                attacker
-            WHERE 
-                geolocation IS NOT NULL
-            GROUP BY 
-                country_code
-            ORDER BY 
-                activity_count DESC
-            """
+                # PostgreSQL-specific query to extract country from JSON
+                query = """
+                SELECT 
+                    (geolocation::json->>'country') as country_code,
+                    COUNT(*) as activity_count
+                FROM 
+                    attacker
+                WHERE 
+                    geolocation IS NOT NULL
+                GROUP BY 
+                    country_code
+                ORDER BY 
+                    activity_count DESC
+                """
             
-            # Execute the query
-            cursor.execute(query)
-            result = cursor.fetchall()
+                # Execute the query
+                cursor.execute(query)
+                result = cursor.fetchall()
             
-            # Convert the result to a dictionary with country code as key and count as value
-            country_data = {}
-            if result:
-                for row in result:
-                    country_code = row[0]  # First column is country_code
-                    count = row[1]         # Second column is activity_count
+                # Convert the result to a dictionary with country code as key and count as value
+                country_data = {}
+                if result:
+                    for row in result:
+                        country_code = row[0]  # First column is country_code
+                        count = row[1]         # Second column is activity_count
                     
-                    if country_code:  # Ensure we have a valid country code
-                        country_data[country_code] = count
+                        if country_code:  # Ensure we have a valid country code
+                            country_data[country_code] = count
             
-            cursor.close()
-            db.close()
+                cursor.close()
             
             return jsonify(country_data)
         
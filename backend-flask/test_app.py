@@ -5,6 +5,13 @@ import json
 import base64
 import hashlib
 import sqlite3
+from concurrent.futures import Future
+
+def gemini_answer(text):
+    """Already resolved future like the gemini batcher hands out"""
+    future = Future()
+    future.set_result(text)
+    return future
 
 @pytest.fixture
 def client():
@@ -28,7 +35,7 @@ def mock_attacker_summary():
 
 @pytest.fixture
 def mock_log_attacker():
-    with patch('honeypot_endpoints.log_attacker_information') as mock:
+    with patch('honeypot_endpoints.queue_attacker_information') as mock:
         yield mock
 
 @pytest.fixture
@@ -36,6 +43,44 @@ def mock_memory_db():
     with patch('honeypot_endpoints.get_memory_db') as mock:
         yield mock
 
+@pytest.fixture(autouse=True)
+def verdict_cache():
+    """Keep the gemini verdict cache in memory and empty for every test."""
+    from verdict_cache import VerdictCache
+    cache = VerdictCache(persistent=False)
+    with patch('capture_pipeline.get_verdict_cache', return_value=cache):
+        yield cache
+
+@pytest.fixture(autouse=True)
+def attacker_cache():
+    """Empty attacker session cache for every test."""
+    from attacker_cache import AttackerSessionCache
+    cache = AttackerSessionCache()
+    with patch('postgres_db.get_attacker_session_cache', return_value=cache):
+        yield cache
+
+@pytest.fixture(autouse=True)
+def no_local_classifier():
+    """Send every payload past the local classifier unless a test opts in."""
+    with patch('capture_pipeline.local_verdict', return_value=None) as mock:
+        yield mock
+
+@pytest.fixture(autouse=True)
+def gemini_governor():
+    """Fresh governor per test without the production rate limits."""
+    from gemini_governor import GeminiGovernor
+    governor = GeminiGovernor(requests_per_minute=100000, tokens_per_minute=10**9)
+    with patch('gemini.get_gemini_governor', return_value=governor):
+        yield governor
+
+@pytest.fixture(autouse=True)
+def decoy_result_cache():
+    """Empty decoy read result cache for every test."""
+    from decoy_cache import DecoyResultCache
+    cache = DecoyResultCache()
+    with patch('honeypot_endpoints.get_decoy_result_cache', return_value=cache):
+        yield cache
+
 @pytest.fixture(autouse=True)
 def mock_gemini():
     with patch('gemini.init_gemini') as mock_init:
@@ -102,15 +147,15 @@ def test_debug_db(mock_get_memory_db, client):
     assert json_data['user_count'] == 3
     assert json_data['sample_user'] == {'id': 1, 'username': 'testuser', 'email': 'test@example.com'}
 
-@patch('app.get_db_connection')
+@patch('app.db_connection')
 @patch('app.example_ua_queries')
-def test_debug_attackers(mock_example_ua_queries, mock_get_db_connection, client):
+def test_debug_attackers(mock_example_ua_queries, mock_db_connection, client):
     """Test the /api/debug/attackers endpoint."""
     # Set up mock connection and cursor
     mock_conn = MagicMock()
     mock_cursor = MagicMock()
     mock_conn.cursor.return_value = mock_cursor
-    mock_get_db_connection.return_value = mock_conn
+    mock_db_connection.return_value.__enter__.return_value = mock_conn
     
     # Mock the query results for both queries
     mock_attackers = [
@@ -149,11 +194,11 @@ def test_debug_attackers(mock_example_ua_queries, mock_get_db_connection, client
     assert json_data['examples'] == mock_examples
     assert json_data['attack_information'] == mock_attacks
 
-@patch('app.get_db_connection')
-def test_debug_attackers_exception(mock_get_db_connection, client):
+@patch('app.db_connection')
+def test_debug_attackers_exception(mock_db_connection, client):
     """Test the /api/debug/attackers endpoint when an exception occurs."""
     # Mock the connection to raise an exception
-    mock_get_db_connection.side_effect = Exception("Database connection error")
+    mock_db_connection.side_effect = Exception("Database connection error")
     
     # Make the request
     response = client.get('/api/debug/attackers')
@@ -606,7 +651,7 @@ def test_login_database_error(client, mock_attacker_info, mock_attacker_summary,
 
 @patch('honeypot_endpoints.extract_attacker_info')
 @patch('honeypot_endpoints.get_attacker_summary')
-@patch('honeypot_endpoints.log_attacker_information')
+@patch('honeypot_endpoints.queue_attacker_information')
 @patch('honeypot_endpoints.get_memory_db')
 def test_forum_comments_sql_injection(mock_memory_db, mock_log_attacker, mock_attacker_summary, mock_attacker_info, client):
     """Test SQL injection detection in forum comments endpoint."""
@@ -654,7 +699,7 @@ def test_forum_comments_sql_injection(mock_memory_db, mock_log_attacker, mock_at
 
 @patch('honeypot_endpoints.extract_attacker_info')
 @patch('honeypot_endpoints.get_attacker_summary')
-@patch('honeypot_endpoints.log_attacker_information')
+@patch('honeypot_endpoints.queue_attacker_information')
 @patch('honeypot_endpoints.get_memory_db')
 def test_security_questions_endpoint(mock_memory_db, mock_log_attacker, mock_attacker_summary, mock_attacker_info, client):
     """Test the security questions endpoint functionality."""
@@ -691,14 +736,14 @@ def test_security_questions_endpoint(mock_memory_db, mock_log_attacker, mock_att
     assert json_data["question_id"] == 1
     assert json_data["question_text"] == "What is your mother's maiden name?"
 
-@patch('soc_admin.get_db_connection')
-def test_get_country_activity(mock_get_db_connection, client):
+@patch('soc_admin.db_connection')
+def test_get_country_activity(mock_db_connection, client):
     """Test the geolocation country activity endpoint."""
     # Set up mock connection and cursor
     mock_conn = MagicMock()
     mock_cursor = MagicMock()
     mock_conn.cursor.return_value = mock_cursor
-    mock_get_db_connection.return_value = mock_conn
+    mock_db_connection.return_value.__enter__.return_value = mock_conn
     
     # Mock the query results for geolocation data
     mock_geolocation_data = [
@@ -779,11 +824,11 @@ def test_analyze_invalid_content_type(client):
     # Check error response - should return 415 Unsupported Media Type
     assert response.status_code == 415
 
-@patch('app.get_db_connection')
-def test_soc_admin_database_error(mock_get_db_connection, client):
+@patch('postgres_db.db_connection')
+def test_soc_admin_database_error(mock_db_connection, client):
     """Test error handling in SOC admin endpoints when database connection fails."""
     # Mock the connection to raise an exception
-    mock_get_db_connection.side_effect = Exception("Database connection refused")
+    mock_db_connection.side_effect = Exception("Database connection refused")
     
     # Test multiple endpoints
     endpoints = [
@@ -804,7 +849,7 @@ def test_soc_admin_database_error(mock_get_db_connection, client):
 
 @patch('honeypot_endpoints.extract_attacker_info')
 @patch('honeypot_endpoints.get_attacker_summary')
-@patch('honeypot_endpoints.log_attacker_information')
+@patch('honeypot_endpoints.queue_attacker_information')
 @patch('honeypot_endpoints.get_memory_db')
 def test_change_password_missing_fields(mock_memory_db, mock_log_attacker, mock_attacker_summary, mock_attacker_info, client):
     """Test the change_password endpoint with missing fields."""
@@ -907,60 +952,88 @@ def test_analyze_payload_2_format(client):
 
 @patch('os.environ', {'DB_NAME': 'testdb', 'DB_USERNAME': 'user', 'DB_PASSWORD': 'pass'})
 @patch('psycopg2.connect')
-def test_get_db_connection_success(mock_connect, client):
-    """Test successful database connection with simpler approach."""
-    # Setup mock connection
-    mock_conn = MagicMock()
-    mock_connect.return_value = mock_conn
-    
-    # Import and test the function
-    from postgres_db import get_db_connection
-    
-    # Force reset of existing connection if any
+def test_db_connection_success(mock_connect, client):
+    """Test borrowing a pooled connection and handing it back."""
     import postgres_db
-    postgres_db._psql_db_conn = None
-    
-    # Get connection
-    conn = get_db_connection()
-    
+    from db_pool import PostgresPool
+
+    mock_conn = MagicMock(closed=0)
+    mock_connect.return_value = mock_conn
+
+    pool = PostgresPool(postgres_db.connect_db, min_size=0, max_size=2, health_check_interval=0)
+
+    with pool.connection() as conn:
+        assert conn is mock_conn
+        assert pool.stats()["in_use"] == 1
+
     # Verify connect was called with correct parameters
-    mock_connect.assert_called()
-    
-    # Connection should not be None
-    assert conn is not None
+    mock_connect.assert_called_once()
+    assert mock_connect.call_args[1]["database"] == "testdb"
 
-@patch('os.environ', {'DB_NAME': 'testdb', 'DB_USERNAME': 'user', 'DB_PASSWORD': 'pass'})
-@patch('psycopg2.connect')
-def test_get_db_connection_retry(mock_connect, client):
-    """Test connection retry with simpler approach."""
-    # Import the module
-    import postgres_db
-    
-    # Force reset of existing connection
-    postgres_db._psql_db_conn = None
-    
-    # Setup mock cursor for first connection that raises exception
-    mock_cursor1 = MagicMock()
-    mock_cursor1.execute.side_effect = Exception("Connection closed")
-    
-    # Setup first connection with the cursor
-    mock_conn1 = MagicMock()
-    mock_conn1.cursor.return_value = mock_cursor1
-    
-    # Setup second connection that works
-    mock_conn2 = MagicMock()
-    mock_connect.side_effect = [mock_conn1, mock_conn2]
-    
-    # Test function
-    conn1 = postgres_db.get_db_connection()
-    assert conn1 is not None
-    
-    # Connection should work
-    assert postgres_db.get_db_connection() is not None
+    # The connection is reused instead of reconnecting
+    with pool.connection() as conn:
+        assert conn is mock_conn
+    assert mock_connect.call_count == 1
+
+    stats = pool.stats()
+    assert stats["idle"] == 1
+    assert stats["borrows"] == 2
+
+def test_db_pool_waits_and_times_out():
+    """Test that borrowers wait for a free connection and time out when the pool stays exhausted."""
+    import threading
+    from db_pool import PostgresPool, PoolTimeout
+
+    pool = PostgresPool(lambda: MagicMock(closed=0), min_size=0, max_size=1, acquire_timeout=0.1, health_check_interval=0)
+
+    conn = pool.borrow()
+    with pytest.raises(PoolTimeout):
+        pool.borrow()
+
+    # A waiting borrower gets the connection as soon as it is returned
+    pool.acquire_timeout = 5
+    threading.Timer(0.05, pool.give_back, args=(conn,)).start()
+    assert pool.borrow() is conn
+
+    stats = pool.stats()
+    assert stats["timeouts"] == 1
+    assert stats["waits"] >= 1
+    assert stats["max_wait_ms"] > 0
+
+def test_db_pool_replaces_dead_connections():
+    """Test that the background health check replaces broken idle connections."""
+    from db_pool import PostgresPool
+
+    dead_conn = MagicMock(closed=0)
+    dead_conn.cursor.return_value.execute.side_effect = Exception("server closed the connection unexpectedly")
+    new_conn = MagicMock(closed=0)
+    connections = iter([dead_conn, new_conn])
+
+    pool = PostgresPool(lambda: next(connections), min_size=1, max_size=2, health_check_interval=0)
+    pool.start()
+    pool.check_idle()
+
+    dead_conn.close.assert_called_once()
+    assert pool.borrow() is new_conn
+    assert pool.stats()["replaced"] == 1
+
+def test_db_pool_discards_closed_connection():
+    """Test that a connection that broke inside the block is not handed out again."""
+    from db_pool import PostgresPool
+
+    broken_conn = MagicMock(closed=0)
+    pool = PostgresPool(lambda: broken_conn, min_size=0, max_size=1, health_check_interval=0)
+
+    with pytest.raises(Exception):
+        with pool.connection() as conn:
+            conn.closed = 2
+            raise Exception("connection lost")
+
+    assert pool.stats()["size"] == 0
 
 @patch('honeypot_endpoints.extract_attacker_info')
 @patch('honeypot_endpoints.get_attacker_summary')
-@patch('honeypot_endpoints.log_attacker_information')
+@patch('honeypot_endpoints.queue_attacker_information')
 @patch('honeypot_endpoints.get_memory_db')
 def test_sql_injection_attack_flow(mock_memory_db, mock_log_attacker, mock_attacker_summary, mock_extract_attacker_info, client):
     """Test the simplified flow of detecting a SQL injection attack."""
@@ -1017,4 +1090,1465 @@ def test_sql_injection_attack_flow(mock_memory_db, mock_log_attacker, mock_attac
     # 7. Check the response reflects successful injection
     assert response.status_code == 200
     data = response.get_json()
-    assert data["success"] is True
\ No newline at end of file
+    assert data["success"] is True
+def test_capture_pipeline_processes_events():
+    """Test that queued events are handled by the capture workers."""
+    from capture_pipeline import CapturePipeline
+
+    handled = []
+    pipeline = CapturePipeline(handled.append, max_size=10, workers=2)
+
+    for i in range(5):
+        assert pipeline.submit({"event": i}) is True
+
+    assert pipeline.drain(timeout=5)
+    assert sorted(event["event"] for event in handled) == [0, 1, 2, 3, 4]
+
+    stats = pipeline.stats()
+    assert stats["submitted"] == 5
+    assert stats["processed"] == 5
+    assert stats["dropped"] == 0
+    assert stats["queue_depth"] == 0
+
+def test_capture_pipeline_drops_when_full():
+    """Test that a full capture queue drops events instead of blocking the request."""
+    import threading
+    from capture_pipeline import CapturePipeline
+
+    release = threading.Event()
+    pipeline = CapturePipeline(lambda event: release.wait(5), max_size=1, workers=1)
+
+    results = [pipeline.submit({"event": i}) for i in range(5)]
+    release.set()
+    assert pipeline.drain(timeout=5)
+
+    stats = pipeline.stats()
+    assert results.count(False) == stats["dropped"]
+    assert stats["dropped"] >= 3
+    assert stats["submitted"] + stats["dropped"] == 5
+
+def test_capture_pipeline_counts_failures():
+    """Test that a failing stage is counted and doesn't kill the worker."""
+    from capture_pipeline import CapturePipeline
+
+    def handler(event):
+        if event["fail"]:
+            raise Exception("Gemini unavailable")
+
+    pipeline = CapturePipeline(handler, max_size=10, workers=1)
+    pipeline.submit({"fail": True})
+    pipeline.submit({"fail": False})
+    assert pipeline.drain(timeout=5)
+
+    stats = pipeline.stats()
+    assert stats["failed"] == 1
+    assert stats["processed"] == 1
+
+def test_get_attacker_summary_defers_gemini(client):
+    """Test that the request path no longer calls gemini and keeps the payload for the workers."""
+    from honeypot_endpoints import get_attacker_summary
+
+    with patch('capture_pipeline.submit_payload') as mock_analyze:
+        with app.test_request_context('/api/forum?forum_id=1'):
+            summary = get_attacker_summary({"ip_address": "10.0.0.5"})
+
+        mock_analyze.assert_not_called()
+
+    assert summary["gemini"] is None
+    assert summary["payload_to_analyze"]["query_params"] == b"forum_id=1"
+    assert summary["request_details"]["path"] == "/api/forum"
+
+def test_process_attacker_summary_stages():
+    """Test that the capture worker enriches, classifies and persists an event."""
+    import capture_pipeline
+
+    summary = {
+        "attacker_info": {"ip_address": "10.0.0.5", "geolocation": None},
+        "gemini": None,
+        "payload_to_analyze": {"query_params": b"id=1 OR 1=1"},
+        "request_details": {"path": "/api/forum"}
+    }
+
+    with patch('capture_pipeline.lookup_geolocation', return_value={"country": "US"}), \
+         patch('capture_pipeline.submit_payload', return_value=gemini_answer("Injection - SQL\n[{id: 1 OR 1=1}]\nTautology based injection")), \
+         patch('capture_pipeline.get_attack_batch_writer') as mock_writer:
+        capture_pipeline.process_attacker_summary(summary)
+
+    mock_writer.return_value.submit.assert_called_once_with(summary)
+    assert summary["attacker_info"]["geolocation"] == {"country": "US"}
+    assert summary["gemini"]["technique"] == "Injection - SQL"
+    assert summary["gemini"]["description"] == "Tautology based injection"
+
+@patch('app.get_capture_pipeline')
+def test_debug_capture_pipeline(mock_get_pipeline, client):
+    """Test the /api/debug/capture_pipeline endpoint."""
+    mock_get_pipeline.return_value.stats.return_value = {"queue_depth": 3, "dropped": 1}
+
+    response = client.get('/api/debug/capture_pipeline')
+
+    assert response.status_code == 200
+    assert response.get_json() == {"queue_depth": 3, "dropped": 1}
+
+def test_attack_batch_writer_groups_events():
+    """Test that the batch writer groups events by size and flushes the remainder."""
+    from batch_writer import AttackBatchWriter
+
+    batches = []
+    writer = AttackBatchWriter(batches.append, max_events=3, max_latency_ms=50)
+
+    for i in range(7):
+        writer._queue.put_nowait({"event": i})
+    writer.flush()
+
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    stats = writer.stats()
+    assert stats["batches"] == 3
+    assert stats["written"] == 7
+
+def test_attack_batch_writer_flushes_on_latency():
+    """Test that a partial batch is written once the latency window closes."""
+    import threading
+    from batch_writer import AttackBatchWriter
+
+    written = threading.Event()
+    batches = []
+
+    def write_batch(batch):
+        batches.append(batch)
+        written.set()
+
+    writer = AttackBatchWriter(write_batch, max_events=100, max_latency_ms=20)
+    writer.submit({"event": 1})
+    writer.submit({"event": 2})
+
+    assert written.wait(5)
+    writer.close()
+    assert sum(len(batch) for batch in batches) == 2
+
+def test_attack_batch_writer_isolates_bad_event():
+    """Test that a failing batch is retried one event at a time."""
+    from batch_writer import AttackBatchWriter
+
+    written = []
+
+    def write_batch(batch):
+        if any(event.get("bad") for event in batch):
+            raise Exception("invalid input syntax")
+        written.extend(batch)
+
+    writer = AttackBatchWriter(write_batch, max_events=10)
+    for event in [{"id": 1}, {"id": 2, "bad": True}, {"id": 3}]:
+        writer._queue.put_nowait(event)
+    writer.flush()
+
+    assert [event["id"] for event in written] == [1, 3]
+    assert writer.stats()["failed"] == 1
+
+def test_attack_batch_writer_skips_per_event_retry_when_postgres_is_down():
+    """Test a connection failure fails the whole batch at once instead of retrying every event."""
+    import psycopg2
+    from batch_writer import AttackBatchWriter
+
+    write_batch = MagicMock(side_effect=psycopg2.OperationalError("could not connect to server"))
+    writer = AttackBatchWriter(write_batch, max_events=10)
+    for event in [{"id": 1}, {"id": 2}, {"id": 3}]:
+        writer._queue.put_nowait(event)
+    writer.flush()
+
+    write_batch.assert_called_once()
+    assert writer.stats()["failed"] == 3
+
+@patch('postgres_db.execute_values')
+def test_resolve_attacker_sessions_upserts_in_key_order(mock_execute_values):
+    """Test attackers are upserted sorted by (ip, fingerprint) so concurrent batches lock rows in one order."""
+    import postgres_db
+
+    def attacker_info(ip, fingerprint):
+        return {"ip_address": ip, "device_fingerprint": fingerprint, "user_agent": "{}", "geolocation": "{}",
+                "browser": "curl", "os": "Linux", "device_type": "Other", "is_bot": True}
+
+    mock_execute_values.return_value = []
+    postgres_db.resolve_attacker_sessions(MagicMock(), [
+        attacker_info("10.0.0.2", "b"), attacker_info("10.0.0.1", "z"), attacker_info("10.0.0.1", "a")
+    ])
+
+    rows = mock_execute_values.call_args[0][2]
+    assert [(row[0], row[2]) for row in rows] == [("10.0.0.1", "a"), ("10.0.0.1", "z"), ("10.0.0.2", "b")]
+
+@patch('postgres_db.send_log_to_logstash')
+@patch('postgres_db.execute_values')
+@patch('postgres_db.db_connection')
+def test_log_attacker_batch_single_transaction(mock_db_connection, mock_execute_values, mock_send_log):
+    """Test that a batch resolves each attacker once and inserts all attacks with one statement and commit."""
+    import postgres_db
+
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_conn.cursor.return_value = mock_cursor
+    mock_db_connection.return_value.__enter__.return_value = mock_conn
+
+    def attacker_summary(ip):
+        return {
+            "attacker_info": {
+                "ip_address": ip,
+                "device_fingerprint": "fp-" + ip,
+                "user_agent": "{}",
+                "geolocation": {"country": "US"},
+                "browser": "curl",
+                "os": "Linux",
+                "device_type": "Other",
+                "is_bot": True
+            },
+            "gemini": {"technique": "Injection - SQL", "iocs": "[1=1]", "description": "SQLi"},
+            "request_details": {"path": "/api/forum"}
+        }
+
+    summaries = [attacker_summary("10.0.0.1"), attacker_summary("10.0.0.1"), attacker_summary("10.0.0.2")]
+
+    sessions = {("10.0.0.1", "fp-10.0.0.1"): (1, 11), ("10.0.0.2", "fp-10.0.0.2"): (2, 12)}
+    with patch('postgres_db.resolve_attacker_sessions', return_value=sessions) as mock_resolve:
+        assert postgres_db.log_attacker_batch(summaries) == 3
+
+    #each attacker is resolved once for the whole batch
+    mock_resolve.assert_called_once()
+    assert len(mock_resolve.call_args[0][1]) == 2
+
+    mock_execute_values.assert_called_once()
+    rows = mock_execute_values.call_args[0][2]
+    assert [row[0] for row in rows] == ["11", "11", "12"]
+    mock_conn.commit.assert_called_once()
+    assert mock_send_log.call_count == 3
+
+def test_log_attacker_information_goes_through_the_batch_writer():
+    """Test a single event is written by log_attacker_batch, so capture_id and the flood counts are kept."""
+    import postgres_db
+
+    summary = {"attacker_info": {}, "gemini": {}, "request_details": {"path": "/api/forum"}, "capture_id": "abc", "count": 3}
+    with patch('postgres_db.log_attacker_batch', return_value=1) as mock_batch:
+        assert postgres_db.log_attacker_information(summary) == 1
+
+    mock_batch.assert_called_once_with([summary])
+
+
+def test_geolocation_cache_expires_and_evicts():
+    """Test the geolocation cache drops expired entries and evicts the least recently used IP."""
+    from geolocation import GeolocationService
+
+    service = GeolocationService(access_token="token", max_entries=2, ttl=60)
+    handler = MagicMock()
+    handler.getDetails.side_effect = lambda ip: MagicMock(all={"ip": ip, "country": "US"})
+    service._handler = handler
+
+    with patch('geolocation.time.monotonic', return_value=1000):
+        service.lookup("8.8.8.8")
+        service.lookup("1.1.1.1")
+        service.lookup("8.8.8.8")
+        service.lookup("9.9.9.9")  #evicts 1.1.1.1, 8.8.8.8 was used more recently
+        service.lookup("8.8.8.8")
+        service.lookup("1.1.1.1")
+
+    assert handler.getDetails.call_count == 4
+    assert service.stats()["evictions"] == 2
+
+    with patch('geolocation.time.monotonic', return_value=1061):
+        service.lookup("1.1.1.1")
+
+    assert handler.getDetails.call_count == 5
+    assert service.stats()["hits"] == 2
+
+
+def test_geolocation_failures_are_not_cached():
+    """Test a failed ipinfo lookup is retried on the next request instead of being cached."""
+    from geolocation import GeolocationService
+
+    service = GeolocationService(access_token="token")
+    handler = MagicMock()
+    handler.getDetails.side_effect = [Exception("rate limited"), MagicMock(all={"country": "US"})]
+    service._handler = handler
+
+    with pytest.raises(Exception):
+        service.lookup("8.8.8.8")
+
+    assert service.lookup("8.8.8.8") == {"country": "US"}
+    assert service.lookup("127.0.0.1") == {"ip": "127.0.0.1", "bogon": True}
+    assert service.stats()["errors"] == 1
+    assert service.stats()["bogons"] == 1
+
+
+def test_ip_location_database_lookup(tmp_path):
+    """Test the offline range database answers IPv4 and IPv6 lookups by bisection."""
+    from ip_database import IPLocationDatabase
+
+    ranges = tmp_path / "ip_ranges.csv"
+    ranges.write_text(
+        "network,country,city,asn\n"
+        "1.1.1.0/24,AU,Sydney,AS13335\n"
+        "8.8.8.0/24,US,Mountain View,AS15169\n"
+        "8.8.4.0/24,US,Mountain View,AS15169\n"
+        "not-a-network,XX,Nowhere,AS0\n"
+        "2001:4860::/32,US,Mountain View,AS15169\n"
+    )
+
+    database = IPLocationDatabase.load(str(ranges))
+
+    assert database.stats() == {"ipv4_ranges": 3, "ipv6_ranges": 1, "locations": 2}
+    assert database.lookup("8.8.4.4") == {"ip": "8.8.4.4", "country": "US", "city": "Mountain View", "asn": "AS15169"}
+    assert database.lookup("1.1.1.255")["city"] == "Sydney"
+    assert database.lookup("2001:4860:4860::8888")["asn"] == "AS15169"
+    assert database.lookup("1.1.2.0") is None
+    assert database.lookup("0.0.0.1") is None
+    assert database.lookup("2001:db8::1") is None
+    assert database.lookup("garbage") is None
+
+
+def test_geolocation_prefers_offline_database(tmp_path):
+    """Test the geolocation service only falls back to ipinfo when the offline database misses."""
+    from geolocation import GeolocationService
+    from ip_database import IPLocationDatabase
+
+    ranges = tmp_path / "ip_ranges.csv"
+    ranges.write_text("network,country,city,asn\n8.8.8.0/24,US,Mountain View,AS15169\n")
+
+    service = GeolocationService(access_token="token", database=IPLocationDatabase.load(str(ranges)))
+    handler = MagicMock()
+    handler.getDetails.return_value = MagicMock(all={"country": "AU"})
+    service._handler = handler
+
+    assert service.lookup("8.8.8.8")["country"] == "US"
+    assert service.lookup("1.1.1.1") == {"country": "AU"}
+    assert service.lookup("9.9.9.9", online=False) is None
+
+    handler.getDetails.assert_called_once_with("1.1.1.1")
+    assert service.stats()["offline_hits"] == 1
+
+
+def test_ioc_rule_engine_tags_matches():
+    """Test the IOC rules scan every part of the request in one pass and tag where each match was found."""
+    from ioc_rules import IOCRuleEngine
+
+    engine = IOCRuleEngine.load()
+    matches = engine.scan({
+        "body": "username=admin' OR 1=1--&password=x",
+        "query": "file=../../etc/passwd",
+        "headers": "User-Agent: ${jndi:ldap://evil/a}\nReferer: <img src=x onerror=alert(1)>\nCookie: session=abc; id=5; lsid=7"
+    })
+
+    found = {(match["rule"], match["location"]) for match in matches}
+    assert ("sql_injection", "body") in found
+    assert ("path_traversal", "query") in found
+    assert ("header_command_injection", "headers") in found
+    assert ("xss", "headers") in found
+    #the cookie separators aren't shell commands
+    assert not any(match["location"] == "headers" and match["match"].strip().startswith(";") for match in matches)
+
+    assert engine.match_labels(matches) == [
+        "Possible SQL injection attempt",
+        "Possible XSS attempt",
+        "Possible path traversal attempt",
+        "Possible command injection attempt"
+    ]
+    assert engine.signature_count > 100
+    assert engine.scan({"body": "hello world", "query": "", "headers": "Accept: text/html"}) == []
+
+
+def test_ioc_rules_keep_broad_sql_literals_out_of_headers():
+    """Test benign headers carrying "--", "select " or powershell aren't tagged while real SQL injection in a header is."""
+    from ioc_rules import IOCRuleEngine
+
+    engine = IOCRuleEngine.load()
+    benign = "Cookie: theme=dark--compact; prefs=select all\nUser-Agent: Mozilla/5.0 -- custom build"
+    assert engine.scan({"headers": benign}) == []
+    powershell = "User-Agent: Mozilla/5.0 (Windows NT 10.0; Microsoft Windows 10.0.19045; en-US) PowerShell/7.4.1"
+    assert engine.scan({"headers": powershell}) == []
+    assert [match["rule"] for match in engine.scan({"query": "sort=name--"})] == ["sql_injection"]
+
+    matches = engine.scan({"headers": "User-Agent: x' UNION SELECT password FROM users--", "body": "q=1 union select 2"})
+    assert {(match["rule"], match["location"]) for match in matches} == {("header_sql_injection", "headers"), ("sql_injection", "body")}
+    assert engine.match_labels(matches) == ["Possible SQL injection attempt"]
+    assert engine.verdict(matches)["technique"] == "Injection - SQL"
+
+
+def test_ioc_rule_engine_falls_back_to_default_rules(monkeypatch):
+    """Test a missing IOC_RULES_PATH file falls back to the bundled rules instead of failing every request."""
+    import ioc_rules
+
+    monkeypatch.setattr(ioc_rules, '_ioc_rule_engine', None)
+    monkeypatch.setenv('IOC_RULES_PATH', 'path_to_ioc_rules.json')
+    engine = ioc_rules.get_ioc_rule_engine()
+    assert engine.signature_count == ioc_rules.IOCRuleEngine.load().signature_count
+
+
+def test_ioc_rule_techniques_are_gemini_attack_vectors():
+    """Test fallback verdicts only use attack vectors the gemini prompts offer, so owasp_technique doesn't split."""
+    from gemini import ATTACK_VECTORS
+    from ioc_rules import IOCRuleEngine
+    from local_classifier import CATEGORY_MAP
+
+    vectors = ATTACK_VECTORS.split(", ")
+    assert set(IOCRuleEngine.load().techniques.values()) <= set(vectors)
+    assert set(CATEGORY_MAP.values()) <= set(vectors)
+
+
+def test_extract_attacker_info_scans_request_iocs(client):
+    """Test extract_attacker_info flags payloads in base64 encoded json bodies and in headers."""
+    from honeypot_endpoints import extract_attacker_info
+
+    body = {"username": base64.b64encode(b"' union select * from users --").decode(), "password": "cGFzcw=="}
+    with app.test_request_context(
+        '/api/login',
+        method='POST',
+        json=body,
+        headers={'User-Agent': 'Mozilla/5.0 <script>alert(1)</script>'}
+    ):
+        attacker_info = extract_attacker_info()
+
+    iocs = json.loads(attacker_info["ioc"])
+    assert iocs[:2] == ["Possible SQL injection attempt", "Possible XSS attempt"]
+    assert {match["location"] for match in attacker_info["ioc_matches"]} == {"body", "headers"}
+
+
+def test_verdict_key_normalizes_payload():
+    """Test equivalent payloads share a verdict key and requests without a payload aren't cached."""
+    from verdict_cache import verdict_key
+
+    key = verdict_key({"attacker_info": {"ip_address": "1.1.1.1"}, "request_data": {"username": "admin' OR 1=1--", "password": "x"}, "query_params": b""})
+    same = verdict_key({"attacker_info": {"ip_address": "2.2.2.2"}, "request_data": {"password": "x", "username": "  ADMIN'   or 1=1-- "}})
+    other = verdict_key({"request_data": {"username": "admin"}, "query_params": b""})
+
+    assert key == same
+    assert key != other
+    assert verdict_key({"query_params": b"b=2&a=%27+or+1%3D1"}) == verdict_key({"query_params": b"a=' or 1=1&b=2"})
+    assert verdict_key({"attacker_info": {}, "query_params": b""}) is None
+
+
+def test_classify_attacker_summary_reuses_cached_verdict(verdict_cache):
+    """Test a repeat payload is answered from the verdict cache instead of gemini."""
+    import capture_pipeline
+
+    def summary():
+        return {
+            "attacker_info": {"ip_address": "10.0.0.5"},
+            "gemini": None,
+            "payload_to_analyze": {"query_params": b"id=1 OR 1=1"}
+        }
+
+    with patch('capture_pipeline.submit_payload', return_value=gemini_answer("Injection - SQL\n[{id: 1 OR 1=1}]\nTautology")) as mock_analyze:
+        first = capture_pipeline.classify_attacker_summary(summary())
+        second = capture_pipeline.classify_attacker_summary(summary())
+
+    mock_analyze.assert_called_once()
+    assert second["gemini"] == first["gemini"] == {"technique": "Injection - SQL", "iocs": "[{id: 1 OR 1=1}]", "description": "Tautology"}
+    assert verdict_cache.stats()["memory_hits"] == 1
+
+
+@patch('verdict_cache.db_connection')
+def test_verdict_cache_persistent_tier(mock_db_connection):
+    """Test verdicts are read from and written to postgres, and an outage pauses the postgres tier."""
+    from verdict_cache import VerdictCache
+
+    mock_conn = MagicMock()
+    mock_cur = MagicMock()
+    mock_conn.cursor.return_value = mock_cur
+    mock_db_connection.return_value.__enter__.return_value = mock_conn
+    mock_cur.fetchone.return_value = ("Injection - XSS", "[q]", "Reflected script")
+
+    cache = VerdictCache()
+    assert cache.get("abc") == {"technique": "Injection - XSS", "iocs": "[q]", "description": "Reflected script"}
+    #the second lookup is served from memory
+    assert cache.get("abc")["technique"] == "Injection - XSS"
+    assert mock_cur.execute.call_count == 1
+
+    cache.put("def", {"technique": "No Attack Vector", "iocs": "[]", "description": "Benign"})
+    insert_sql, params = mock_cur.execute.call_args[0]
+    assert "ON CONFLICT (payload_hash) DO NOTHING" in insert_sql
+    assert params == ("def", "No Attack Vector", "[]", "Benign")
+    mock_conn.commit.assert_called_once()
+
+    mock_db_connection.side_effect = Exception("connection refused")
+    assert cache.get("ghi") is None
+    assert cache.get("jkl") is None
+    assert mock_db_connection.call_count == 3
+    assert cache.stats()["errors"] == 1
+
+
+def test_gemini_batcher_sends_one_prompt_per_batch():
+    """Test concurrent payloads are classified with one batched call and split back to each caller."""
+    from gemini_batcher import GeminiBatcher
+    from concurrent.futures import ThreadPoolExecutor
+
+    analyze_batch = MagicMock(side_effect=lambda payloads: [f"Injection - SQL\n[{p}]\nanalysis {p}" for p in payloads])
+    analyze_single = MagicMock()
+    batcher = GeminiBatcher(analyze_batch, analyze_single, max_batch=5, max_wait_ms=200)
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        answers = list(pool.map(lambda i: batcher.classify(f"p{i}", timeout=5), range(5)))
+
+    assert answers == [f"Injection - SQL\n[p{i}]\nanalysis p{i}" for i in range(5)]
+    analyze_batch.assert_called_once()
+    analyze_single.assert_not_called()
+    assert batcher.stats()["max_batch_size"] == 5
+
+
+def test_gemini_batcher_falls_back_per_item():
+    """Test payloads missing from the batch answer are retried alone and a failed call answers every item."""
+    from gemini_batcher import GeminiBatcher
+
+    analyze_batch = MagicMock(return_value=["No Attack Vector\n[]\nBenign", None])
+    analyze_single = MagicMock(return_value="Injection - XSS\n[q]\nScript tag")
+    batcher = GeminiBatcher(analyze_batch, analyze_single, max_batch=2, max_wait_ms=500)
+
+    first, second = batcher.submit("a"), batcher.submit("b")
+    assert first.result(timeout=5) == "No Attack Vector\n[]\nBenign"
+    assert second.result(timeout=5) == "Injection - XSS\n[q]\nScript tag"
+    analyze_single.assert_called_once_with("b")
+    assert batcher.stats()["fallbacks"] == 1
+
+    analyze_batch.side_effect = Exception("quota exceeded")
+    first, second = batcher.submit("c"), batcher.submit("d")
+    assert first.result(timeout=5) == second.result(timeout=5) == "Error: quota exceeded"
+    assert analyze_single.call_count == 1
+
+
+def test_gemini_batcher_rejects_past_max_pending():
+    """Test payloads past max_pending are answered with an error straight away and the bound frees up again."""
+    import threading
+    from gemini_batcher import GeminiBatcher
+
+    release = threading.Event()
+    analyze_single = MagicMock(side_effect=lambda payload: release.wait(5) and "No Attack Vector\n[]\nBenign")
+    batcher = GeminiBatcher(MagicMock(), analyze_single, max_batch=1, max_wait_ms=0, max_pending=2)
+
+    first, second = batcher.submit("a"), batcher.submit("b")
+    third = batcher.submit("c")
+    assert third.done()
+    assert third.result().startswith("Error: gemini backlog full")
+    assert batcher.stats()["rejected"] == 1
+
+    release.set()
+    assert first.result(timeout=5) == second.result(timeout=5) == "No Attack Vector\n[]\nBenign"
+    assert batcher.stats()["pending"] == 0
+    assert batcher.submit("d").result(timeout=5) == "No Attack Vector\n[]\nBenign"
+
+
+def test_split_batch_response():
+    """Test numbered batch answers are split per payload and malformed answers are left for fallback."""
+    from gemini import split_batch_response
+
+    text = "[1]\nInjection - SQL\n[{id: 1 OR 1=1}]\nTautology\n\n**[3]**\nNo Attack Vector\n[]\n\n[2]\nInjection - XSS\n[q]\nScript tag\n"
+
+    assert split_batch_response(text, 4) == [
+        "Injection - SQL\n[{id: 1 OR 1=1}]\nTautology",
+        "Injection - XSS\n[q]\nScript tag",
+        None,
+        None
+    ]
+
+
+def test_local_classifier_predicts_known_categories():
+    """Test the n-gram classifier trained from training-matrial separates the OWASP categories."""
+    from local_classifier import LocalClassifier, load_training_samples
+
+    model = LocalClassifier.train(load_training_samples())
+
+    assert model.predict("<script>alert(document.cookie)</script>")[0] == "Injection - XSS"
+    assert model.predict("1' UNION SELECT table_name FROM information_schema.tables--")[0] == "Injection - SQL"
+    assert model.predict("Can we move the team meeting to Thursday?")[0] == "No Attack Vector"
+
+    #round trips through the exported format
+    restored = LocalClassifier.from_dict(json.loads(json.dumps(model.to_dict())))
+    label, confidence = restored.predict("<img src=x onerror=alert(1)>")
+    assert label == "Injection - XSS"
+    assert 0 <= confidence <= 1
+
+
+def test_local_verdict_threshold(no_local_classifier, monkeypatch):
+    """Test confident local verdicts skip gemini and uncertain ones are escalated."""
+    import capture_pipeline
+    from local_classifier import LocalClassifier, local_verdict
+
+    classifier = LocalClassifier({}, {}, class_sizes={"Injection - XSS": 50})
+    classifier.classify = MagicMock()
+    monkeypatch.setattr('local_classifier.get_local_classifier', lambda: classifier)
+    payload = {"request_data": {"username": "<script>alert(1)</script>"}, "query_params": b"page=2"}
+
+    classifier.classify.return_value = ("Injection - XSS", 0.95, 0.3)
+    verdict = local_verdict(payload)
+    assert verdict["technique"] == "Injection - XSS"
+    assert verdict["iocs"] == "[{username: <script>alert(1)</script>}, {page?: 2}]"
+
+    classifier.classify.return_value = ("Injection - XSS", 0.5, 0.3)
+    assert local_verdict(payload) is None
+    #confident but barely ahead of the runner up
+    classifier.classify.return_value = ("Injection - XSS", 0.95, 0.02)
+    assert local_verdict(payload) is None
+    assert local_verdict({"query_params": b""}) is None
+
+    no_local_classifier.return_value = {"technique": "Injection - SQL", "iocs": "[]", "description": "local"}
+    summary = {"attacker_info": {}, "gemini": None, "payload_to_analyze": payload}
+    with patch('capture_pipeline.submit_payload') as mock_classify:
+        capture_pipeline.classify_attacker_summary(summary)
+
+    mock_classify.assert_not_called()
+    assert summary["gemini"]["technique"] == "Injection - SQL"
+
+
+def test_local_verdict_sends_benign_ids_to_gemini(no_local_classifier):
+    """Test the trained model doesn't answer plain decoy traffic locally from a thinly trained class."""
+    import capture_pipeline
+    from local_classifier import get_local_classifier, local_verdict
+
+    assert local_verdict({"query_params": b"user_id=3"}) is None
+    assert local_verdict({"request_data": {"q": "SELECT a new laptop please"}}) is None
+    assert get_local_classifier().class_sizes["Broken Access Control"] < 5
+
+    no_local_classifier.side_effect = local_verdict
+    summary = {"attacker_info": {}, "gemini": None, "payload_to_analyze": {"query_params": b"user_id=3"}}
+    with patch('capture_pipeline.submit_payload') as mock_classify:
+        mock_classify.return_value.result.return_value = "No Attack Vector\n[]\nForum lookup by user id"
+        capture_pipeline.classify_attacker_summary(summary)
+
+    mock_classify.assert_called_once()
+    assert summary["gemini"]["technique"] == "No Attack Vector"
+
+
+def test_local_verdict_reads_keys_and_defers_to_ioc_rules(no_local_classifier, monkeypatch):
+    """Test query keys are classified and a benign local verdict never overrides an IOC rule match."""
+    import capture_pipeline
+    from local_classifier import LocalClassifier, get_local_classifier, local_verdict, payload_text
+
+    injected = {"query_params": b"user_id%3D1%20UNION%20SELECT%20username,password%20FROM%20Users%20--%20x=1"}
+    assert "UNION SELECT username,password" in payload_text(injected)
+    assert get_local_classifier().classify(payload_text(injected))[0] == "Injection - SQL"
+    assert (local_verdict(injected) or {}).get("technique") != "No Attack Vector"
+
+    classifier = LocalClassifier({}, {}, class_sizes={"No Attack Vector": 50})
+    classifier.classify = MagicMock(return_value=("No Attack Vector", 0.99, 0.3))
+    monkeypatch.setattr('local_classifier.get_local_classifier', lambda: classifier)
+    payload = {"request_data": {"comment": "see you -- bob"}}
+    assert local_verdict(payload)["technique"] == "No Attack Vector"
+    assert local_verdict(payload, [{"rule": "sql_comment"}]) is None
+
+    no_local_classifier.side_effect = local_verdict
+    summary = {"attacker_info": {"ioc_matches": [{"rule": "sql_comment"}]}, "gemini": None, "payload_to_analyze": payload}
+    with patch('capture_pipeline.submit_payload') as mock_classify:
+        mock_classify.return_value.result.return_value = "Injection - SQL\n[{comment: see you -- bob}]\nComment sequence"
+        capture_pipeline.classify_attacker_summary(summary)
+
+    mock_classify.assert_called_once()
+
+
+def test_gemini_deadline_falls_back_to_ioc_rules(verdict_cache, monkeypatch):
+    """Test a slow gemini answer is replaced by the IOC rules verdict and upgraded when it arrives."""
+    import time
+    import capture_pipeline
+    from ioc_rules import get_ioc_rule_engine
+
+    monkeypatch.setenv('GEMINI_DEADLINE_MS', '10')
+    upgrade = MagicMock(side_effect=[0, 1])
+    upgrader = capture_pipeline.LateVerdictUpgrader(upgrade, retry_interval=0)
+    monkeypatch.setattr(capture_pipeline, 'get_late_verdict_upgrader', lambda: upgrader)
+
+    matches = get_ioc_rule_engine().scan({"query": "id=1' or 1=1--"})
+    summary = {
+        "attacker_info": {"ip_address": "10.0.0.5", "ioc_matches": matches},
+        "gemini": None,
+        "payload_to_analyze": {"query_params": b"id=1' or 1=1--"}
+    }
+
+    pending = Future()
+    with patch('capture_pipeline.submit_payload', return_value=pending):
+        capture_pipeline.classify_attacker_summary(summary)
+
+    assert summary["gemini"]["technique"] == "Injection - SQL"
+    assert summary["gemini"]["iocs"] == "[{query: ' or 1=1}, {query: --}]"
+    assert summary["capture_id"]
+
+    #the late answer is written over the fallback, retrying until the batch writer has the row
+    pending.set_result("Injection - SQL\n[{id?: 1' or 1=1--}]\nTautology")
+    deadline = time.monotonic() + 5
+    while upgrader.stats()["upgraded"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    late = {"technique": "Injection - SQL", "iocs": "[{id?: 1' or 1=1--}]", "description": "Tautology"}
+    assert upgrade.call_args_list == [call(summary["capture_id"], late)] * 2
+    assert summary["gemini"] == late
+    assert upgrader.stats()["pending"] == 0
+    assert verdict_cache.stats()["stores"] == 1
+
+
+def test_malformed_gemini_answer_falls_back_to_ioc_rules(verdict_cache):
+    """Test errors and answers without three lines no longer crash the worker and aren't cached."""
+    import capture_pipeline
+
+    for answer in ["Injection - XSS", "Error: 429 quota exceeded"]:
+        summary = {
+            "attacker_info": {"ip_address": "10.0.0.5"},
+            "gemini": None,
+            "payload_to_analyze": {"query_params": b"q=hello"}
+        }
+        with patch('capture_pipeline.submit_payload', return_value=gemini_answer(answer)):
+            capture_pipeline.classify_attacker_summary(summary)
+
+        assert summary["gemini"]["technique"] == "No Attack Vector"
+        assert "capture_id" not in summary
+
+    assert verdict_cache.stats()["stores"] == 0
+
+
+def test_gemini_governor_circuit_breaker():
+    """Test the breaker opens after consecutive failures, rejects without calling and closes on a good probe."""
+    import time
+    from gemini_governor import GeminiGovernor, GeminiUnavailable
+
+    governor = GeminiGovernor(failure_threshold=2, reset_timeout=0.05, requests_per_minute=1000)
+    failing = MagicMock(side_effect=RuntimeError("503 unavailable"))
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            governor.call(failing, "prompt")
+
+    with pytest.raises(GeminiUnavailable):
+        governor.call(failing, "prompt")
+    assert failing.call_count == 2
+    assert governor.stats()["state"] == "open"
+
+    #a failed half-open probe opens the breaker again straight away
+    time.sleep(0.06)
+    with pytest.raises(RuntimeError):
+        governor.call(failing, "prompt")
+    assert governor.stats()["state"] == "open"
+
+    time.sleep(0.06)
+    assert governor.call(lambda prompt: "ok", "prompt") == "ok"
+
+    stats = governor.stats()
+    assert stats["state"] == "closed"
+    assert stats["rejected"] == 1
+    assert stats["failures"] == 3
+    assert stats["times_opened"] == 2
+
+
+def test_gemini_governor_rate_limits():
+    """Test the request bucket throttles callers and the token bucket settles on the reported usage."""
+    from gemini_governor import GeminiGovernor, GeminiThrottled
+
+    governor = GeminiGovernor(requests_per_minute=2, tokens_per_minute=100000, max_wait=0.05)
+    response = MagicMock()
+    response.usage_metadata.total_token_count = 1000
+
+    governor.call(lambda prompt: response, "x" * 400)
+    assert governor.stats()["tokens_available"] == 99000
+
+    governor.call(lambda prompt: response, "prompt")
+    with pytest.raises(GeminiThrottled):
+        governor.call(lambda prompt: response, "prompt")
+
+    stats = governor.stats()
+    assert stats["throttled"] == 1
+    assert stats["calls"] == 2
+    #throttling isn't a provider failure
+    assert stats["state"] == "closed"
+
+
+def test_analyze_payload_skips_gemini_while_circuit_open(gemini_governor, mock_gemini):
+    """Test analyze_payload_2 answers with an error instead of calling gemini while the breaker is open."""
+    import gemini
+
+    gemini_governor.state = gemini_governor.OPEN
+    gemini_governor._opened_at = float('inf')
+
+    with patch.object(gemini, 'gemini_client') as mock_client:
+        result = gemini.analyze_payload_2({"query_params": b"id=1"})
+
+    mock_client.models.generate_content.assert_not_called()
+    assert result.startswith("Error: circuit open")
+
+
+@patch('app.db_connection')
+def test_narrative_report_goes_through_gemini_governor(mock_db_connection, client):
+    """Test the narrative report calls gemini through the governor and answers 503 while its circuit is open."""
+    from gemini_governor import GeminiUnavailable
+
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = [("SQL injection against /api/users",)]
+    mock_cursor.fetchone.return_value = (7,)
+    mock_db_connection.return_value.__enter__.return_value.cursor.return_value = mock_cursor
+
+    with patch('app.generate_content', return_value=MagicMock(text="Narrative")) as mock_generate:
+        response = client.get('/api/generate_narrative_report?attacker_id=3')
+    assert response.status_code == 200
+    assert response.get_json()["narrative_summary"] == "Narrative"
+    assert "SQL injection against /api/users" in mock_generate.call_args[0][0]
+
+    with patch('app.generate_content', side_effect=GeminiUnavailable("circuit open")):
+        response = client.get('/api/generate_narrative_report?attacker_id=3')
+    assert response.status_code == 503
+
+
+def test_log_shipper_batches_gzip_ndjson():
+    """Test queued logs go out as one gzip NDJSON post over the shipper's session."""
+    import gzip
+    from log_shipper import LogShipper
+
+    shipper = LogShipper("http://logstash:5044")
+    shipper.session = MagicMock()
+    shipper.session.post.return_value.status_code = 200
+
+    for i in range(3):
+        shipper._queue.put_nowait((0, json.dumps({"log": i})))
+    shipper.flush()
+
+    shipper.session.post.assert_called_once()
+    url = shipper.session.post.call_args[0][0]
+    kwargs = shipper.session.post.call_args[1]
+    assert url == "http://logstash:5044"
+    assert kwargs["headers"] == {"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"}
+    lines = gzip.decompress(kwargs["data"]).decode().splitlines()
+    assert [json.loads(line) for line in lines] == [{"log": 0}, {"log": 1}, {"log": 2}]
+
+    stats = shipper.stats()
+    assert stats["shipped"] == 3
+    assert stats["batches"] == 1
+    assert stats["pending"] == 0
+
+
+def test_log_shipper_retries_with_backoff():
+    """Test connection errors and 5xx answers are retried while other rejections are not."""
+    import requests
+    from log_shipper import LogShipper
+
+    shipper = LogShipper("http://logstash:5044", backoff=0)
+    shipper.session = MagicMock()
+    unavailable = MagicMock(status_code=503)
+    accepted = MagicMock(status_code=200)
+    shipper.session.post.side_effect = [requests.ConnectionError("refused"), unavailable, accepted]
+
+    assert shipper.send(['{"log": 1}'])
+    assert shipper.session.post.call_count == 3
+    assert shipper.stats()["retries"] == 2
+
+    shipper.session.post.reset_mock(side_effect=True)
+    shipper.session.post.return_value = MagicMock(status_code=400)
+    shipper._queue.put_nowait((0, '{"log": 2}'))
+    shipper.flush()
+
+    shipper.session.post.assert_called_once()
+    assert shipper.stats()["failed"] == 1
+
+
+@patch('app.get_log_shipper')
+def test_debug_log_shipper(mock_get_shipper, client):
+    """Test the /api/debug/log_shipper endpoint."""
+    mock_get_shipper.return_value.stats.return_value = {"shipped": 10, "last_lag_ms": 12.5}
+
+    response = client.get('/api/debug/log_shipper')
+
+    assert response.status_code == 200
+    assert response.get_json() == {"shipped": 10, "last_lag_ms": 12.5}
+
+
+def test_log_spool_rotates_evicts_and_resumes(tmp_path):
+    """Test the spool keeps order across segments, evicts the oldest past its cap and resumes from its cursor."""
+    from log_spool import LogSpool
+
+    spool = LogSpool(str(tmp_path), segment_bytes=40, max_bytes=100)
+    for i in range(12):
+        spool.append([json.dumps({"log": i})])
+
+    #a segment rotates after 4 logs of 11-12 bytes, the cap leaves room for the newest 2 segments
+    stats = spool.stats()
+    assert stats["evicted_lines"] == 4
+    assert stats["segments"] == 2
+
+    segment, lines = spool.next_batch(max_lines=2)
+    assert [json.loads(line)["log"] for line in lines] == [4, 5]
+    spool.ack(segment, 2)
+
+    #a restarted backend picks up after the acked logs
+    spool = LogSpool(str(tmp_path), segment_bytes=40, max_bytes=100)
+    remaining = []
+    while True:
+        batch = spool.next_batch(max_lines=2)
+        if batch is None:
+            break
+        remaining += [json.loads(line)["log"] for line in batch[1]]
+        spool.ack(batch[0], len(batch[1]))
+
+    assert remaining == [6, 7, 8, 9, 10, 11]
+    assert not spool.has_pending()
+
+
+def test_log_shipper_spools_while_logstash_is_down(tmp_path):
+    """Test failed batches go to the spool and are shipped in order, ahead of new logs, once logstash is back."""
+    import gzip
+    import requests
+    from log_shipper import LogShipper
+    from log_spool import LogSpool
+
+    shipper = LogShipper("http://logstash:5044", max_retries=0, spool=LogSpool(str(tmp_path)), drain_interval=0)
+    shipper.session = MagicMock()
+    shipper.session.post.side_effect = requests.ConnectionError("refused")
+
+    shipper._ship([(0, '{"log": 1}'), (0, '{"log": 2}')])
+    shipper._ship([(0, '{"log": 3}')])
+    assert shipper.stats()["spooled"] == 3
+    assert shipper.stats()["failed"] == 0
+
+    posted = []
+    def accept(url, data, headers, timeout):
+        posted.append([json.loads(line)["log"] for line in gzip.decompress(data).decode().splitlines()])
+        return MagicMock(status_code=200)
+    shipper.session.post.side_effect = accept
+
+    shipper._ship([(0, '{"log": 4}')])
+
+    assert sum(posted, []) == [1, 2, 3, 4]
+    assert not shipper.spool.has_pending()
+    assert shipper.stats()["shipped"] == 4
+
+
+def test_log_shipper_survives_spool_errors():
+    """Test an OSError from the spool is logged and backed off instead of killing the shipper thread."""
+    import time
+    from log_shipper import LogShipper
+
+    spool = MagicMock()
+    spool.next_batch.side_effect = [OSError("spool directory removed"), None, None, None, None]
+    spool.has_pending.return_value = False
+    shipper = LogShipper("http://logstash:5044", spool=spool, backoff=0.01, drain_interval=0)
+    shipper._collect = MagicMock(return_value=[])
+
+    shipper.start()
+    deadline = time.monotonic() + 2
+    while spool.next_batch.call_count < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    shipper._stopped.set()
+    shipper._thread.join(1)
+
+    assert spool.next_batch.call_count >= 2
+
+
+def test_attacker_session_cache_window():
+    """Test cached sessions are served inside the window and expire a margin before it ends."""
+    import time
+    from attacker_cache import AttackerSessionCache
+
+    cache = AttackerSessionCache(window=900, margin=30)
+    assert cache.lookup("10.0.0.1", "fp") is None
+
+    cache.remember("10.0.0.1", "fp", 4, 9, time.time())
+    assert cache.lookup("10.0.0.1", "fp") == (4, 9)
+
+    #an older transaction finishing late doesn't move last_seen back
+    cache.remember("10.0.0.1", "fp", 4, 9, time.time() - 880)
+    assert cache.lookup("10.0.0.1", "fp") == (4, 9)
+
+    cache.remember("10.0.0.2", "fp", 5, 10, time.time() - 880)
+    assert cache.lookup("10.0.0.2", "fp") is None
+
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["expired"] == 1
+    assert stats["identities"] == 2
+
+
+@patch('postgres_db.send_log_to_logstash')
+@patch('postgres_db.execute_values')
+@patch('postgres_db.db_connection')
+def test_log_attacker_batch_skips_resolve_for_cached_sessions(mock_db_connection, mock_execute_values, mock_send_log, attacker_cache):
+    """Test cached attackers are only touched and a session missing from postgres is resolved again."""
+    import time
+    import postgres_db
+
+    mock_db_connection.return_value.__enter__.return_value = MagicMock()
+
+    def attacker_summary(ip):
+        return {
+            "attacker_info": {
+                "ip_address": ip,
+                "device_fingerprint": "fp",
+                "user_agent": "{}",
+                "geolocation": "{}",
+                "browser": "curl",
+                "os": "Linux",
+                "device_type": "Other",
+                "is_bot": True
+            },
+            "gemini": {"technique": "Injection - SQL", "iocs": "[1=1]", "description": "SQLi"},
+            "request_details": {"path": "/api/forum"}
+        }
+
+    attacker_cache.remember("10.0.0.1", "fp", 1, 11, time.time())
+    attacker_cache.remember("10.0.0.2", "fp", 2, 12, time.time())
+
+    #session 12 was deleted behind the cache's back
+    mock_execute_values.side_effect = [[(11,)], None]
+    resolved = {("10.0.0.2", "fp"): (2, 13)}
+    with patch('postgres_db.resolve_attacker_sessions', return_value=resolved) as mock_resolve:
+        postgres_db.log_attacker_batch([attacker_summary("10.0.0.1"), attacker_summary("10.0.0.2")])
+
+    assert [info["ip_address"] for info in mock_resolve.call_args[0][1]] == ["10.0.0.2"]
+    touched = mock_execute_values.call_args_list[0][0][2]
+    assert [row[:2] for row in touched] == [(1, 11), (2, 12)]
+    attack_rows = mock_execute_values.call_args_list[1][0][2]
+    assert [row[0] for row in attack_rows] == ["11", "13"]
+
+    assert attacker_cache.lookup("10.0.0.2", "fp") == (2, 13)
+    assert attacker_cache.stats()["invalidated"] == 1
+
+
+def test_flood_suppressor_summarizes_repeats():
+    """Test only the first captures of a flood are processed and the repeats become one summarized row."""
+    import postgres_db
+    from flood_suppression import FloodSuppressor
+
+    emitted = []
+    suppressor = FloodSuppressor(emitted.append, full_events=2, window=60)
+
+    def capture(query):
+        return {
+            "attacker_info": {"ip_address": "10.0.0.5", "device_fingerprint": "fp"},
+            "gemini": None,
+            "payload_to_analyze": {"query_params": query},
+            "request_details": {"path": "/api/forum"}
+        }
+
+    flood = [capture(b"id=1 OR 1=1") for _ in range(5)]
+    assert [suppressor.admit(summary) for summary in flood] == [True, True, False, False, False]
+    #a different payload, or the same one in different case, is its own group
+    assert suppressor.admit(capture(b"id=2"))
+    assert not suppressor.admit(capture(b"ID=1 or 1=1"))
+
+    #workers classified the captures that went through in full
+    flood[1]["gemini"] = {"technique": "Injection - SQL", "iocs": "[{id?: 1 OR 1=1}]", "description": "Tautology"}
+
+    assert suppressor.flush() == 0
+    assert suppressor.flush(force=True) == 1
+
+    summary = emitted[0]
+    assert summary["count"] == 4
+    assert summary["first_ts"] <= summary["last_ts"]
+    assert summary["gemini"] == flood[1]["gemini"]
+    assert suppressor.stats()["suppressed"] == 4
+
+    row = postgres_db.attack_command_row({**summary, "session_id": 7, "attacker_info": {"device_type": "Other"}})
+    assert row[-3:] == (4, summary["first_ts"], summary["last_ts"])
+
+
+def test_log_security_misconfiguration_is_flood_suppressed(client):
+    """Test the sensor's port scan report, which carries no payload, goes through flood suppression."""
+    from flood_suppression import FloodSuppressor
+
+    emitted = []
+    suppressor = FloodSuppressor(emitted.append, full_events=1, window=60)
+    report = {"ip_address": "10.0.0.9", "device_fingerprint": "fp", "user_agent": "nmap"}
+
+    with patch('capture_pipeline.get_flood_suppressor', return_value=suppressor), \
+            patch('capture_pipeline.get_capture_pipeline') as pipeline:
+        pipeline.return_value.submit.return_value = True
+        responses = [client.post('/api/log/security_misconfiguration', json=report) for _ in range(3)]
+
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    assert pipeline.return_value.submit.call_count == 1
+    assert suppressor.flush(force=True) == 1
+    assert emitted[0]["count"] == 2
+    assert emitted[0]["payload_to_analyze"] == {}
+
+
+def test_flood_suppressor_window_reopens(monkeypatch):
+    """Test a closed window hands its repeats to the next flush and starts counting afresh."""
+    import flood_suppression
+
+    clock = [1000.0]
+    monkeypatch.setattr(flood_suppression.time, 'monotonic', lambda: clock[0])
+
+    emitted = []
+    suppressor = flood_suppression.FloodSuppressor(emitted.append, full_events=1, window=60)
+    capture = {
+        "attacker_info": {"ip_address": "10.0.0.5", "device_fingerprint": "fp"},
+        "gemini": None,
+        "payload_to_analyze": {"query_params": b"id=1"},
+        "request_details": {"path": "/api/forum"}
+    }
+
+    assert suppressor.admit(capture)
+    assert not suppressor.admit(capture)
+
+    clock[0] += 61
+    assert suppressor.admit(capture)
+    assert suppressor.flush() == 1
+    assert emitted[0]["count"] == 1
+    assert suppressor.stats()["groups"] == 1
+
+
+
+def test_metrics_endpoint(client):
+    """Test /metrics serves per route request counters and stage histograms in the Prometheus text format."""
+    from metrics import time_stage
+
+    with time_stage("ioc_scan"):
+        pass
+    client.get('/api/test')
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+
+    body = response.get_data(as_text=True)
+    assert '# TYPE honeypot_http_requests_total counter' in body
+    assert 'honeypot_http_requests_total{route="/api/test",method="GET",status="200"}' in body
+    assert 'honeypot_stage_seconds_bucket{stage="ioc_scan",le="+Inf"}' in body
+    assert 'honeypot_stage_seconds_count{stage="ioc_scan"}' in body
+
+
+def test_metrics_method_label_is_bounded(client):
+    """Test made up request methods share the "other" label instead of creating a label value each."""
+    client.open('/api/test', method='XYZZY')
+    client.open('/api/test', method='PLUGH')
+
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'method="other"' in body
+    assert 'XYZZY' not in body
+    assert 'PLUGH' not in body
+
+
+def test_histogram_buckets_are_cumulative():
+    """Test histogram buckets render cumulatively with a sum and count per label set."""
+    from metrics import Histogram
+
+    histogram = Histogram("test_seconds", "Test histogram", ("stage",), buckets=(0.1, 1))
+    histogram.observe(0.05, stage="a")
+    histogram.observe(0.5, stage="a")
+    histogram.observe(5, stage="a")
+
+    lines = histogram.render()
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="a",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{stage="a"} 5.55' in lines
+    assert histogram.count(stage="a") == 3
+
+
+def test_decoy_queries_are_timed_by_statement_type():
+    """Test decoy sqlite queries land in the decoy histogram under a bounded statement label."""
+    from decoy_database import TimedConnection
+    from metrics import DECOY_QUERY_SECONDS, sql_statement_type
+
+    assert sql_statement_type("  SELECT * FROM users") == "select"
+    assert sql_statement_type("(select 1)") == "select"
+    assert sql_statement_type("'; DROP TABLE users; --") == "other"
+    assert sql_statement_type("") == "other"
+
+    before = DECOY_QUERY_SECONDS.count(statement="create")
+    db = sqlite3.connect(":memory:", factory=TimedConnection)
+    db.execute("CREATE TABLE users (id INTEGER)")
+    db.executemany("INSERT INTO users VALUES (?)", [(1,), (2,)])
+    assert db.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 2
+
+    assert DECOY_QUERY_SECONDS.count(statement="create") == before + 1
+    assert DECOY_QUERY_SECONDS.count(statement="insert") >= 1
+
+
+def test_load_test_report_percentiles():
+    """Test the load test report gives nearest rank percentiles, error rates and status counts per route."""
+    from benchmarks.load_test import build_requests, percentile, summarize
+
+    assert percentile([1, 2, 3, 4], 50) == 2
+    assert percentile(list(range(1, 101)), 99) == 99
+    assert percentile([], 95) == 0.0
+
+    results = [("forum", 200, i / 1000) for i in range(1, 100)] + [("forum", 500, 0.5), ("login", None, 1.0)]
+    report = summarize(results, elapsed=2.0)
+
+    assert report["forum"]["requests"] == 100
+    assert report["forum"]["error_rate"] == 0.01
+    assert report["forum"]["p50_ms"] == 50.0
+    assert report["forum"]["p99_ms"] == 99.0
+    assert report["forum"]["statuses"] == {"200": 99, "500": 1}
+    assert report["login"]["statuses"] == {"failed": 1}
+    assert report["all"]["throughput_rps"] == 50.5
+
+    specs = build_requests(["' or 1=1 --"], 12, attackers=3)
+    assert {spec["route"] for spec in specs} == {"forum", "forum_comments", "employees", "reimbursement", "it_support", "login"}
+    assert len({spec["headers"]["X-Forwarded-For"] for spec in specs}) <= 3
+
+
+def test_fake_gemini_answers_batched_prompts():
+    """Test the stand-in gemini server answers in the numbered format the batcher splits."""
+    import requests
+    from benchmarks.fake_services import FakeGemini
+    from gemini import split_batch_response
+
+    service = FakeGemini().start()
+    try:
+        prompt = "Payload [1]:\n' or 1=1\n\nPayload [2]:\n<script>"
+        response = requests.post(service.url + "/v1beta/models/gemini-1.5-flash:generateContent",
+                                 json={"contents": [{"parts": [{"text": prompt}]}]})
+        text = response.json()["candidates"][0]["content"]["parts"][0]["text"]
+    finally:
+        service.stop()
+
+    answers = split_batch_response(text, 2)
+    assert all(answer and answer.startswith("Injection - SQL") for answer in answers)
+    assert service.stats()["requests"] == 1
+
+
+def test_microbenchmark_regression_check():
+    """Test microbenchmark results carry per call timings and slowdowns past the tolerance are flagged."""
+    from benchmarks.microbenchmarks import compare, measure
+
+    result = measure(lambda: None, number=100, repeat=2)
+    assert result["number"] == 100 and result["repeat"] == 2
+    assert 0 < result["best_us"] <= result["median_us"]
+
+    baseline = {"ioc_scan": {"best_us": 10.0}, "parse_gemini_answer": {"best_us": 2.0}}
+    results = {"ioc_scan": {"best_us": 13.0}, "parse_gemini_answer": {"best_us": 2.2}, "new_benchmark": {"best_us": 1.0}}
+    assert compare(results, baseline, tolerance=0.2) == {"ioc_scan": 1.3}
+
+
+def test_decoy_snapshot_rebuilds_when_stale(tmp_path):
+    """Test the decoy snapshot loads the same data as the SQL scripts and is rebuilt when the checksum changes."""
+    import decoy_snapshot
+
+    path = str(tmp_path / "decoy.sqlite")
+    assert decoy_snapshot.is_stale(path)
+    assert decoy_snapshot.ensure_snapshot(path)
+    assert not decoy_snapshot.ensure_snapshot(path)
+
+    scripted = sqlite3.connect(":memory:")
+    decoy_snapshot.run_source_scripts(scripted)
+    loaded = sqlite3.connect(":memory:")
+    decoy_snapshot.load_snapshot(loaded, path)
+    for table in ("Users", "Forum", "ForumComments", "SecurityAnswers"):
+        query = f"SELECT COUNT(*) FROM {table}"
+        assert loaded.execute(query).fetchone() == scripted.execute(query).fetchone()
+
+    # A checksum from other scripts marks the image stale
+    with open(path + ".sha256", "w") as f:
+        f.write("0" * 64)
+    assert decoy_snapshot.is_stale(path)
+    assert decoy_snapshot.ensure_snapshot(path)
+    assert decoy_snapshot.snapshot_checksum(path) == decoy_snapshot.source_checksum()
+
+
+def test_decoy_sandbox_copy_on_write():
+    """Test attackers read the base decoy until their first write, then only see their own changes."""
+    from decoy_sandbox import DecoySandboxes
+
+    def connect():
+        connection = sqlite3.connect(":memory:", check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    base = connect()
+    base.execute("CREATE TABLE Users (user_id INTEGER, password TEXT)")
+    base.execute("INSERT INTO Users VALUES (1, 'original')")
+    base.commit()
+
+    sandboxes = DecoySandboxes(connect, max_sandboxes=2)
+    assert sandboxes.connection("attacker-a", base) is None
+
+    sandbox = sandboxes.connection("attacker-a", base, for_write=True)
+    sandbox.execute("UPDATE Users SET password = 'pwned' WHERE user_id = 1")
+    sandbox.commit()
+
+    # Reads now follow attacker a to their copy, everyone else still sees the base
+    assert sandboxes.connection("attacker-a", base).execute("SELECT password FROM Users").fetchone()[0] == "pwned"
+    assert base.execute("SELECT password FROM Users").fetchone()[0] == "original"
+    assert sandboxes.connection("attacker-b", base) is None
+
+    # Past max_sandboxes the least recently used copy is dropped
+    sandboxes.connection("attacker-b", base, for_write=True)
+    sandboxes.connection("attacker-c", base, for_write=True)
+    assert sandboxes.connection("attacker-a", base) is None
+    assert sandboxes.stats()["sandboxes"] == 2
+    assert sandboxes.stats()["evicted"] == 1
+
+
+def test_decoy_sandbox_eviction_waits_for_release():
+    """Test a sandbox evicted while a request still uses it stays open until that request releases it."""
+    import decoy_database
+    from decoy_sandbox import DecoySandboxes
+
+    base = decoy_database._connect_sandbox()
+    base.execute("CREATE TABLE Forum (post TEXT)")
+
+    sandboxes = DecoySandboxes(decoy_database._connect_sandbox, max_sandboxes=1)
+    leased = sandboxes.connection("attacker-a", base, for_write=True)
+    leased.execute("INSERT INTO Forum VALUES ('hello')")
+    # Sandboxes run in autocommit like the base connections, a write leaves no transaction open
+    assert not leased.in_transaction
+
+    sandboxes.connection("attacker-b", base, for_write=True)
+    assert sandboxes.stats()["evicted"] == 1
+    assert leased.execute("SELECT post FROM Forum").fetchone()[0] == "hello"
+
+    sandboxes.release(leased)
+    with pytest.raises(sqlite3.ProgrammingError):
+        leased.execute("SELECT post FROM Forum")
+    assert sandboxes.stats()["leased"] == 1
+
+
+def test_change_password_uses_attacker_sandbox(client, monkeypatch):
+    """Test with sandboxes on a password change is only visible to the attacker who made it."""
+    import decoy_database
+    from decoy_sandbox import DecoySandboxes
+
+    monkeypatch.setenv('DECOY_SANDBOXES', 'true')
+    monkeypatch.setattr(decoy_database, '_decoy_sandboxes', DecoySandboxes(decoy_database._connect_sandbox))
+
+    username = decoy_database.get_memory_db().execute("SELECT username FROM Users LIMIT 1").fetchone()[0]
+    password_query = "SELECT password FROM Users WHERE username = ?"
+    original = decoy_database.get_memory_db().execute(password_query, (username,)).fetchone()[0]
+
+    attacker = {"X-Forwarded-For": "45.83.64.1", "User-Agent": "sqlmap/1.7.2"}
+    response = client.post('/api/change_password', json={"username": username, "newPassword": "hunter2"}, headers=attacker)
+    assert response.status_code == 200
+    # the request's lease on its sandbox ends at teardown
+    assert decoy_database.get_decoy_sandboxes().stats()["leased"] == 0
+
+    with app.test_request_context('/', headers=attacker):
+        assert decoy_database.get_memory_db().execute(password_query, (username,)).fetchone()[0] != original
+    with app.test_request_context('/', headers={"X-Forwarded-For": "45.83.64.2", "User-Agent": "sqlmap/1.7.2"}):
+        assert decoy_database.get_memory_db().execute(password_query, (username,)).fetchone()[0] == original
+
+
+def test_decoy_connections_pool_is_reused_across_request_threads():
+    """Test requests on fresh threads check out pooled decoy connections instead of opening new ones."""
+    import threading
+    import decoy_database
+
+    connections = decoy_database.DecoyConnections(uri="file:decoy_pool_test?mode=memory&cache=shared", max_idle=2)
+
+    def request_thread():
+        with app.test_request_context('/'), patch('decoy_database.get_decoy_connections', return_value=connections):
+            db = decoy_database.get_memory_db()
+            assert decoy_database.get_memory_db() is db
+            db.execute("BEGIN")
+            db.execute("SELECT count(*) FROM Users").fetchone()
+            decoy_database.release_memory_db()
+
+    for _ in range(5):
+        thread = threading.Thread(target=request_thread)
+        thread.start()
+        thread.join()
+
+    stats = connections.stats()
+    assert stats["opened"] == 1
+    assert stats["reused"] == 4
+    assert stats["in_use"] == 0
+    # a transaction left open by a request is rolled back before the connection is pooled again
+    assert not connections._idle[0].in_transaction
+
+
+def test_decoy_connections_per_thread_and_lock_waits():
+    """Test each thread gets its own decoy connection, reads skip writer locks and writers wait them out."""
+    import threading
+    from decoy_database import DecoyConnections
+
+    connections = DecoyConnections(uri="file:decoy_lock_test?mode=memory&cache=shared", lock_timeout=5)
+    writer = connections.connection()
+
+    other = {}
+    thread = threading.Thread(target=lambda: other.update(connection=connections.connection()))
+    thread.start()
+    thread.join()
+    assert other["connection"] is not writer
+    assert connections.connection() is writer
+
+    # Hold the Users table lock from this thread's connection
+    writer.execute("BEGIN IMMEDIATE")
+    writer.execute("UPDATE Users SET password = 'held' WHERE user_id = 1")
+
+    results = {}
+    def read_then_write():
+        connection = connections.connection()
+        results["read"] = connection.execute("SELECT password FROM Users WHERE user_id = 1").fetchone()[0]
+        connection.execute("UPDATE Users SET password = 'second' WHERE user_id = 1")
+        results["written"] = True
+
+    thread = threading.Thread(target=read_then_write)
+    thread.start()
+    thread.join(0.2)
+    assert results.get("read") == "held"
+    assert "written" not in results
+
+    writer.execute("COMMIT")
+    thread.join(5)
+    assert results["written"]
+    assert writer.execute("SELECT password FROM Users WHERE user_id = 1").fetchone()[0] == "second"
+
+    stats = connections.stats()
+    assert stats["lock_waits"] == 1
+    assert stats["lock_wait_ms_max"] >= 100
+    assert stats["lock_timeouts"] == 0
+
+
+def test_decoy_route_queries_use_indexes():
+    """Test no decoy route query scans a table it filters or joins on once the data is scaled up."""
+    from benchmarks.decoy_query_plans import DECOY_QUERIES, build_decoy_db, full_scans, run_plans
+
+    report = run_plans(scales=(2,), repeat=1)["2"]
+    assert report["rows"]["Users"] == 2 * build_decoy_db(1).execute("SELECT COUNT(*) FROM Users").fetchone()[0]
+    assert {name: query["full_scans"] for name, query in report["queries"].items() if query["full_scans"]} == {}
+
+    # Without the schema indexes the same checks catch the scans
+    connection = build_decoy_db(1, indexes=False)
+    searched = {name: (sql, tables) for name, sql, tables in DECOY_QUERIES}
+    assert full_scans(connection, *searched["forum_comments_by_forum"])[1] == ["SCAN ForumComments"]
+
+
+def test_decoy_result_cache_serves_repeats_until_a_write(client, mock_log_attacker, decoy_result_cache):
+    """Test repeated decoy reads come from the cache and a write to a table they read drops them."""
+    path = '/api/forum/comments?ForumComments.forum_id=1'
+    first = client.get(path)
+    assert first.status_code == 200
+    assert decoy_result_cache.stats()["misses"] == 1
+
+    with patch('honeypot_endpoints.decoy_rows_response') as run_query:
+        repeat = client.get(path)
+        run_query.assert_not_called()
+    assert repeat.data == first.data
+    assert repeat.mimetype == "application/json"
+    assert decoy_result_cache.stats()["hits"] == 1
+
+    # A write to another table leaves the entry alone, a new comment drops it
+    decoy_result_cache.invalidate(["CorporateInitiatives"])
+    assert decoy_result_cache.stats()["entries"] == 1
+    username = first.get_json()[0]["username"]
+    response = client.post('/api/forum/comments', json={"username": username, "forum_id": 1, "comment": "cached?"})
+    assert response.status_code == 200
+    assert decoy_result_cache.stats()["entries"] == 0
+    assert len(client.get(path).get_json()) == len(first.get_json()) + 1
+
+
+def test_decoy_result_cache_lru_and_scopes():
+    """Test the result cache evicts least recently used bodies and keeps sandbox results apart."""
+    from werkzeug.datastructures import MultiDict
+    from decoy_cache import DecoyResultCache, result_key
+
+    assert result_key("/api/forum", MultiDict([("b", "2"), ("a", "1")])) == result_key("/api/forum", MultiDict([("a", "1"), ("b", "2")]))
+
+    cache = DecoyResultCache(max_entries=2)
+    cache.put(("/a", (), None), b"[1]", "select * from Users", cache.clock())
+    cache.put(("/a", (), 7), b"[2]", "select * from Users", cache.clock())
+    cache.get(("/a", (), None))
+    cache.put(("/b", (), None), b"[3]", "select * from Forum", cache.clock())
+    assert cache.get(("/a", (), 7)) is None
+    assert cache.get(("/a", (), None)) == b"[1]"
+
+    # A write inside sandbox 7 never touches results of the shared database
+    cache.put(("/a", (), 7), b"[2]", "select * from Users", cache.clock())
+    cache.invalidate(["users"], 7)
+    assert cache.get(("/a", (), 7)) is None
+    assert cache.get(("/a", (), None)) == b"[1]"
+    assert cache.stats()["evicted"] == 2
+
+    # A read that started before a write to its table doesn't cache what it saw
+    started = cache.clock()
+    cache.invalidate(["Forum"])
+    cache.put(("/b", (), None), b"[3]", "select * from Forum", started)
+    cache.put(("/c", (), None), b"[4]", "select * from CorporateInitiatives", started)
+    assert cache.get(("/b", (), None)) is None
+    assert cache.get(("/c", (), None)) == b"[4]"
+    assert cache.stats()["stale"] == 1
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl
+from postgres_db import db_connection
+import common_path
+from metrics import time_postgres
+
+#Gemini verdict cache
+#Automated tools send the same payloads thousands of times, verdicts are cached by a hash of the
+#normalized request data and query params. An in-process LRU sits in front of the Gemini_Verdict table
+#so verdicts are shared by every worker and survive restarts
+
+def _normalize(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    return re.sub(r'\s+', ' ', str(value)).strip().casefold()
+
+def verdict_key(payload_to_analyze):
+    """sha256 of the normalized request data and query params, None when the request carried neither
+    since the verdict then depends on the attacker context rather than a payload"""
+    request_data = payload_to_analyze.get("request_data") or {}
+    query_params = payload_to_analyze.get("query_params") or b""
+    if isinstance(query_params, bytes):
+        query_params = query_params.decode('utf-8', 'replace')
+
+    normalized = {
+        "request_data": sorted((_normalize(key), _normalize(value)) for key, value in dict(request_data).items()),
+        "query_params": sorted((_normalize(key), _normalize(value)) for key, value in parse_qsl(query_params, keep_blank_values=True))
+    }
+    if not normalized["request_data"] and not normalized["query_params"]:
+        return None
+
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+class VerdictCache:
+    def __init__(self, max_entries=10000, persistent=True, retry_interval=30):
+        self.max_entries = max_entries
+        self.persistent = persistent
+        self.retry_interval = retry_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        #the postgres tier is skipped for retry_interval seconds after an error so an outage doesn't
+        #add a connection timeout to every lookup
+        self._persistent_down_until = 0
+
+        #counters exposed through stats()
+        self.memory_hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.errors = 0
+
+    def get(self, key):
+        with self._lock:
+            verdict = self._entries.get(key)
+            if verdict is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return dict(verdict)
+
+        verdict = self._load(key)
+        if verdict is not None:
+            self._remember(key, verdict)
+            self.persistent_hits += 1
+            return dict(verdict)
+
+        self.misses += 1
+        return None
+
+    def put(self, key, verdict):
+        verdict = {
+            "technique": verdict["technique"],
+            "iocs": verdict["iocs"],
+            "description": verdict["description"]
+        }
+        self._remember(key, verdict)
+        self._store(key, verdict)
+        self.stores += 1
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+
+        lookups = self.memory_hits + self.persistent_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.memory_hits + self.persistent_hits) / lookups, 4) if lookups else 0,
+            "stores": self.stores,
+            "errors": self.errors,
+            "cache_size": size,
+            "cache_capacity": self.max_entries,
+            "persistent": self.persistent
+        }
+
+    def _remember(self, key, verdict):
+        with self._lock:
+            self._entries[key] = verdict
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _persistent_available(self):
+        return self.persistent and time.monotonic() >= self._persistent_down_until
+
+    def _persistent_failed(self, e):
+        print(f"Verdict cache database error: {e}")
+        self.errors += 1
+        self._persistent_down_until = time.monotonic() + self.retry_interval
+
+    def _load(self, key):
+        if not self._persistent_available():
+            return None
+
+        try:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                with time_postgres("verdict_select"):
+                    cur.execute("""
+                        SELECT owasp_technique, ioc, gemini_response
+                        FROM Gemini_Verdict
+                        WHERE payload_hash = %s
+                    """, (key,))
+                    row = cur.fetchone()
+                cur.close()
+        except Exception as e:
+            self._persistent_failed(e)
+            return None
+
+        if row is None:
+            return None
+        return {"technique": row[0], "iocs": row[1], "description": row[2]}
+
+    def _store(self, key, verdict):
+        if not self._persistent_available():
+            return
+
+        try:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                with time_postgres("verdict_insert"):
+                    cur.execute("""
+                        INSERT INTO Gemini_Verdict (payload_hash, owasp_technique, ioc, gemini_response)
+                        VALUES (%s, %s, %s, %s)
+                        ON CONFLICT (payload_hash) DO NOTHING
+                    """, (key, verdict["technique"], verdict["iocs"], verdict["description"]))
+                conn.commit()
+                cur.close()
+        except Exception as e:
+            self._persistent_failed(e)
+
+
+_verdict_cache = None
+_verdict_cache_lock = threading.Lock()
+
+def get_verdict_cache():
+    global _verdict_cache
+
+    with _verdict_cache_lock:
+        if _verdict_cache is None:
+            _verdict_cache = VerdictCache(max_entries=int(os.environ.get('VERDICT_CACHE_SIZE', 10000)))
+
+    return _verdict_cache
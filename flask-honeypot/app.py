@@ -5,64 +5,18 @@ import hashlib
 import os
 from datetime import datetime
 from dotenv import load_dotenv
-from user_agents import parse
+import common_path
+from geolocation import get_geolocation_service
+from user_agent_parser import parse_user_agent
+from metrics import instrument_app, time_stage
 
 # Initialize Flask
 app = Flask(__name__)
+instrument_app(app)
 
 # Load environment variables (optional)
 load_dotenv()
 
-def parse_user_agent(user_agent_string):
-    """
-    Parse a user agent string into structured data using the user-agents package
-    """
-    if not user_agent_string:
-        return {
-            "browser": "Unknown",
-            "browser_version": "Unknown",
-            "os": "Unknown",
-            "device": "Unknown",
-            "is_mobile": False,
-            "is_tablet": False,
-            "is_pc": False,
-            "is_bot": False,
-            "raw": user_agent_string
-        }
-    
-    try:
-        # Parse the user agent string
-        user_agent = parse(user_agent_string)
-        
-        # Extract structured information
-        parsed_data = {
-            "browser": user_agent.browser.family,
-            "browser_version": ".".join(str(v) for v in user_agent.browser.version if v),
-            "os": f"{user_agent.os.family} {'.'.join(str(v) for v in user_agent.os.version if v)}".strip(),
-            "device": user_agent.device.family,
-            "is_mobile": user_agent.is_mobile,
-            "is_tablet": user_agent.is_tablet,
-            "is_pc": user_agent.is_pc,
-            "is_bot": user_agent.is_bot,
-            "raw": user_agent_string
-        }
-        
-        return parsed_data
-    except Exception as e:
-        print(f"Error parsing user agent: {e}")
-        return {
-            "browser": "Parse Error",
-            "browser_version": "Unknown",
-            "os": "Unknown",
-            "device": "Unknown",
-            "is_mobile": False,
-            "is_tablet": False,
-            "is_pc": False,
-            "is_bot": False,
-            "raw": user_agent_string,
-            "error": str(e)
-        }
-
 def extract_attacker_info():
     """Extract attacker information from the request with hardcoded payload for port 6969"""
     # Get IP Address
@@ -84,14 +38,13 @@ def extract_attacker_info():
     }
     device_fingerprint = hashlib.sha256(json.dumps(fingerprint_data, sort_keys=True).encode()).hexdigest()
     
-    # Get geolocation - optional, using ipinfo if available
+    # Get geolocation - offline IP database first, then ipinfo if a token is configured
     geolocation = {"country": "Unknown", "city": "Unknown"}
     try:
-        import ipinfo
         ipinfo_token = os.environ.get('IP_INFO_ACCESS_TOKEN')
-        if ipinfo_token:
-            geolocation_handler = ipinfo.getHandler(ipinfo_token)
-            geolocation = geolocation_handler.getDetails(ip_address).all
+        details = get_geolocation_service().lookup(ip_address, online=bool(ipinfo_token))
+        if details:
+            geolocation.update(details)
     except Exception as e:
         print(f"Geolocation lookup failed: {str(e)}")
     
@@ -112,7 +65,7 @@ def extract_attacker_info():
     ioc = json.dumps(ioc_list)
     
     # Store the full parsed UA data
-    user_agent_data = json.dumps(parsed_ua)
+    user_agent_data = json.dumps(dict(parsed_ua))
     
     return {
         "ip_address": ip_address,
@@ -145,11 +98,12 @@ def handle_port_6969_connection():
         backend_url = os.environ.get('BACKEND_API_URL')
 
         # Send data to backend
-        response = requests.post(
-            backend_url,
-            json=attacker_info,
-            headers={"Content-Type": "application/json"}
-        )
+        with time_stage("backend_forward"):
+            response = requests.post(
+                backend_url,
+                json=attacker_info,
+                headers={"Content-Type": "application/json"}
+            )
 
         # Check response
         if response.status_code == 200:
@@ -4,6 +4,16 @@ import requests
 from unittest.mock import patch, MagicMock
 from flask import Flask, request
 from app import app, parse_user_agent, extract_attacker_info, handle_port_6969_connection
+import geolocation
+from geolocation import GeolocationService
+
+
+@pytest.fixture(autouse=True)
+def geolocation_service():
+    """Give every test an empty geolocation cache so lookups don't leak between tests."""
+    geolocation._geolocation_service = GeolocationService()
+    yield geolocation._geolocation_service
+    geolocation._geolocation_service = None
 
 
 @pytest.fixture
@@ -547,4 +557,118 @@ def test_device_fingerprint_creation(mock_extract_info, client):
             fingerprint3 = result3["device_fingerprint"]
             
             # Verify fingerprint is different
-            assert fingerprint1 != fingerprint3
\ No newline at end of file
+            assert fingerprint1 != fingerprint3
+
+
+@patch('ipinfo.getHandler')
+@patch('os.environ.get')
+def test_geolocation_lookup_is_cached(mock_env_get, mock_get_handler, geolocation_service):
+    """Test repeat lookups for the same IP reuse one handler and skip the network."""
+    with app.test_request_context(
+        '/',
+        environ_base={
+            'REMOTE_ADDR': '8.8.8.8',
+        },
+        headers={
+            'User-Agent': 'Test/1.0'
+        }
+    ):
+        mock_env_get.return_value = "test_token"
+        mock_handler = MagicMock()
+        mock_get_handler.return_value = mock_handler
+        mock_details = MagicMock()
+        mock_details.all = {"country": "US", "city": "Mountain View"}
+        mock_handler.getDetails.return_value = mock_details
+
+        for _ in range(5):
+            result = extract_attacker_info()
+            assert result["geolocation"] == {"country": "US", "city": "Mountain View"}
+
+        mock_get_handler.assert_called_once()
+        mock_handler.getDetails.assert_called_once_with("8.8.8.8")
+
+        stats = geolocation_service.stats()
+        assert stats["misses"] == 1
+        assert stats["hits"] == 4
+
+
+@patch('ipinfo.getHandler')
+@patch('os.environ.get')
+def test_geolocation_skips_private_addresses(mock_env_get, mock_get_handler, geolocation_service):
+    """Test private and loopback addresses never reach ipinfo."""
+    mock_env_get.return_value = "test_token"
+
+    for ip_address in ['192.168.1.1', '127.0.0.1', '10.0.0.5', 'not-an-ip']:
+        with app.test_request_context('/', environ_base={'REMOTE_ADDR': ip_address}):
+            result = extract_attacker_info()
+            assert result["geolocation"]["bogon"] is True
+            assert result["geolocation"]["country"] == "Unknown"
+
+    mock_get_handler.assert_not_called()
+    assert geolocation_service.stats()["bogons"] == 4
+
+
+@patch('ipinfo.getHandler')
+def test_geolocation_offline_database_without_token(mock_get_handler, tmp_path, monkeypatch):
+    """Test an air-gapped sensor enriches events from the offline IP range file."""
+    ranges = tmp_path / "ip_ranges.csv"
+    ranges.write_text(
+        "network,country,city,asn\n"
+        "8.8.8.0/24,US,Mountain View,AS15169\n"
+        "2001:4860::/32,US,Mountain View,AS15169\n"
+    )
+    monkeypatch.delenv('IP_INFO_ACCESS_TOKEN', raising=False)
+    monkeypatch.setenv('IP_LOCATION_DB', str(ranges))
+    geolocation._geolocation_service = None
+
+    with app.test_request_context('/', environ_base={'REMOTE_ADDR': '8.8.8.8'}):
+        result = extract_attacker_info()
+        assert result["geolocation"]["country"] == "US"
+        assert result["geolocation"]["asn"] == "AS15169"
+
+    with app.test_request_context('/', environ_base={'REMOTE_ADDR': '2001:4860:4860::8888'}):
+        assert extract_attacker_info()["geolocation"]["city"] == "Mountain View"
+
+    #not in the file and no token, so it stays unknown instead of going to ipinfo
+    with app.test_request_context('/', environ_base={'REMOTE_ADDR': '1.1.1.1'}):
+        assert extract_attacker_info()["geolocation"] == {"country": "Unknown", "city": "Unknown"}
+
+    mock_get_handler.assert_not_called()
+
+
+def test_parse_user_agent_is_memoized():
+    """Test repeat user agents come from the cache as one shared read-only record."""
+    from user_agents import parse
+    from user_agent_parser import clear_user_agent_cache, user_agent_cache_stats
+
+    clear_user_agent_cache()
+    test_ua = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+
+    with patch('user_agent_parser.parse', wraps=parse) as mock_parse:
+        first = parse_user_agent(test_ua)
+        second = parse_user_agent(test_ua)
+
+    assert first is second
+    mock_parse.assert_called_once_with(test_ua)
+    assert user_agent_cache_stats()["hits"] == 1
+
+    with pytest.raises(TypeError):
+        first["browser"] = "Tampered"
+
+    # Long junk headers are parsed but never cached
+    parse_user_agent("x" * 5000)
+    assert user_agent_cache_stats()["cache_size"] == 1
+
+
+@patch('app.requests.post')
+def test_metrics_endpoint(mock_post, client):
+    """Test the sensor serves its request counters and backend forward timings from /metrics."""
+    mock_post.return_value = MagicMock(status_code=200)
+
+    client.get('/wp-login.php')
+    response = client.get('/metrics')
+
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'honeypot_http_requests_total{route="/<path:path>",method="GET",status="403"}' in body
+    assert 'honeypot_stage_seconds_count{stage="backend_forward"}' in body
@@ -0,0 +1,43 @@
+import os
+import sys
+import timeit
+
+#Microbenchmark for the memoized user agent parser
+#Usage: python benchmarks/user_agent_benchmark.py [iterations]
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from user_agent_parser import _parse_user_agent, clear_user_agent_cache, parse_user_agent
+
+#the kind of mix scanner traffic produces, a few tools repeated over and over
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 14_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.3 Mobile/15E148 Safari/604.1",
+    "sqlmap/1.7.2#stable (https://sqlmap.org)",
+    "curl/7.88.1",
+    "python-requests/2.31.0",
+    "Mozilla/5.0 zgrab/0.x",
+    "Googlebot/2.1 (+http://www.google.com/bot.html)",
+    "Nmap Scripting Engine; https://nmap.org/book/nse.html",
+]
+
+def run_benchmark(iterations=20000):
+    requests = [USER_AGENTS[i % len(USER_AGENTS)] for i in range(iterations)]
+
+    uncached = timeit.timeit(lambda: [_parse_user_agent(ua) for ua in requests], number=1)
+
+    clear_user_agent_cache()
+    cached = timeit.timeit(lambda: [parse_user_agent(ua) for ua in requests], number=1)
+
+    return {
+        "iterations": iterations,
+        "distinct_user_agents": len(USER_AGENTS),
+        "uncached_us_per_parse": round(uncached / iterations * 1e6, 3),
+        "cached_us_per_parse": round(cached / iterations * 1e6, 3),
+        "speedup": round(uncached / cached, 1) if cached else None
+    }
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for key, value in run_benchmark(iterations).items():
+        print(f"{key}: {value}")
@@ -0,0 +1,193 @@
+import ipaddress
+import os
+import threading
+import time
+from collections import OrderedDict
+from ip_database import IPLocationDatabase
+from metrics import time_stage, timed_stage
+
+try:
+    import ipinfo
+    import requests
+    from ipinfo.details import Details
+except ImportError:
+    ipinfo = None
+
+#Shared geolocation service for backend-flask and flask-honeypot
+#Lookups try the offline range database first, then one long lived ipinfo handler behind a bounded
+#LRU + TTL cache keyed by IP, scanners reuse the same addresses thousands of times so most lookups
+#never leave the process
+
+class GeolocationCache:
+    def __init__(self, max_entries=10000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def is_bogon(ip_address):
+    """True for private, loopback and other non routable addresses ipinfo can't locate"""
+    try:
+        ip = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return True
+
+    return ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_multicast or ip.is_reserved or ip.is_unspecified
+
+
+class IpinfoApiHandler:
+    """ipinfo details from another base URL (a proxy or the load test stand-in). The ipinfo handler
+    only reads the library's module level API_URL, which would redirect every handler in the process"""
+    def __init__(self, access_token, api_url, timeout=2):
+        self.access_token = access_token
+        self.api_url = api_url.rstrip('/')
+        self.timeout = timeout
+
+    def getDetails(self, ip_address):
+        headers = {"Accept": "application/json"}
+        if self.access_token:
+            headers["Authorization"] = f"Bearer {self.access_token}"
+        response = requests.get(f"{self.api_url}/{ip_address}", headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        return Details(response.json())
+
+
+class GeolocationService:
+    def __init__(self, access_token=None, max_entries=10000, ttl=3600, database=None, api_url=None):
+        self.access_token = access_token
+        self.api_url = api_url
+        self.database = database
+        self.cache = GeolocationCache(max_entries=max_entries, ttl=ttl)
+        self._handler = None
+        self._handler_lock = threading.Lock()
+
+        #counters exposed through stats()
+        self.hits = 0
+        self.misses = 0
+        self.bogons = 0
+        self.errors = 0
+        self.offline_hits = 0
+
+    def handler(self):
+        with self._handler_lock:
+            if self._handler is None:
+                if ipinfo is None:
+                    raise RuntimeError("ipinfo is not installed")
+                token = self.access_token or os.environ.get('IP_INFO_ACCESS_TOKEN')
+                api_url = self.api_url or os.environ.get('IPINFO_API_URL')
+                if api_url and api_url.startswith(('http://', 'https://')):
+                    self._handler = IpinfoApiHandler(token, api_url)
+                else:
+                    if api_url:
+                        print(f"IPINFO_API_URL {api_url!r} is not an http(s) URL, using ipinfo.io")
+                    self._handler = ipinfo.getHandler(token)
+            return self._handler
+
+    @timed_stage("geolocation")
+    def lookup(self, ip_address, online=True):
+        """Geolocation details for an IP in the same shape as ipinfo's Details.all, lookup errors are raised
+
+        With online=False only the offline database is used and None is returned when it has no match
+        """
+        if is_bogon(ip_address):
+            self.bogons += 1
+            return {"ip": ip_address, "bogon": True}
+
+        if self.database is not None:
+            details = self.database.lookup(ip_address)
+            if details is not None:
+                self.offline_hits += 1
+                return details
+
+        if not online:
+            return None
+
+        cached = self.cache.get(ip_address)
+        if cached is not None:
+            self.hits += 1
+            return dict(cached)
+
+        self.misses += 1
+        try:
+            with time_stage("ipinfo"):
+                details = self.handler().getDetails(ip_address).all
+        except Exception:
+            self.errors += 1
+            raise
+
+        self.cache.set(ip_address, details)
+        return dict(details)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bogons": self.bogons,
+            "errors": self.errors,
+            "offline_hits": self.offline_hits,
+            "offline_ranges": len(self.database) if self.database is not None else 0,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0,
+            "cache_size": len(self.cache),
+            "cache_capacity": self.cache.max_entries,
+            "evictions": self.cache.evictions
+        }
+
+
+def load_ip_database(path):
+    if not path:
+        return None
+
+    try:
+        database = IPLocationDatabase.load(path)
+        print(f"Loaded {len(database)} IP ranges from {path}")
+        return database
+    except OSError as e:
+        print(f"Could not load IP location database {path}: {e}")
+        return None
+
+
+_geolocation_service = None
+_geolocation_service_lock = threading.Lock()
+
+def get_geolocation_service():
+    global _geolocation_service
+
+    with _geolocation_service_lock:
+        if _geolocation_service is None:
+            _geolocation_service = GeolocationService(
+                max_entries=int(os.environ.get('GEOLOCATION_CACHE_SIZE', 10000)),
+                ttl=int(os.environ.get('GEOLOCATION_CACHE_TTL', 3600)),
+                database=load_ip_database(os.environ.get('IP_LOCATION_DB'))
+            )
+
+    return _geolocation_service
@@ -0,0 +1,239 @@
+import base64
+import binascii
+import json
+import os
+import re
+import threading
+from bisect import bisect_right
+from urllib.parse import unquote_plus
+from metrics import timed_stage
+
+#IOC rule engine
+#Signatures are loaded from a rules file (ioc_rules.json) and compiled into one regex, literal signatures
+#from every rule are folded into a single prefix trie so the cost per character stays flat as rules are
+#added. Body, query string and headers are lowercased, joined and scanned in a single pass, each match is
+#tagged with the rule and the part of the request it was found in. A rule can list the "locations" it
+#applies to (the broad SQL literals like "--" stay out of headers, where cookies and user agents carry
+#them innocently), fields whose rule sets differ are scanned with separate regexes. Regex patterns in
+#the rules file see lowercased text and should start with a literal character (not a class or \b) to
+#keep the scan fast. A rule's technique (the attack vector gemini would answer with) backs the fallback verdict when gemini
+#can't answer in time
+
+DEFAULT_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ioc_rules.json')
+
+#headers that are noisy by design (multipart boundaries are full of "--") and never carry a payload
+IGNORED_HEADERS = {"content-type", "content-length"}
+
+#only the start of each field is scanned so a huge upload can't stall the request
+MAX_SCAN_LENGTH = 65536
+
+def literal_trie_branches(literals):
+    """Top level alternatives of a regex matching any of the literals with shared prefixes factored out,
+    "union select" and "union all select" become union (?:all select|select)"""
+    trie = {}
+    for literal in literals:
+        node = trie
+        for char in literal:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    return [re.escape(char) + _trie_to_regex(child) for char, child in sorted(trie.items()) if char]
+
+def _trie_to_regex(node):
+    branches = [re.escape(char) + _trie_to_regex(child) for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ''
+
+    #a literal ending here makes the longer continuations optional
+    optional = '' in node
+    if len(branches) == 1 and not optional:
+        return branches[0]
+
+    return '(?:' + '|'.join(branches) + ')' + ('?' if optional else '')
+
+
+class RuleScanner:
+    """Compiled signatures and patterns of a set of rules"""
+    def __init__(self, rules):
+        self.names = tuple(rules)
+        self._literal_rules = {}
+        self._patterns = []
+
+        for name, rule in rules.items():
+            for signature in rule.get("signatures", []):
+                self._literal_rules.setdefault(signature.lower(), name)
+
+            for pattern in rule.get("patterns", []):
+                self._patterns.append((pattern, re.compile(pattern, re.MULTILINE), name))
+
+        #One flat alternation with no groups, when every branch starts with a literal character the regex
+        #engine can skip ahead to candidate positions instead of trying the whole alternation at every one.
+        #Which rule matched is worked out afterwards, only for the (rare) matches
+        alternatives = literal_trie_branches(self._literal_rules) + [pattern for pattern, _, _ in self._patterns]
+        self.pattern = re.compile('|'.join(alternatives) or '(?!)', re.MULTILINE)
+        self.signature_count = len(self._literal_rules) + len(self._patterns)
+
+    def match_rule(self, text, match):
+        rule = self._literal_rules.get(match.group())
+        if rule is not None:
+            return rule
+
+        #the literals didn't match here, so it was the first pattern that matches at this position
+        for _, compiled, name in self._patterns:
+            if compiled.match(text, match.start()):
+                return name
+
+
+class IOCRuleEngine:
+    def __init__(self, rules):
+        self.rules = rules
+        self.labels = {}
+        self.techniques = {}
+        #rule name -> locations it applies to, None for every location
+        self.locations = {}
+
+        for name, rule in rules.items():
+            self.labels[name] = rule.get("label", name)
+            if rule.get("technique"):
+                self.techniques[name] = rule["technique"]
+            self.locations[name] = set(rule["locations"]) if rule.get("locations") else None
+
+        every_rule = RuleScanner(rules)
+        self.pattern = every_rule.pattern
+        self.signature_count = every_rule.signature_count
+        #rule names -> scanner, locations with the same rules share one
+        self._scanners = {every_rule.names: every_rule}
+        #location -> scanner of the rules that apply there, built on first use
+        self._location_scanners = {}
+        self._lock = threading.Lock()
+
+    def scanner(self, location):
+        scanner = self._location_scanners.get(location)
+        if scanner is None:
+            names = tuple(name for name, locations in self.locations.items() if locations is None or location in locations)
+            with self._lock:
+                scanner = self._scanners.get(names)
+                if scanner is None:
+                    scanner = self._scanners[names] = RuleScanner({name: self.rules[name] for name in names})
+                self._location_scanners[location] = scanner
+        return scanner
+
+    @classmethod
+    def load(cls, path=DEFAULT_RULES_PATH):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    @timed_stage("ioc_scan")
+    def scan(self, fields, max_matches=50):
+        """Scan {location: text} in one pass per distinct rule set, returns [{"rule", "label", "location", "match"}]"""
+        #scanner -> (locations, offsets, parts, position)
+        groups = {}
+        for location, text in fields.items():
+            if not text:
+                continue
+            text = text[:MAX_SCAN_LENGTH].lower()
+            locations, offsets, parts, position = groups.setdefault(self.scanner(location), ([], [], [], [0]))
+            locations.append(location)
+            offsets.append(position[0])
+            parts.append(text)
+            position[0] += len(text) + 1
+
+        matches = []
+        for scanner, (locations, offsets, parts, _) in groups.items():
+            text = '\n'.join(parts)
+            for match in scanner.pattern.finditer(text):
+                rule = scanner.match_rule(text, match)
+                matches.append({
+                    "rule": rule,
+                    "label": self.labels[rule],
+                    "location": locations[bisect_right(offsets, match.start()) - 1],
+                    "match": match.group()
+                })
+                if len(matches) >= max_matches:
+                    return matches
+
+        return matches
+
+    def match_labels(self, matches):
+        """Distinct IOC labels for a list of matches, in rules file order"""
+        found = {match["rule"] for match in matches}
+        return list(dict.fromkeys(label for name, label in self.labels.items() if name in found))
+
+    def verdict(self, matches):
+        """Deterministic gemini style verdict from a list of matches, the technique of the rule with the
+        most matches (ties go to rules file order) or No Attack Vector when nothing matched"""
+        counts = {}
+        for match in matches:
+            if match["rule"] in self.techniques:
+                counts[match["rule"]] = counts.get(match["rule"], 0) + 1
+
+        if not counts:
+            return {"technique": "No Attack Vector", "iocs": "[]", "description": "No IOC rule matched the request"}
+
+        order = list(self.labels)
+        rule = max(counts, key=lambda name: (counts[name], -order.index(name)))
+
+        #same shape gemini is asked for, [{location: match}]
+        iocs = [f"{{{match['location']}: {match['match']}}}" for match in matches if match["rule"] in counts]
+        return {
+            "technique": self.techniques[rule],
+            "iocs": "[" + ", ".join(iocs) + "]",
+            "description": f"Matched IOC rules: {', '.join(self.labels[name] for name in order if name in counts)}"
+        }
+
+
+def _decode_json_values(body):
+    """The decoy frontend base64 encodes its form fields, decode them so the signatures can see the payload"""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return []
+
+    if not isinstance(data, dict):
+        return []
+
+    decoded = []
+    for value in data.values():
+        if not isinstance(value, str):
+            continue
+        try:
+            decoded.append(base64.b64decode(value, validate=True).decode('utf-8'))
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            pass
+    return decoded
+
+def request_fields(request):
+    """Body, query string and headers of a flask request as text for IOCRuleEngine.scan"""
+    body = request.get_data(cache=True, as_text=True) or ""
+    if request.mimetype == 'application/x-www-form-urlencoded':
+        body = unquote_plus(body)
+    elif request.is_json:
+        body = '\n'.join([body] + _decode_json_values(body))
+
+    headers = '\n'.join(f"{key}: {value}" for key, value in request.headers.items() if key.lower() not in IGNORED_HEADERS)
+
+    return {
+        "body": body,
+        "query": unquote_plus(request.query_string.decode('utf-8', 'replace')),
+        "headers": headers
+    }
+
+
+_ioc_rule_engine = None
+_ioc_rule_engine_lock = threading.Lock()
+
+def get_ioc_rule_engine():
+    global _ioc_rule_engine
+
+    with _ioc_rule_engine_lock:
+        if _ioc_rule_engine is None:
+            path = os.environ.get('IOC_RULES_PATH') or DEFAULT_RULES_PATH
+            try:
+                _ioc_rule_engine = IOCRuleEngine.load(path)
+            except OSError as e:
+                if path == DEFAULT_RULES_PATH:
+                    raise
+                print(f"Could not load IOC rules {path}, using {DEFAULT_RULES_PATH}: {e}")
+                _ioc_rule_engine = IOCRuleEngine.load(DEFAULT_RULES_PATH)
+
+    return _ioc_rule_engine
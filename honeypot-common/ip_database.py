@@ -0,0 +1,113 @@
+import csv
+import socket
+from array import array
+from bisect import bisect_right
+
+#Offline IP to location database
+#Loads a CSV of CIDR ranges (network,country,city,asn) into sorted integer arrays and answers lookups by
+#bisection, so sensors can enrich events without any network call. Ranges are expected not to overlap,
+#which is how the GeoLite/IP2Location style range exports are laid out
+
+def parse_address(ip_address):
+    """(version, integer value) for an IP string, socket.inet_pton is much cheaper than the ipaddress module"""
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip_address), 'big')
+    except OSError:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip_address), 'big')
+
+def parse_network(cidr):
+    """(version, first address, last address) for a CIDR string, host bits are ignored"""
+    address, _, prefix = cidr.strip().partition('/')
+    version, value = parse_address(address)
+    bits = 32 if version == 4 else 128
+    prefix = int(prefix) if prefix else bits
+    if not 0 <= prefix <= bits:
+        raise ValueError(f"Invalid prefix length in {cidr}")
+
+    host_mask = (1 << (bits - prefix)) - 1
+    start = value & ~host_mask
+    return version, start, start | host_mask
+
+
+class IPLocationDatabase:
+    def __init__(self):
+        #IPv4 bounds fit in unsigned 32 bit arrays, IPv6 bounds are 128 bit so they stay python ints
+        self._v4_starts = array('I')
+        self._v4_ends = array('I')
+        self._v4_meta = array('I')
+        self._v6_starts = []
+        self._v6_ends = []
+        self._v6_meta = array('I')
+
+        #(country, city, asn) tuples shared by every range with the same location
+        self._locations = []
+
+    @classmethod
+    def load(cls, path):
+        database = cls()
+        location_index = {}
+        v4_rows = []
+        v6_rows = []
+
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                try:
+                    version, start, end = parse_network(row["network"])
+                except (KeyError, ValueError, OSError, AttributeError, TypeError):
+                    continue
+
+                location = (row.get("country") or "", row.get("city") or "", row.get("asn") or "")
+                index = location_index.get(location)
+                if index is None:
+                    index = location_index[location] = len(database._locations)
+                    database._locations.append(location)
+
+                bounds = (start, end, index)
+                if version == 4:
+                    v4_rows.append(bounds)
+                else:
+                    v6_rows.append(bounds)
+
+        v4_rows.sort()
+        v6_rows.sort()
+
+        for start, end, index in v4_rows:
+            database._v4_starts.append(start)
+            database._v4_ends.append(end)
+            database._v4_meta.append(index)
+
+        for start, end, index in v6_rows:
+            database._v6_starts.append(start)
+            database._v6_ends.append(end)
+            database._v6_meta.append(index)
+
+        return database
+
+    def lookup(self, ip_address):
+        """Location for an IP as a dict, or None if it isn't covered by any range"""
+        try:
+            version, value = parse_address(ip_address)
+        except (OSError, TypeError, ValueError):
+            return None
+
+        if version == 4:
+            starts, ends, meta = self._v4_starts, self._v4_ends, self._v4_meta
+        else:
+            starts, ends, meta = self._v6_starts, self._v6_ends, self._v6_meta
+
+        i = bisect_right(starts, value) - 1
+        if i < 0 or value > ends[i]:
+            return None
+
+        country, city, asn = self._locations[meta[i]]
+        return {"ip": ip_address, "country": country, "city": city, "asn": asn}
+
+    def __len__(self):
+        return len(self._v4_starts) + len(self._v6_starts)
+
+    def stats(self):
+        return {
+            "ipv4_ranges": len(self._v4_starts),
+            "ipv6_ranges": len(self._v6_starts),
+            "locations": len(self._locations)
+        }
@@ -0,0 +1,211 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+#Shared latency and request metrics for backend-flask and flask-honeypot
+#Counters and histograms live in one process wide registry and are served in the Prometheus text format
+#from /metrics (see instrument_app). Stages are timed with time_stage("name"), label values must come from
+#a small fixed set since every distinct label combination is kept forever
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(tuple(labels.get(name, "") for name in self.labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        #label values -> [per bucket counts (the last one is +Inf), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            series = self._series.get(tuple(labels.get(name, "") for name in self.labels))
+            return series[2] if series else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (None,), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound is None else _format_value(float(bound))
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', le)])} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, documentation, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._get_or_create(Counter, name, documentation, labels=labels)
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labels=labels, buckets=buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "honeypot_stage_seconds", "Time spent in each capture processing stage", ("stage",))
+POSTGRES_SECONDS = REGISTRY.histogram(
+    "honeypot_postgres_statement_seconds", "Time spent per postgres statement", ("statement",))
+DECOY_QUERY_SECONDS = REGISTRY.histogram(
+    "honeypot_decoy_query_seconds", "Time spent per decoy sqlite query, by statement type", ("statement",))
+DECOY_LOCK_WAIT_SECONDS = REGISTRY.histogram(
+    "honeypot_decoy_lock_wait_seconds", "Time decoy sqlite statements waited on shared cache table locks")
+HTTP_REQUESTS = REGISTRY.counter(
+    "honeypot_http_requests_total", "HTTP requests by route, method and status", ("route", "method", "status"))
+HTTP_ERRORS = REGISTRY.counter(
+    "honeypot_http_request_errors_total", "HTTP requests that ended in a 5xx or an unhandled exception", ("route", "method"))
+HTTP_SECONDS = REGISTRY.histogram(
+    "honeypot_http_request_seconds", "HTTP request latency by route", ("route",))
+
+def time_stage(stage):
+    """Context manager timing one processing stage into honeypot_stage_seconds"""
+    return STAGE_SECONDS.time(stage=stage)
+
+def timed_stage(stage):
+    """Decorator form of time_stage"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(stage=stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def time_postgres(statement):
+    return POSTGRES_SECONDS.time(statement=statement)
+
+SQL_STATEMENT_TYPES = {"select", "insert", "update", "delete", "with", "pragma", "create", "drop"}
+
+def sql_statement_type(sql):
+    """First keyword of the statement, anything outside a known set is "other" so attacker supplied
+    SQL can't create new label values"""
+    keyword = str(sql).lstrip(" \t\r\n(").split(None, 1)[0].lower() if str(sql).strip() else ""
+    return keyword if keyword in SQL_STATEMENT_TYPES else "other"
+
+HTTP_METHODS = {"GET", "POST", "PUT", "PATCH", "DELETE", "HEAD", "OPTIONS"}
+
+def method_label(method):
+    """The request method, or "other" for the arbitrary tokens werkzeug lets attackers send"""
+    return method if method in HTTP_METHODS else "other"
+
+def instrument_app(app):
+    """Count and time every request of a flask app and serve the registry from /metrics"""
+    from flask import Response, g, request
+
+    def route_label():
+        #the url rule rather than the path, so scanners probing random paths share one label
+        return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+    @app.before_request
+    def start_request_timer():
+        g._metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('_metrics_started', None)
+        if started is not None:
+            route = route_label()
+            HTTP_SECONDS.observe(time.perf_counter() - started, route=route)
+            HTTP_REQUESTS.inc(route=route, method=method_label(request.method), status=str(response.status_code))
+            if response.status_code >= 500:
+                HTTP_ERRORS.inc(route=route, method=method_label(request.method))
+        return response
+
+    @app.teardown_request
+    def record_unhandled_error(exc):
+        #after_request doesn't run when the exception propagates (testing, debug)
+        started = g.pop('_metrics_started', None)
+        if exc is not None and started is not None:
+            route = route_label()
+            HTTP_SECONDS.observe(time.perf_counter() - started, route=route)
+            HTTP_REQUESTS.inc(route=route, method=method_label(request.method), status="500")
+            HTTP_ERRORS.inc(route=route, method=method_label(request.method))
+
+    def metrics():
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+    app.add_url_rule('/metrics', 'metrics', metrics, methods=['GET'])
+    return app
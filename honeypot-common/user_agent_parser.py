@@ -0,0 +1,86 @@
+from functools import lru_cache
+from types import MappingProxyType
+from user_agents import parse
+from metrics import timed_stage
+
+#Shared user agent parsing for backend-flask and flask-honeypot
+#The user_agents regex suite is one of the most expensive steps per request, scanner traffic only uses a
+#handful of UA strings so parsed results are memoized by the raw string in a bounded LRU cache
+
+USER_AGENT_CACHE_SIZE = 4096
+
+#longer strings are parsed without being cached so junk headers can't pin large keys in memory
+MAX_CACHED_LENGTH = 1024
+
+def _parse_user_agent(user_agent_string):
+    if not user_agent_string:
+        return MappingProxyType({
+            "browser": "Unknown",
+            "browser_version": "Unknown",
+            "os": "Unknown",
+            "device": "Unknown",
+            "is_mobile": False,
+            "is_tablet": False,
+            "is_pc": False,
+            "is_bot": False,
+            "raw": user_agent_string
+        })
+
+    try:
+        # Parse the user agent string
+        user_agent = parse(user_agent_string)
+
+        # Extract structured information
+        return MappingProxyType({
+            "browser": user_agent.browser.family,
+            "browser_version": ".".join(str(v) for v in user_agent.browser.version if v),
+            "os": f"{user_agent.os.family} {'.'.join(str(v) for v in user_agent.os.version if v)}".strip(),
+            "device": user_agent.device.family,
+            "is_mobile": user_agent.is_mobile,
+            "is_tablet": user_agent.is_tablet,
+            "is_pc": user_agent.is_pc,
+            "is_bot": user_agent.is_bot,
+            "raw": user_agent_string
+        })
+    except Exception as e:
+        print(f"Error parsing user agent: {e}")
+        return MappingProxyType({
+            "browser": "Parse Error",
+            "browser_version": "Unknown",
+            "os": "Unknown",
+            "device": "Unknown",
+            "is_mobile": False,
+            "is_tablet": False,
+            "is_pc": False,
+            "is_bot": False,
+            "raw": user_agent_string,
+            "error": str(e)
+        })
+
+_cached_parse_user_agent = lru_cache(maxsize=USER_AGENT_CACHE_SIZE)(_parse_user_agent)
+
+@timed_stage("user_agent_parse")
+def parse_user_agent(user_agent_string):
+    """
+    Parse a user agent string into structured data using the user-agents package
+
+    The result is a read only mapping shared between callers, copy it with dict() before changing it
+    """
+    if user_agent_string and len(user_agent_string) > MAX_CACHED_LENGTH:
+        return _parse_user_agent(user_agent_string)
+
+    return _cached_parse_user_agent(user_agent_string)
+
+def user_agent_cache_stats():
+    info = _cached_parse_user_agent.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "hit_ratio": round(info.hits / lookups, 4) if lookups else 0,
+        "cache_size": info.currsize,
+        "cache_capacity": info.maxsize
+    }
+
+def clear_user_agent_cache():
+    _cached_parse_user_agent.cache_clear()